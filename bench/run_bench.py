@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#Author: cdhigh <https://github.com/cdhigh>
+"""inkwell.py 的离线性能测试套件
+1. 启动本地AI服务桩(stub_server.py)，不需要网络和真实的api key
+2. 使用合成的大数据集测试：长对话、大体积 My Clippings.txt、多会话历史文件
+3. 输出json格式的报告：总耗时、p50/p95延时、网络收发字节数、内存峰值(tracemalloc)
+用法：
+python bench/run_bench.py --out result.json
+python bench/run_bench.py --quick --latency 0.05 --error-rate 0.1
+"""
+import os, sys, json, time, random, argparse, tempfile, platform, tracemalloc
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_PATH))
+sys.path.insert(0, BENCH_PATH)
+import inkwell
+from inkwell import percentile
+from stub_server import StubServer, StubConfig, fakeAnswer
+
+#执行一个测试项，返回统计结果字典
+#func: 无参数函数，每次迭代调用一次
+#stub: 如果提供，则统计这个测试项期间的网络收发字节数
+def measure(name, func, iterations, stub=None):
+    if stub:
+        stub.stats.reset()
+    latencies = []
+    errors = 0
+    tracemalloc.start()
+    wallStart = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    wall = time.perf_counter() - wallStart
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies.sort()
+    ret = {'name': name, 'iterations': iterations, 'errors': errors, 'wall_s': round(wall, 6),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3), 'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'peak_mem_kb': round(peak / 1024, 1)}
+    if stub:
+        stats = stub.stats.toDict()
+        ret['bytes_sent'] = stats['bytes_in'] #桩服务收到的就是客户端发出的
+        ret['bytes_received'] = stats['bytes_out']
+    return ret
+
+#生成一个长对话，返回消息列表，第一项为系统prompt
+def makeChat(turns, rnd):
+    messages = [{'role': 'system', 'content': inkwell.DEFAULT_PROMPT}]
+    for idx in range(turns):
+        messages.append({'role': 'user', 'content': f'Question {idx}: ' + fakeAnswer(200, rnd)})
+        messages.append({'role': 'assistant', 'content': fakeAnswer(1500, rnd)})
+    return messages
+
+#生成一个包含表格和代码块的markdown文本
+def makeMarkdown(size, rnd):
+    table = '| Name | Value | Note |\n|---|---|---|\n' + '\n'.join(f'| item{i} | {i * 3} | 备注{i} |' for i in range(8))
+    code = '```python\nfor i in range(10):\n    print(i)\n```'
+    parts = []
+    currLen = 0
+    while currLen < size:
+        block = '\n\n'.join([fakeAnswer(800, rnd), '> quoted line\n1. first\n2. second', table, code])
+        parts.append(block)
+        currLen += len(block)
+    return '\n\n'.join(parts)
+
+#生成指定大小的 My Clippings.txt 文件
+def makeClippings(fileName, sizeMb, rnd):
+    target = int(sizeMb * 1024 * 1024)
+    written = 0
+    idx = 0
+    with open(fileName, 'w', encoding='utf-8') as f:
+        while written < target:
+            loc = rnd.randint(1, 9000)
+            entry = (f'Book Title {idx % 50} (Author {idx % 13})\n'
+                f'- Your Highlight on page {loc // 20} | Location {loc}-{loc + 3} | Added on Monday, 1 January 2024 10:00:00\n\n'
+                f'{fakeAnswer(300, rnd)}\n==========\n')
+            f.write(entry)
+            written += len(entry.encode('utf-8'))
+            idx += 1
+    return written
+
+#生成历史会话列表
+def makeHistory(convNum, turns, rnd):
+    return [inkwell.Conversation.fromDict({'topic': f'conversation {idx}', 'prompt': 'default',
+        'messages': makeChat(turns, rnd)[1:]}) for idx in range(convNum)]
+
+#使用临时配置文件创建一个 InkWell 实例
+def makeInkWell(workDir, provider, host, displayStyle='markdown_table'):
+    cfg = dict(inkwell.DEFAULT_CFG)
+    cfg.update({'provider': provider, 'api_key': 'bench-key1;bench-key2', 'api_host': host,
+        'display_style': displayStyle, 'max_history': 1000, 'token_limit': 8000})
+    cfgFile = os.path.join(workDir, 'config.json')
+    with open(cfgFile, 'w', encoding='utf-8') as f:
+        json.dump(cfg, f)
+    return inkwell.InkWell(cfgFile)
+
+def runBench(args):
+    rnd = random.Random(args.seed)
+    results = []
+    stubCfg = StubConfig(latency=args.latency, throughput=args.throughput, errorRate=args.error_rate,
+        respSize=args.resp_size, seed=args.seed, compress=not args.no_gzip)
+    stub = StubServer(stubCfg=stubCfg, certFile=args.certfile, keyFile=args.keyfile).start()
+    workDir = tempfile.mkdtemp(prefix='inkwell_bench_')
+    try:
+        chat = makeChat(args.turns, rnd)
+        ink = makeInkWell(workDir, 'openai', stub.url)
+
+        #网络请求，每个服务商格式各测一次
+        for provider in ('openai', 'google', 'anthropic'):
+            model = inkwell.AI_LIST[provider]['models'][0]['name']
+            client = inkwell.SimpleAiProvider(provider, apiKey='bench-key1;bench-key2', model=model,
+                apiHost=stub.url, compressHosts=args.compress_hosts)
+            trimmed = ink.getTrimmedChat(chat)
+            results.append(measure(f'chat[{provider}]', lambda: client.chat(trimmed), args.requests, stub))
+            client.close()
+
+        #纯CPU处理
+        results.append(measure('getTrimmedChat', lambda: ink.getTrimmedChat(chat), args.iterations))
+        markdown = makeMarkdown(args.md_size, rnd)
+        results.append(measure('markdownToTerm', lambda: ink.markdownToTerm(markdown), args.iterations))
+        results.append(measure('markdownToHtml', lambda: ink.markdownToHtml(markdown), args.iterations))
+
+        #摘要文件
+        clipFile = os.path.join(workDir, 'My Clippings.txt')
+        clipBytes = makeClippings(clipFile, args.clip_mb, rnd)
+        inkwell.CLIPPINGS_FILE = clipFile
+        item = measure('readClippings', ink.readClippings, max(1, args.iterations // 10))
+        item['file_bytes'] = clipBytes
+        results.append(item)
+
+        #历史文件读写
+        ink.history = makeHistory(args.conversations, args.history_turns, rnd)
+        item = measure('saveHistory', ink.saveHistory, max(1, args.iterations // 10))
+        item['file_bytes'] = os.path.getsize(os.path.join(workDir, inkwell.HISTORY_JSON))
+        results.append(item)
+        results.append(measure('loadHistory', ink.loadHistory, max(1, args.iterations // 10)))
+    finally:
+        stub.stop()
+        if not args.keep:
+            import shutil
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    return {'version': inkwell.__Version__, 'python': platform.python_version(), 'machine': platform.machine(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'params': vars(args), 'results': results}
+
+def getArg():
+    parser = argparse.ArgumentParser(description='Offline benchmark for inkwell.py')
+    parser.add_argument("--out", metavar="FILE", help="Write the json report to this file")
+    parser.add_argument("--quick", action="store_true", help="Use small datasets for a fast run")
+    parser.add_argument("--iterations", type=int, default=50, help="Iterations of the cpu bound cases")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per provider")
+    parser.add_argument("--turns", type=int, default=200, help="Turns of the long chat")
+    parser.add_argument("--md-size", type=int, default=20000, help="Characters of the markdown text")
+    parser.add_argument("--clip-mb", type=float, default=20, help="Size of the clippings file in MB")
+    parser.add_argument("--conversations", type=int, default=100, help="Conversations in the history")
+    parser.add_argument("--history-turns", type=int, default=20, help="Turns of each history conversation")
+    parser.add_argument("--latency", type=float, default=0.0, help="Stub latency before the first byte")
+    parser.add_argument("--throughput", type=int, default=0, help="Stub body bytes per second")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Stub ratio of injected errors")
+    parser.add_argument("--resp-size", type=int, default=2000, help="Stub answer length")
+    parser.add_argument("--no-gzip", action="store_true", help="Stub never compresses the responses")
+    parser.add_argument("--compress-hosts", default='', help="Gzip request bodies for these hosts, '*' for all")
+    parser.add_argument("--certfile", help="PEM certificate to run the stub over https")
+    parser.add_argument("--keyfile", help="PEM private key for --certfile")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the synthetic data")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary work directory")
+    args = parser.parse_args()
+    if args.quick:
+        args.iterations, args.requests, args.turns = 5, 3, 40
+        args.clip_mb, args.conversations, args.history_turns = 1, 10, 5
+    return args
+
+if __name__ == "__main__":
+    args = getArg()
+    report = json.dumps(runBench(args), ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(report)
+    print(report)
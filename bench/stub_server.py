@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#Author: cdhigh <https://github.com/cdhigh>
+"""本地AI服务桩，模拟 OpenAI/Gemini/Anthropic 的接口格式，用于离线性能测试
+1. 可配置首字节延时、下载速率和错误注入比例
+2. 统计请求数和收发字节数
+3. 传入证书文件可以启用 HTTPS
+4. 支持gzip压缩的请求体，客户端支持的话响应体也使用gzip压缩
+用法：
+python bench/stub_server.py --port 8089 --latency 0.2 --throughput 20000 --error-rate 0.05
+"""
+import json, ssl, time, zlib, random, argparse, threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+#桩服务的行为参数
+class StubConfig:
+    def __init__(self, latency=0.0, throughput=0, errorRate=0.0, errorStatus=503, respSize=2000, seed=None,
+        compress=True):
+        self.latency = latency #收到请求后到返回首字节之间的延时(秒)
+        self.throughput = throughput #响应体的下载速率(字节/秒)，0为不限速
+        self.errorRate = errorRate #随机返回错误的比例 0.0-1.0
+        self.errorStatus = errorStatus #错误注入时返回的HTTP状态码
+        self.respSize = respSize #AI回复文本的大约长度(字符)
+        self.compress = compress #客户端支持的话是否使用gzip压缩响应体
+        self.random = random.Random(seed)
+
+#收发统计，多线程共享，需要加锁
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def add(self, bytesIn, bytesOut, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.bytesIn += bytesIn
+            self.bytesOut += bytesOut
+
+    def toDict(self):
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'bytes_in': self.bytesIn,
+                'bytes_out': self.bytesOut}
+
+#生成一段类似AI回复的markdown文本
+def fakeAnswer(size, rnd):
+    words = ['inkwell', 'kindle', 'reading', 'note', 'chapter', 'idea', 'book', 'summary', 'question',
+        'context', '**bold**', '*italic*', '`code`', '阅读', '摘要', '笔记']
+    lines = ['# Answer']
+    currLen = 0
+    while currLen < size:
+        line = '- ' + ' '.join(rnd.choice(words) for _ in range(12))
+        lines.append(line)
+        currLen += len(line) + 1
+    return '\n'.join(lines)
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #支持长连接，和 SimpleAiProvider 的连接池行为一致
+    disable_nagle_algorithm = True #避免响应头和响应体分开发送时的延时确认干扰测试结果
+
+    def log_message(self, format, *args): #安静模式
+        pass
+
+    def do_GET(self):
+        self.handle_request(b'')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.handle_request(self.rfile.read(length) if length else b'')
+
+    #分发请求，根据路径返回不同服务商格式的数据
+    def handle_request(self, reqBody):
+        cfg = self.server.stubCfg
+        rnd = cfg.random
+        bytesIn = len(self.requestline) + len(str(self.headers)) + len(reqBody)
+        if cfg.latency > 0:
+            time.sleep(cfg.latency)
+
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            reqBody = zlib.decompress(reqBody, 16 + zlib.MAX_WBITS)
+        path = self.path.split('?', 1)[0]
+        if cfg.errorRate > 0 and rnd.random() < cfg.errorRate:
+            status, data = cfg.errorStatus, {'error': {'message': 'injected error', 'code': cfg.errorStatus}}
+        else:
+            status, data = 200, self.build_response(path, reqBody, fakeAnswer(cfg.respSize, rnd))
+
+        body = json.dumps(data).encode('utf-8')
+        gzipped = cfg.compress and ('gzip' in self.headers.get('Accept-Encoding', ''))
+        if gzipped:
+            comp = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = comp.compress(body) + comp.flush()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.write_throttled(body, cfg.throughput)
+        self.server.stats.add(bytesIn, len(body), error=(status != 200))
+
+    #按指定速率输出响应体
+    def write_throttled(self, body, throughput):
+        if throughput <= 0:
+            self.wfile.write(body)
+            return
+        chunk = max(256, throughput // 20) #每50ms一个数据块
+        for pos in range(0, len(body), chunk):
+            self.wfile.write(body[pos:pos + chunk])
+            self.wfile.flush()
+            time.sleep(chunk / throughput)
+
+    #构建对应格式的json响应
+    def build_response(self, path, reqBody, answer):
+        try:
+            req = json.loads(reqBody) if reqBody else {}
+        except ValueError:
+            req = {}
+        promptTokens = len(reqBody) // 3
+        completionTokens = len(answer) // 3
+        if path.endswith(':generateContent'): #gemini
+            return {'candidates': [{'content': {'role': 'model', 'parts': [{'text': answer}]}, 'finishReason': 'STOP'}],
+                'usageMetadata': {'promptTokenCount': promptTokens, 'candidatesTokenCount': completionTokens,
+                'totalTokenCount': promptTokens + completionTokens}}
+        elif path.endswith('/v1/complete'): #anthropic 旧接口
+            return {'type': 'completion', 'completion': answer, 'stop_reason': 'stop_sequence',
+                'model': req.get('model', '')}
+        elif path.endswith('/v1/messages'): #anthropic messages接口
+            return {'type': 'message', 'role': 'assistant', 'model': req.get('model', ''),
+                'content': [{'type': 'text', 'text': answer}], 'stop_reason': 'end_turn',
+                'usage': {'input_tokens': promptTokens, 'output_tokens': completionTokens}}
+        elif path.endswith('/models'):
+            if 'v1beta' in path:
+                return {'models': [{'name': 'models/gemini-2.0-flash', 'inputTokenLimit': 1048576}]}
+            return {'object': 'list', 'data': [{'id': 'gpt-4o-mini', 'object': 'model'}, {'id': 'gpt-4o', 'object': 'model'}]}
+        else: #openai兼容格式
+            return {'id': 'chatcmpl-stub', 'object': 'chat.completion', 'model': req.get('model', ''),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': promptTokens, 'completion_tokens': completionTokens,
+                'total_tokens': promptTokens + completionTokens}}
+
+class ThreadingStubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+#封装桩服务器，可以在当前进程的后台线程运行
+class StubServer:
+    def __init__(self, host='127.0.0.1', port=0, stubCfg=None, certFile=None, keyFile=None):
+        self.server = ThreadingStubServer((host, port), StubHandler)
+        self.server.stubCfg = stubCfg or StubConfig()
+        self.server.stats = StubStats()
+        self.scheme = 'http'
+        if certFile:
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(certFile, keyFile)
+            self.server.socket = ctx.wrap_socket(self.server.socket, server_side=True)
+            self.scheme = 'https'
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'{self.scheme}://{host}:{port}'
+
+    @property
+    def stats(self):
+        return self.server.stats
+
+    @property
+    def config(self):
+        return self.server.stubCfg
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def getArg():
+    parser = argparse.ArgumentParser(description='Local stub server for AI providers')
+    parser.add_argument("--host", default='127.0.0.1', help="Listening address")
+    parser.add_argument("--port", type=int, default=8089, help="Listening port")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before the first byte")
+    parser.add_argument("--throughput", type=int, default=0, help="Body bytes per second, 0 for unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Ratio of injected errors")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of injected errors")
+    parser.add_argument("--resp-size", type=int, default=2000, help="Approximate answer length")
+    parser.add_argument("--no-gzip", action="store_true", help="Never compress the responses")
+    parser.add_argument("--certfile", help="PEM certificate to enable https")
+    parser.add_argument("--keyfile", help="PEM private key for --certfile")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = getArg()
+    stubCfg = StubConfig(latency=args.latency, throughput=args.throughput, errorRate=args.error_rate,
+        errorStatus=args.error_status, respSize=args.resp_size, compress=not args.no_gzip)
+    stub = StubServer(args.host, args.port, stubCfg, args.certfile, args.keyfile)
+    print(f'Stub server listening on {stub.url}')
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(stub.stats.toDict()))
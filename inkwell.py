@@ -19,14 +19,29 @@ bin/kterm.sh -e 'python3 /mnt/us/extensions/kterm/ai/inkwell.py --config /mnt/us
 lipc-set-prop com.lab126.cmd wirelessEnable 1
 lipc-set-prop com.lab126.cmd wirelessEnable 0
 """
-import os, sys, re, json, ssl, argparse
+import os, sys, io, re, hmac, json, ssl, html, math, time, zlib, heapq, queue, bisect, signal, socket, argparse, threading
 import http.client
+from array import array
+from collections import deque, Counter
+from itertools import accumulate
+from functools import lru_cache, wraps
 from urllib.parse import urlsplit
 
 __Version__ = 'v1.6.1 (2025-06-19)'
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 CONFIG_JSON = f"{BASE_PATH}/config.json"
 HISTORY_JSON = "history.json" #历史文件会自动跟随程序传入的配置文件路径
+RENDER_CACHE_JSON = "render_cache.json" #终端渲染结果的缓存文件，和历史文件在同一个目录
+PENDING_JSON = "pending.json" #网络不可用时等待发送的消息，和历史文件在同一个目录
+MODELS_JSON = "models.json" #从服务商获取的model列表缓存，和配置文件在同一个目录
+ARCHIVE_FILE = "archive.dat" #超过 max_history 的历史会话归档文件，和历史文件在同一个目录
+ARCHIVE_INDEX = "archive_index.jsonl" #归档文件的索引
+USAGE_JSON = "usage.json" #token用量账本，和历史文件在同一个目录
+CLIPS_CACHE_JSON = "clippings_cache.json" #去重后的最新读书摘要缓存，和历史文件在同一个目录
+CLIPS_INDEX_FILE = "clippings_index.bin" #全部读书摘要的检索索引，和历史文件在同一个目录
+MEMORY_INDEX_FILE = "memory_index.bin" #记忆模式使用的归档会话检索索引，和历史文件在同一个目录
+DOC_INDEX_DIR = "doc_index" #/doc 命令建立的文档索引目录，和历史文件在同一个目录
+DAEMON_LOG = "daemon.log" #常驻进程会话中的异常记录，常驻进程没有终端，和历史文件在同一个目录
 PROMPTS_FILE = f"{BASE_PATH}/prompts.txt"
 KINDLE_DOC_DIR = '/mnt/us/documents'
 CLIPPINGS_FILE = os.path.join(KINDLE_DOC_DIR, 'My Clippings.txt')
@@ -72,22 +87,486 @@ DEFAULT_TOPIC = 'new conversation'
 DEFAULT_CFG = {"provider": "", "model": "", "api_key": "", "api_host": "", 
     "display_style": "markdown", "chat_type": "multi_turn", "token_limit": 4000, "max_history": 10, 
     "prompt": "default", "custom_prompt": "", "smtp_sender": "", "smtp_host": "", "smtp_username": "",
-    "smtp_password": "", "renew_api_key": ""}
+    "smtp_password": "", "renew_api_key": "", "show_timing": False, "trace_file": "",
+    "compress_hosts": "", "relay_key": "", "daemon_idle": 10,
+    "profiles": [], "failover_cooldown": 300, "utility_profile": {},
+    "replay_turns": 10, "render_cache": False, "pack_history": True,
+    "net_probe": True, "model_cache_hours": 24, "archive_history": True, "clip_dedup": True,
+    "clip_top_k": 8, "memory_mode": False, "memory_turns": 2, "memory_chunks": 4,
+    "doc_chunks": 4, "connect_timeout": 10, "read_timeout": 60, "request_deadline": 0}
+
+#记忆模式下附加在系统prompt后面的相关对话片段
+MEMORY_PROMPT = """Excerpts from earlier conversations that may be related to the question, use them only if they help:
+{chunks}"""
+
+#文档模式下附加在系统prompt后面的文档片段
+DOC_PROMPT = """Parts of the document "{name}" related to the question, answer based on them:
+{chunks}"""
 
 #AI响应的结构封装
 class AiResponse:
-    def __init__(self, success, content='', error='', host=''):
+    def __init__(self, success, content='', error='', host='', timing='', offline=False):
         self.success = success
         self.content = content
         self.error = error
         self.host = host
+        self.timing = timing #显示在对话泡泡上的耗时信息
+        self.offline = offline #因为网络不可用而失败
+
+#一条对话消息，使用 __slots__ 节省内存，role 为驻留字符串
+#历史会话和当前会话共享同一个消息对象，content 只保存一份
+#支持 msg['content'] 和 msg.get('role') 的字典式访问，兼容原先使用字典的代码
+#_json 缓存这条消息在各种请求格式下的json片段，修改 role/content 后自动失效
+class Message:
+    __slots__ = ('role', 'content', '_json')
+    FIELDS = ('role', 'content')
+    def __init__(self, role='user', content=''):
+        self.role = sys.intern(role or 'user')
+        self.content = content or ''
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+        if key != '_json':
+            object.__setattr__(self, '_json', None)
+
+    def __getitem__(self, key):
+        if key not in Message.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in Message.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, sys.intern(value) if key == 'role' else value)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in Message.FIELDS else default
+
+    def toDict(self):
+        return {'role': self.role, 'content': self.content}
+
+    def __repr__(self):
+        return f'Message({self.role!r}, {self.content[:20]!r})'
+
+#json序列化时将 Message 转换为字典
+def jsonDefault(obj):
+    if isinstance(obj, (Message, Conversation)):
+        return obj.toDict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+#已经序列化好的json文本，作为 payload 顶层的值时由 dumpsPayload() 原样插入
+class RawJson(str):
+    pass
+
+RAW_JSON_MARK = '\x00inkwell-raw-json-'
+
+#序列化请求体，结果和 json.dumps(payload, default=jsonDefault) 完全相同
+#顶层的 RawJson 值先用占位字符串代替，序列化后再替换为原始文本
+def dumpsPayload(payload):
+    if not any(isinstance(value, RawJson) for value in payload.values()):
+        return json.dumps(payload, default=jsonDefault)
+    raws = {}
+    plain = {}
+    for key, value in payload.items():
+        if isinstance(value, RawJson):
+            mark = f'{RAW_JSON_MARK}{len(raws)}'
+            raws[json.dumps(mark)] = value
+            value = mark
+        plain[key] = value
+    text = json.dumps(plain, default=jsonDefault)
+    for mark, value in raws.items():
+        text = text.replace(mark, value, 1)
+    return text
+
+#json字符串转义后的文本，不包括两边的引号，多段转义文本直接拼接等于整个字符串的转义结果
+def jsonEscape(text):
+    return json.dumps(text)[1:-1]
+
+#一条消息在各种请求格式下的json片段
+#openai/google: 消息列表中的一项；anthropic/single_turn: 拼接为一个长字符串的一段，已经转义
+SINGLE_TURN_ROLES = {'system': 'background', 'assistant': 'Your responsed'}
+MESSAGE_ENCODERS = {
+    'openai': lambda e: json.dumps(e, default=jsonDefault),
+    'google': lambda e: json.dumps({'role': 'user' if (e.get('role') != 'assistant') else 'model',
+        'parts': [{'text': e.get('content', '')}]}),
+    'anthropic': lambda e: jsonEscape("\n\n{}: {}".format('Human' if (e.get('role') != 'assistant') else 'Assistant',
+        e.get('content', ''))),
+    'single_turn': lambda e: jsonEscape(f'{SINGLE_TURN_ROLES.get(e["role"], "I asked")}:\n{e["content"]}\n'),
+}
+
+#返回消息在 fmt 格式下的json片段，Message 对象缓存结果，每轮对话只需要编码新增的消息
+def encodeMessage(msg, fmt):
+    if not isinstance(msg, Message):
+        return MESSAGE_ENCODERS[fmt](msg)
+    cache = msg._json
+    if cache is None:
+        cache = msg._json = {}
+    frag = cache.get(fmt)
+    if frag is None:
+        frag = cache[fmt] = MESSAGE_ENCODERS[fmt](msg)
+    return frag
+
+#一个历史会话，不活动的会话可以调用 pack() 丢弃消息对象，只保留压缩后的json文本
+#访问 messages 时自动解压，保存历史文件时直接使用压缩前的json文本，不需要重新序列化
+class Conversation:
+    __slots__ = ('topic', 'prompt', '_messages', '_packed')
+    def __init__(self, topic=DEFAULT_TOPIC, prompt='default', messages=None):
+        self.topic = topic
+        self.prompt = prompt
+        self._messages = messages if messages is not None else []
+        self._packed = None #zlib压缩后的json文本，和保存到历史文件的格式相同
+
+    @classmethod
+    def fromDict(cls, item):
+        msgs = [Message(e.get('role'), e.get('content')) for e in (item.get('messages') or []) if isinstance(e, dict)]
+        return cls(item.get('topic', DEFAULT_TOPIC), item.get('prompt', 'default'), msgs)
+
+    @property
+    def messages(self):
+        if self._messages is None:
+            item = json.loads(zlib.decompress(self._packed).decode('utf-8'))
+            self._messages = [Message(e.get('role'), e.get('content')) for e in item.get('messages', [])]
+        return self._messages
+
+    @messages.setter
+    def messages(self, value):
+        self._messages = value
+        self._packed = None
+
+    @property
+    def packed(self):
+        return self._messages is None
+
+    #返回消息列表，压缩的会话临时解压为字典列表，不保留解压后的结果
+    def peekMessages(self):
+        if self._messages is not None:
+            return self._messages
+        return json.loads(zlib.decompress(self._packed).decode('utf-8')).get('messages', [])
+
+    #丢弃消息对象，只保留压缩后的文本
+    def pack(self):
+        if self._packed is None:
+            self._packed = zlib.compress(self.toJson().encode('utf-8'))
+        self._messages = None
+
+    #返回保存到历史文件的json文本
+    def toJson(self):
+        if self._messages is None:
+            return zlib.decompress(self._packed).decode('utf-8')
+        return json.dumps(self.toDict(), ensure_ascii=False, indent=2, default=jsonDefault)
+
+    def toDict(self):
+        return {'topic': self.topic, 'prompt': self.prompt, 'messages': self.messages}
+
+    def __getitem__(self, key):
+        if key not in ('topic', 'prompt', 'messages'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in ('topic', 'prompt', 'messages') else default
+
+#逐项解析json数组文本，每次只创建一个元素的对象，降低加载大文件时的内存峰值
+def iterJsonArray(text):
+    decoder = json.JSONDecoder()
+    skip = re.compile(r'[\s,]*')
+    pos = skip.match(text).end()
+    if text[pos:pos + 1] != '[':
+        raise ValueError('Not a json array')
+    pos = skip.match(text, pos + 1).end()
+    while pos < len(text) and text[pos] != ']':
+        item, pos = decoder.raw_decode(text, pos)
+        yield item
+        pos = skip.match(text, pos).end()
+
+#从历史文件加载会话列表，pack=True 则每个会话解析后马上压缩
+def loadConversations(fileName, pack=True):
+    with open(fileName, 'r', encoding='utf-8') as f:
+        text = f.read()
+    history = []
+    for item in iterJsonArray(text):
+        if isinstance(item, dict):
+            history.append(Conversation.fromDict(item))
+            if pack:
+                history[-1].pack()
+    return history
+
+#token用量账本，按天、ApiKey、model累计服务商返回的用量，同时根据实际的token数校准每个token的平均字符数
+#数据格式：{"days": {"2025-01-31": {"...abcd": {"gpt-4o": {"requests":, "prompt":, "completion":, "cached":}}}},
+#  "ratios": {"openai": {"ratio": 3.2, "samples": 10}}}
+class UsageLedger:
+    DEFAULT_RATIO = 3.0 #没有校准数据时，每个token平均3个字符
+    def __init__(self, fileName=None, keepDays=365):
+        self.fileName = fileName
+        self.keepDays = keepDays
+        self.data = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.data is None:
+            self.data = {'days': {}, 'ratios': {}}
+            try:
+                with open(self.fileName, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    self.data.update(data)
+            except Exception:
+                pass
+        return self.data
+
+    def save(self):
+        if not (self.fileName and self.dirty):
+            return
+        with self.lock:
+            days = self.data['days']
+            for day in sorted(days)[:-self.keepDays]: #删除太旧的记录
+                del days[day]
+            try:
+                with open(self.fileName, 'w', encoding='utf-8') as f:
+                    json.dump(self.data, f, ensure_ascii=False, indent=1)
+                self.dirty = False
+            except Exception as e:
+                print(f'Failed to save the usage ledger: {e}')
+
+    #记录一次请求的用量
+    #usage: {'prompt':, 'completion':, 'cached':}
+    #chars: 发送的文本字符数，用于校准；为0则不校准
+    def record(self, provider, key, model, usage, chars=0):
+        if not usage:
+            return
+        with self.lock:
+            data = self.load()
+            item = data['days'].setdefault(time.strftime('%Y-%m-%d'), {}).setdefault(key, {}).setdefault(model,
+                {'requests': 0, 'prompt': 0, 'completion': 0, 'cached': 0})
+            item['requests'] += 1
+            for k in ('prompt', 'completion', 'cached'):
+                item[k] += usage.get(k, 0) or 0
+            prompt = usage.get('prompt', 0) or 0
+            if chars > 0 and prompt >= 50: #太短的请求误差太大
+                cal = data['ratios'].setdefault(provider, {'ratio': self.DEFAULT_RATIO, 'samples': 0})
+                alpha = max(0.1, 1 / (cal['samples'] + 1)) #开始时快速收敛，之后缓慢跟随
+                cal['ratio'] = round(cal['ratio'] * (1 - alpha) + min(8.0, max(0.5, chars / prompt)) * alpha, 3)
+                cal['samples'] += 1
+            self.dirty = True
+
+    #返回某个服务商每个token的平均字符数
+    def charsPerToken(self, provider):
+        return (self.load()['ratios'].get(provider) or {}).get('ratio', self.DEFAULT_RATIO)
+
+    #返回最近几天的用量记录 [(day, key, model, item),]
+    def recent(self, days=7):
+        data = self.load()['days']
+        return [(day, key, model, item) for day in sorted(data)[-days:] for key, models in data[day].items()
+            for model, item in models.items()]
+
+#历史会话归档，超过 max_history 的会话追加到归档文件，永不丢失
+#每个会话单独压缩为一个数据块：4字节标识 + 4字节长度 + zlib压缩的json文本，读取一个会话不需要解压其他会话
+#索引文件每行一个json对象，记录数据块的位置、标题和时间，列表和过滤只需要读取索引
+#恢复到历史列表的会话在索引中追加一行删除标记 {"deleted": offset}，数据块保留
+class ConversationArchive:
+    MAGIC = b'IKA1'
+    DELETED = b'IKD1' #删除记录，后面4个字节为被删除会话的位置，重建索引时使用
+    def __init__(self, dirName):
+        self.dataFile = os.path.join(dirName, ARCHIVE_FILE)
+        self.indexFile = os.path.join(dirName, ARCHIVE_INDEX)
+        self._entries = None
+
+    #返回索引列表，最早归档的在前面 [{'offset':, 'size':, 'topic':, 'prompt':, 'time':, 'count':}]
+    def entries(self):
+        if self._entries is None:
+            if os.path.isfile(self.dataFile) and not os.path.isfile(self.indexFile):
+                self.rebuildIndex()
+            entries, deleted = [], set()
+            try:
+                with open(self.indexFile, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            item = json.loads(line)
+                        except ValueError: #写入时被中断的行
+                            continue
+                        if 'deleted' in item:
+                            deleted.add(item['deleted'])
+                        else:
+                            entries.append(item)
+            except OSError:
+                pass
+            self._entries = [item for item in entries if item['offset'] not in deleted]
+        return self._entries
+
+    #追加会话列表到归档文件
+    def append(self, convs):
+        entries = self.entries()
+        with open(self.dataFile, 'ab') as fData, open(self.indexFile, 'a', encoding='utf-8') as fIdx:
+            for conv in convs:
+                data = zlib.compress(conv.toJson().encode('utf-8'))
+                offset = fData.seek(0, os.SEEK_END)
+                fData.write(self.MAGIC + len(data).to_bytes(4, 'big') + data)
+                item = {'offset': offset, 'size': len(data), 'topic': conv.topic, 'prompt': conv.prompt,
+                    'time': int(time.time()), 'count': len(conv.messages)}
+                fIdx.write(json.dumps(item, ensure_ascii=False) + '\n')
+                entries.append(item)
+
+    #读取一个归档的会话，返回 Conversation 实例
+    def read(self, entry):
+        with open(self.dataFile, 'rb') as f:
+            f.seek(entry['offset'])
+            header = f.read(8)
+            if header[:4] != self.MAGIC:
+                raise ValueError('Corrupted archive block')
+            data = f.read(int.from_bytes(header[4:], 'big'))
+        return Conversation.fromDict(json.loads(zlib.decompress(data).decode('utf-8')))
+
+    #从索引中删除一个会话，数据块保留，归档文件中也追加一个删除记录
+    def remove(self, entry):
+        with open(self.dataFile, 'ab') as f:
+            f.write(self.DELETED + entry['offset'].to_bytes(4, 'big'))
+        with open(self.indexFile, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'deleted': entry['offset']}) + '\n')
+        self.entries().remove(entry)
+
+    #索引文件丢失时，扫描归档文件重建索引
+    def rebuildIndex(self):
+        with open(self.dataFile, 'rb') as fData, open(self.indexFile, 'w', encoding='utf-8') as fIdx:
+            while (header := fData.read(8))[:4] in (self.MAGIC, self.DELETED):
+                if header[:4] == self.DELETED:
+                    fIdx.write(json.dumps({'deleted': int.from_bytes(header[4:], 'big')}) + '\n')
+                    continue
+                offset = fData.tell() - 8
+                data = fData.read(int.from_bytes(header[4:], 'big'))
+                try:
+                    conv = Conversation.fromDict(json.loads(zlib.decompress(data).decode('utf-8')))
+                except Exception:
+                    continue
+                item = {'offset': offset, 'size': len(data), 'topic': conv.topic, 'prompt': conv.prompt,
+                    'time': int(os.path.getmtime(self.dataFile)), 'count': len(conv.messages)}
+                fIdx.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+#会话记忆，检索当前会话较早的对话、其他历史会话和归档会话中和问题相关的片段
+#每一轮问答为一个片段，返回时截断为 CHUNK 个字符
+#当前会话每轮增量加入索引；历史会话数量不多，列表变化后在内存中重建索引
+#归档只会追加，索引保存到文件并增量更新，已经恢复到历史列表的会话在检索时过滤掉
+class ConversationMemory:
+    CHUNK = 1200
+    def __init__(self, archive, indexFile):
+        self.archive = archive
+        self.indexFile = indexFile
+        self.current = None #当前会话的消息列表
+        self.currentIndex = None
+        self.currentCount = 0 #当前会话已经索引的消息数量
+        self.historyIndex = None
+        self.historySign = None
+        self.archiveIndex = None
+
+    #将 msgs[start:] 中完整的问答加入索引，引用为 (ref, 问题的下标)，返回下一个需要处理的下标
+    @staticmethod
+    def addTurns(index, msgs, ref, start=0):
+        idx = start
+        while idx + 1 < len(msgs):
+            if msgs[idx]['role'] == 'user' and msgs[idx + 1]['role'] == 'assistant':
+                if not msgs[idx + 1]['content'].startswith('Error: '):
+                    index.add('{}\n{}'.format(msgs[idx]['content'], msgs[idx + 1]['content']), ref, idx)
+                idx += 2
+            else:
+                idx += 1
+        return idx
+
+    @staticmethod
+    def turnText(msgs, idx):
+        return '{}\n{}'.format(msgs[idx]['content'], msgs[idx + 1]['content'])[:ConversationMemory.CHUNK]
+
+    def updateCurrent(self, messages):
+        if self.current is not messages or self.currentCount > len(messages):
+            self.current = messages
+            self.currentIndex = TermIndex(1 << 14)
+            self.currentCount = 1 #第一条为系统prompt
+        self.currentCount = self.addTurns(self.currentIndex, messages, 0, self.currentCount)
+
+    def updateHistory(self, history):
+        sign = tuple((id(conv), -1 if conv.packed else len(conv.messages)) for conv in history)
+        if sign != self.historySign:
+            self.historySign = sign
+            self.historyIndex = TermIndex(1 << 15)
+            for pos, conv in enumerate(history):
+                self.addTurns(self.historyIndex, conv.peekMessages(), pos)
+
+    #归档文件被重写过(比索引记录的位置短)则重建索引
+    def updateArchive(self):
+        if self.archiveIndex is None:
+            self.archiveIndex = TermIndex.load(self.indexFile)
+        index = self.archiveIndex
+        try:
+            size = os.path.getsize(self.archive.dataFile)
+        except OSError:
+            size = 0
+        if not index or index.meta.get('next', 0) > size:
+            index = self.archiveIndex = TermIndex(1 << 16)
+            index.meta = {'next': 0}
+        added = 0
+        for entry in self.archive.entries():
+            if entry['offset'] < index.meta['next']:
+                continue
+            try:
+                self.addTurns(index, self.archive.read(entry).messages, entry['offset'])
+            except Exception:
+                pass
+            index.meta['next'] = entry['offset'] + 8 + entry['size']
+            added += 1
+        if added:
+            try:
+                index.save(self.indexFile)
+            except Exception as e:
+                print(f'Failed to save the memory index: {e}')
+
+    #检索和 question 相关的片段，返回 [(会话标题, 片段文本)]，按相关度排序
+    #messages: 当前会话，只检索下标小于 recentStart 的部分；history 中标题为 currTopic 的会话(当前会话)跳过
+    def search(self, question, messages, recentStart, history, currTopic, k=4, budget=4000):
+        self.updateCurrent(messages)
+        self.updateHistory(history)
+        self.updateArchive()
+        live = {entry['offset']: entry for entry in self.archive.entries()}
+        found = [(score, 'current', doc) for score, doc in self.currentIndex.search(question, k * 2)]
+        found.extend((score, 'history', doc) for score, doc in self.historyIndex.search(question, k * 2))
+        found.extend((score, 'archive', doc) for score, doc in self.archiveIndex.search(question, k * 2))
+        found.sort(reverse=True)
+        ret = []
+        used = 0
+        convs = {} #同一个归档会话只读取一次
+        for _, source, doc in found:
+            ref, idx = (self.currentIndex if source == 'current' else self.historyIndex if source == 'history'
+                else self.archiveIndex).ref(doc)
+            if source == 'current':
+                if idx + 1 >= recentStart:
+                    continue
+                topic, msgs = currTopic, messages
+            elif source == 'history':
+                if ref >= len(history) or history[ref].topic == currTopic:
+                    continue
+                topic, msgs = history[ref].topic, history[ref].peekMessages()
+            else:
+                if ref not in live:
+                    continue
+                if ref not in convs:
+                    try:
+                        convs[ref] = self.archive.read(live[ref])
+                    except Exception:
+                        continue
+                topic, msgs = convs[ref].topic, convs[ref].messages
+            text = self.turnText(msgs, idx)
+            if ret and used + len(text) > budget:
+                break
+            ret.append((topic, text))
+            used += len(text)
+            if len(ret) >= k:
+                break
+        return ret
 
 #翻译颜色代码为终端转义字符串
 #color: 支持 列表[R, G, B]/字符串"red"
 #offset: =0 设置前景色，=10 设置背景色
 def interpretColor(color, offset=0):
     if isinstance(color, int):
-        return f"{38 + offset};5;{code:d}"
+        return f"{38 + offset};5;{color:d}"
     code = _TERMINAL_COLORS.get(color, 30) if isinstance(color, str) else color
     if isinstance(code, (tuple, list)): #RGB
         return f"{38 + offset};2;{code[0]:d};{code[1]:d};{code[2]:d}"
@@ -97,6 +576,14 @@ def interpretColor(color, offset=0):
 #返回着色格式化后的字符串，用于终端显示字体
 def style(text, fg=None, bg=None, bold=None, dim=None, underline=None, overline=None,
     italic=None, blink=None, reverse=None, strikethrough=None, reset=True):
+    fg = tuple(fg) if isinstance(fg, list) else fg #列表不能作为缓存的键
+    bg = tuple(bg) if isinstance(bg, list) else bg
+    prefix = stylePrefix(fg, bg, bold, dim, underline, overline, italic, blink, reverse, strikethrough)
+    return f"{prefix}{text}\033[0m" if reset else f"{prefix}{text}"
+
+#生成样式的转义字符串前缀，同样的样式只计算一次
+@lru_cache(maxsize=64)
+def stylePrefix(fg, bg, bold, dim, underline, overline, italic, blink, reverse, strikethrough):
     parts = []
     if fg:
         parts.append(f"\033[{interpretColor(fg)}m")
@@ -118,15 +605,265 @@ def style(text, fg=None, bg=None, bold=None, dim=None, underline=None, overline=
         parts.append(f"\033[{7 if reverse else 27}m")
     if strikethrough is not None:
         parts.append(f"\033[{9 if strikethrough else 29}m")
-    parts.append(text)
-    if reset:
-        parts.append("\033[0m")
     return "".join(parts)
 
 #向终端输出带颜色的字符串
 def sprint(txt, **kwargs):
     print(style(txt, **kwargs))
 
+#终端输出层，kterm在e-ink屏幕上每次写入都会触发一次局部刷新
+#帧：作为上下文管理器使用时，帧内所有的print输出先缓存，最外层帧结束时一次写入终端，支持嵌套
+#注意：帧内不能调用input()，否则提示符会被缓存
+class TermWriter:
+    def __init__(self):
+        self.depth = 0
+        self.target = None
+        self.buffer = None
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.target = sys.stdout
+            self.buffer = io.StringIO()
+            sys.stdout = self.buffer
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            sys.stdout = self.target
+            text = self.buffer.getvalue()
+            self.target = self.buffer = None
+            self.write(text)
+        return False
+
+    #使用一次系统调用写入终端
+    def write(self, text):
+        if not text:
+            return
+        out = sys.stdout
+        if self.depth: #在帧内
+            out.write(text)
+            return
+        out.flush()
+        if buf := getattr(out, 'buffer', None):
+            buf.write(text.encode(out.encoding or 'utf-8', 'replace'))
+            buf.flush()
+        else:
+            out.write(text)
+            out.flush()
+
+termWriter = TermWriter()
+
+#返回终端的列数，获取不到则使用环境变量 COLUMNS 或默认80
+def termWidth():
+    try:
+        return os.get_terminal_size(sys.stdout.fileno()).columns
+    except Exception:
+        return str_to_int(os.environ.get('COLUMNS', ''), 80) or 80
+
+#终端显示宽度查找表，(起始码位, 结束码位, 宽度)，按起始码位排序
+#宽度2为东亚宽字符(East Asian Width 为 W/F)和emoji，宽度0为组合字符和零宽字符，其他字符宽度为1
+#只收录常用区块，不需要在kindle上导入和遍历 unicodedata
+CHAR_WIDTH_TABLE = (
+    (0x0300, 0x036F, 0), (0x0483, 0x0489, 0), (0x0591, 0x05BD, 0), (0x0610, 0x061A, 0), (0x064B, 0x065F, 0),
+    (0x0E31, 0x0E31, 0), (0x0E34, 0x0E3A, 0), (0x0E47, 0x0E4E, 0), (0x1100, 0x115F, 2), (0x1160, 0x11FF, 0),
+    (0x1AB0, 0x1AFF, 0), (0x1DC0, 0x1DFF, 0), (0x200B, 0x200F, 0), (0x2028, 0x202E, 0), (0x2060, 0x2064, 0),
+    (0x20D0, 0x20FF, 0), (0x231A, 0x231B, 2), (0x2329, 0x232A, 2), (0x23E9, 0x23EC, 2), (0x23F0, 0x23F0, 2),
+    (0x23F3, 0x23F3, 2), (0x25FD, 0x25FE, 2), (0x2614, 0x2615, 2), (0x2648, 0x2653, 2), (0x267F, 0x267F, 2),
+    (0x2693, 0x2693, 2), (0x26A1, 0x26A1, 2), (0x26AA, 0x26AB, 2), (0x26BD, 0x26BE, 2), (0x26C4, 0x26C5, 2),
+    (0x26CE, 0x26CE, 2), (0x26D4, 0x26D4, 2), (0x26EA, 0x26EA, 2), (0x26F2, 0x26F3, 2), (0x26F5, 0x26F5, 2),
+    (0x26FA, 0x26FA, 2), (0x26FD, 0x26FD, 2), (0x2705, 0x2705, 2), (0x270A, 0x270B, 2), (0x2728, 0x2728, 2),
+    (0x274C, 0x274C, 2), (0x274E, 0x274E, 2), (0x2753, 0x2755, 2), (0x2757, 0x2757, 2), (0x2795, 0x2797, 2),
+    (0x27B0, 0x27B0, 2), (0x27BF, 0x27BF, 2), (0x2B1B, 0x2B1C, 2), (0x2B50, 0x2B50, 2), (0x2B55, 0x2B55, 2),
+    (0x2E80, 0x3029, 2), (0x302A, 0x302D, 0), (0x302E, 0x303E, 2), (0x3041, 0x3098, 2), (0x3099, 0x309A, 0),
+    (0x309B, 0x4DBF, 2), (0x4E00, 0xA4CF, 2), (0xA960, 0xA97F, 2), (0xAC00, 0xD7A3, 2), (0xD7B0, 0xD7FF, 0),
+    (0xF900, 0xFAFF, 2), (0xFE00, 0xFE0F, 0), (0xFE10, 0xFE19, 2), (0xFE20, 0xFE2F, 0), (0xFE30, 0xFE6F, 2),
+    (0xFEFF, 0xFEFF, 0), (0xFF00, 0xFF60, 2), (0xFFE0, 0xFFE6, 2), (0x16FE0, 0x16FE4, 2), (0x17000, 0x18CFF, 2),
+    (0x1B000, 0x1B2FF, 2), (0x1F004, 0x1F004, 2), (0x1F0CF, 0x1F0CF, 2), (0x1F18E, 0x1F18E, 2),
+    (0x1F191, 0x1F19A, 2), (0x1F200, 0x1F265, 2), (0x1F300, 0x1F320, 2), (0x1F32D, 0x1F335, 2),
+    (0x1F337, 0x1F37C, 2), (0x1F37E, 0x1F393, 2), (0x1F3A0, 0x1F3CA, 2), (0x1F3CF, 0x1F3D3, 2),
+    (0x1F3E0, 0x1F3F0, 2), (0x1F3F4, 0x1F3F4, 2), (0x1F3F8, 0x1F43E, 2), (0x1F440, 0x1F440, 2),
+    (0x1F442, 0x1F4FC, 2), (0x1F4FF, 0x1F53D, 2), (0x1F54B, 0x1F54E, 2), (0x1F550, 0x1F567, 2),
+    (0x1F57A, 0x1F57A, 2), (0x1F595, 0x1F596, 2), (0x1F5A4, 0x1F5A4, 2), (0x1F5FB, 0x1F64F, 2),
+    (0x1F680, 0x1F6C5, 2), (0x1F6CC, 0x1F6CC, 2), (0x1F6D0, 0x1F6D2, 2), (0x1F6D5, 0x1F6DF, 2),
+    (0x1F6EB, 0x1F6EC, 2), (0x1F6F4, 0x1F6FC, 2), (0x1F7E0, 0x1F7F0, 2), (0x1F90C, 0x1F93A, 2),
+    (0x1F93C, 0x1F945, 2), (0x1F947, 0x1F9FF, 2), (0x1FA70, 0x1FAFF, 2), (0x20000, 0x3FFFD, 2),
+    (0xE0001, 0xE007F, 0), (0xE0100, 0xE01EF, 0))
+CHAR_WIDTH_STARTS = [item[0] for item in CHAR_WIDTH_TABLE]
+ANSI_ESC_PATTERN = re.compile(r'\033\[[0-9;]*m')
+
+#返回一个字符在终端上占用的列数
+def charWidth(ch):
+    cp = ord(ch)
+    if cp < 0x300:
+        return 0 if cp < 32 else 1
+    idx = bisect.bisect_right(CHAR_WIDTH_STARTS, cp) - 1
+    if idx >= 0 and cp <= CHAR_WIDTH_TABLE[idx][1]:
+        return CHAR_WIDTH_TABLE[idx][2]
+    return 1
+
+#返回字符串在终端上的显示宽度，忽略里面的ANSI转义序列
+@lru_cache(maxsize=4096)
+def displayWidth(text):
+    if '\033' in text:
+        text = ANSI_ESC_PATTERN.sub('', text)
+    if text.isascii():
+        return len(text)
+    return sum(charWidth(ch) for ch in text)
+
+#将字符串按显示宽度折行，返回行列表，ANSI转义序列不占宽度，跨行的样式在下一行重新开始
+#英文优先在空格处折行，中日韩文字可以在任意位置折行
+def wrapByWidth(text, width):
+    if displayWidth(text) <= width:
+        return [text]
+    tokens = re.findall(r'\033\[[0-9;]*m|\s+|[\x21-\x7e]+|.', text)
+    lines = []
+    curr, currWidth, active = [], 0, []
+    def newLine():
+        nonlocal curr, currWidth
+        lines.append(''.join(curr).rstrip() + ('\033[0m' if active else ''))
+        curr, currWidth = list(active), 0
+
+    for token in tokens:
+        if token.startswith('\033'):
+            active = [] if token == '\033[0m' else active + [token]
+            curr.append(token)
+            continue
+        tokWidth = displayWidth(token)
+        if token.isspace():
+            if currWidth and currWidth + tokWidth <= width:
+                curr.append(token)
+                currWidth += tokWidth
+            elif currWidth:
+                newLine()
+            continue
+        if currWidth + tokWidth > width and currWidth:
+            newLine()
+        while tokWidth > width: #单词比列宽还长，强制截断
+            cut = ''
+            for ch in token:
+                if displayWidth(cut + ch) > width:
+                    break
+                cut += ch
+            cut = cut or token[0]
+            curr.append(cut)
+            currWidth += displayWidth(cut)
+            newLine()
+            token = token[len(cut):]
+            tokWidth = displayWidth(token)
+        if token:
+            curr.append(token)
+            currWidth += tokWidth
+    if currWidth or not lines:
+        lines.append(''.join(curr).rstrip())
+    return lines
+
+#在指定的总宽度内分配每列的宽度，列内容足够短的使用原宽度，剩余的宽度平均分配给其他列
+def fitColumnWidths(natural, avail):
+    widths = [0] * len(natural)
+    remain = list(range(len(natural)))
+    while remain:
+        share = max(2, avail // len(remain)) #最少两列宽，保证宽字符能放下
+        fits = [idx for idx in remain if natural[idx] <= share]
+        if not fits: #所有列都比平均宽度长，平均分配
+            for num, idx in enumerate(remain):
+                widths[idx] = max(2, avail // len(remain) + (1 if num < avail % len(remain) else 0))
+            break
+        for idx in fits:
+            widths[idx] = max(1, natural[idx])
+            avail -= widths[idx]
+            remain.remove(idx)
+    return widths
+
+#排版一个markdown表格块，每行都以 | 开头和结尾，返回排版后的字符串
+#同样的表格和终端宽度只排版一次，回放历史对话时直接使用缓存结果
+@lru_cache(maxsize=128)
+def layoutMdTable(block, width):
+    rows = [[cell.strip() for cell in row.strip().strip('|').split('|')] for row in block.split('\n')]
+    colNum = max(len(row) for row in rows)
+    rows = [row + [''] * (colNum - len(row)) for row in rows] #列数不够的行补充空单元格
+    isSep = [all(not cell.strip('-: ') for cell in row) and any(row) for row in rows]
+    natural = [max((displayWidth(row[i]) for row, sep in zip(rows, isSep) if not sep), default=1)
+        for i in range(colNum)]
+    colWidths = fitColumnWidths(natural, width - 3 * colNum - 1) #每列的 '| ' 和 ' ' 加上最后的 '|'
+
+    lines = []
+    contentIdx = 0
+    for row, sep in zip(rows, isSep):
+        if sep: #分割线
+            lines.append('| ' + "-+-".join(('-' * colWidth) for colWidth in colWidths) + ' |')
+            continue
+        bold = contentIdx == 0 #第一行为表头，使用粗体
+        contentIdx += 1
+        cells = [wrapByWidth(cell, colWidth) for cell, colWidth in zip(row, colWidths)]
+        for lineIdx in range(max(len(cell) for cell in cells)):
+            parts = []
+            for cell, colWidth in zip(cells, colWidths):
+                txt = cell[lineIdx] if lineIdx < len(cell) else ''
+                txt = txt + ' ' * (colWidth - displayWidth(txt))
+                parts.append(style(txt, bold=True) if bold else txt)
+            lines.append("| {} |".format(" | ".join(parts)))
+    return '\n'.join(lines)
+
+#终端渲染结果的缓存，键为 内容哈希+显示模式+终端宽度，值为渲染后的字符串
+#fileName: 如果提供，则在第一次使用时从文件加载，调用save()时保存到文件
+class RenderCache:
+    def __init__(self, fileName=None, maxItems=2000):
+        self.fileName = fileName
+        self.maxItems = maxItems
+        self.items = {}
+        self.loaded = False
+        self.dirty = False
+
+    #生成缓存键，使用两个校验和加长度，冲突概率可以忽略
+    @staticmethod
+    def key(content, disStyle, width):
+        data = content.encode('utf-8')
+        return f'{zlib.crc32(data):08x}{zlib.adler32(data):08x}{len(data)}:{disStyle}:{width}'
+
+    def get(self, key):
+        if not self.loaded:
+            self.load()
+        return self.items.get(key)
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.dirty = True
+        if len(self.items) > self.maxItems: #字典保持插入顺序，删除最早的
+            for oldKey in list(self.items)[:len(self.items) - self.maxItems]:
+                del self.items[oldKey]
+
+    def load(self):
+        self.loaded = True
+        if not self.fileName or not os.path.isfile(self.fileName):
+            return
+        try:
+            with open(self.fileName, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+            if isinstance(items, dict):
+                self.items = {**items, **self.items}
+        except Exception:
+            pass
+
+    def save(self):
+        if not self.fileName or not self.dirty:
+            return
+        try:
+            with open(self.fileName, 'w', encoding='utf-8') as f:
+                json.dump(self.items, f, ensure_ascii=False)
+            self.dirty = False
+        except Exception as e:
+            print(f'Failed to save render cache: {e}')
+
+#装饰器，函数内所有的终端输出合并为一帧写入
+def outputFrame(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with termWriter:
+            return func(*args, **kwargs)
+    return wrapper
+
 #字符串转整数，出错则返回default
 def str_to_int(txt, default=0):
     try:
@@ -134,16 +871,520 @@ def str_to_int(txt, default=0):
     except:
         return default
 
+#最近秩法计算百分位数，values需要是排好序的列表
+def percentile(values, pct):
+    if not values:
+        return 0
+    idx = max(0, min(len(values) - 1, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+    return values[idx]
+
+#读书摘要元数据行中表示位置的关键词，各语言的Kindle不同
+CLIP_LOCATION_WORDS = ('location', 'loc.', 'position', 'posición', 'posizione', 'positie', 'posição', '位置')
+
+#从读书摘要的元数据行解析位置范围，返回 (start, end)，无法解析返回None
+#元数据行使用竖杠分隔：笔记类型/页数/位置/时间，优先使用包含位置关键词的部分，否则使用第一个数字范围
+def parseClipLocation(meta):
+    parts = meta.lower().split('|')
+    parts = parts[:-1] or parts #最后一部分为添加时间
+    withWord = [e for e in parts if any(word in e for word in CLIP_LOCATION_WORDS)]
+    for part in withWord:
+        if match := re.search(r'(\d+)(?:\s*-\s*(\d+))?', part):
+            return int(match.group(1)), int(match.group(2) or match.group(1))
+    for part in parts:
+        if match := re.search(r'(\d+)\s*-\s*(\d+)', part):
+            return int(match.group(1)), int(match.group(2))
+    return None
+
+#读书摘要文本的字符4-gram集合，忽略大小写和空白，中英文都适用
+def clipShingles(text):
+    text = ''.join(text.split())
+    return {text[i:i + 4] for i in range(max(1, len(text) - 3))}
+
+#合并同一本书的近似重复摘要(Kindle每次扩展或重新选择高亮都会追加一条新记录)
+#两条都有位置时必须位置范围重叠，并且一条的文本包含另一条或者4-gram重合度超过一半，才认为是重复
+#重复的两条保留文本较长的一条(包含另一条的那条)，长度相同时保留较新的
+#entries: [(书名, 元数据行, 摘要内容)]，按文件中的顺序；返回保留下来的条目的下标列表
+def collapseClippings(entries):
+    kept = [] #[(下标, 位置, 规范化文本, 4-gram集合)]，被合并的项设置为None
+    byBook = {}
+    for idx, (book, meta, text) in enumerate(entries):
+        loc = parseClipLocation(meta)
+        norm = ' '.join(text.lower().split())
+        shingles = clipShingles(norm)
+        dropped = False
+        for pos in byBook.get(book, []):
+            if not (item := kept[pos]):
+                continue
+            _, oldLoc, oldNorm, oldShingles = item
+            if loc and oldLoc and not (loc[0] <= oldLoc[1] and oldLoc[0] <= loc[1]):
+                continue
+            if not ((oldNorm in norm or norm in oldNorm) or (loc and oldLoc and
+                len(shingles & oldShingles) * 2 >= min(len(shingles), len(oldShingles)))):
+                continue
+            if len(oldNorm) > len(norm):
+                dropped = True
+                break
+            kept[pos] = None
+        if not dropped:
+            byBook.setdefault(book, []).append(len(kept))
+            kept.append((idx, loc, norm, shingles))
+    return [item[0] for item in kept if item]
+
+#解析一条读书摘要，返回 (书名, 元数据行, 摘要内容)，不是有效的摘要返回None
+#每个笔记第一行是书名；第二行使用横杠开头，竖杠分割：笔记类型/页数/位置/时间；之后为具体摘要内容
+def parseClipping(item):
+    lines = item.strip().split('\n', 2)
+    if len(lines) < 3 or not lines[-1].strip():
+        return None
+    return lines[0].strip('\ufeff '), lines[1], lines[-1].strip()
+
+#从 offset 开始逐条读取读书摘要文件，不需要一次读入整个文件
+#返回 (起始位置, 结束位置, 书名, 元数据行, 摘要内容) 的生成器，位置为字节偏移，结束位置包括分隔行
+#文件末尾还没有分隔行的摘要可能不完整，不返回
+def iterClippings(fileName, offset=0):
+    with open(fileName, 'rb') as f:
+        f.seek(offset)
+        start = pos = offset
+        lines = []
+        for line in f:
+            pos += len(line)
+            if not line.startswith(b'=========='):
+                lines.append(line)
+                continue
+            if item := parseClipping(b''.join(lines).decode('utf-8', errors='ignore').replace('\r\n', '\n')):
+                yield (start, pos) + item
+            start = pos
+            lines = []
+
+#检索用的分词：拉丁/西里尔字母单词(去掉常见的停用词和几个常见的后缀)，中日韩文字使用相邻的两个字
+RETRIEVAL_TOKEN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+|[a-z0-9\u00c0-\u024f\u0400-\u04ff]+')
+RETRIEVAL_STOPWORDS = frozenset('about after all also an and any are as at be been but by can could did do does for '
+    'from had has have he her his how if in into is it its me my no not of on or our she so than that the their them '
+    'then there these they this to was we were what when where which who why will with would you your'.split())
+RETRIEVAL_SUFFIXES = ('ism', 'ists', 'ist', 'ings', 'ing', 's')
+def retrievalTerms(text):
+    terms = []
+    for word in RETRIEVAL_TOKEN.findall(text.lower()):
+        if word[0] >= '\u3040':
+            terms.extend(word[i:i + 2] for i in range(max(1, len(word) - 1)))
+        elif len(word) > 1 and word not in RETRIEVAL_STOPWORDS:
+            for suffix in RETRIEVAL_SUFFIXES:
+                if word.endswith(suffix) and len(word) - len(suffix) >= 4 and not word.endswith('ss'):
+                    word = word[:-len(suffix)]
+                    break
+            terms.append(word)
+    return terms
+
+#哈希TF-IDF检索索引，词语使用crc32哈希到固定数量的桶，不需要保存词表
+#倒排表使用 array 紧凑保存：postStart[t] 到 postStart[t + 1] 为桶t在 postDocs/postTf 中的范围
+#新增的文档先放在 delta 字典中，积累到一定数量或者保存时才合并到倒排表，支持增量更新
+#添加文档后所有词的idf都会变化，文档的向量长度在检索和保存前使用当前的df统一重新计算
+#每个文档只保存一个引用(起始位置和长度)，原文由调用者根据引用读取
+class TermIndex:
+    ARRAYS = (('df', 'I'), ('norms', 'f'), ('refStart', 'I'), ('refLen', 'I'), ('postStart', 'I'),
+        ('postDocs', 'I'), ('postTf', 'H'))
+    def __init__(self, dim=1 << 17):
+        self.dim = dim #桶的数量，必须为2的幂
+        self.df = array('I', [0]) * dim
+        self.norms = array('f')
+        self.refStart = array('I')
+        self.refLen = array('I')
+        self.postStart = array('I', [0]) * (dim + 1)
+        self.postDocs = array('I')
+        self.postTf = array('H')
+        self.delta = {} #{桶: [(文档编号, 词频)]}，还没有合并到倒排表的文档
+        self.deltaDocs = 0
+        self.meta = {} #调用者保存的附加信息，比如已经索引到的文件位置
+        self.buckets = {} #词语到桶的缓存
+        self.stale = False #添加文档后 norms 还没有重新计算
+
+    def __len__(self):
+        return len(self.norms)
+
+    #分词并统计词频，返回 {桶: 词频}，先统计单词数量，每个不同的单词只需要查一次缓存
+    def termCounts(self, text):
+        cache = self.buckets
+        if len(cache) > 100000:
+            cache.clear()
+        counts = {}
+        for word, num in Counter(RETRIEVAL_TOKEN.findall(text.lower())).items():
+            if (buckets := cache.get(word)) is None:
+                mask = self.dim - 1
+                buckets = cache[word] = [zlib.crc32(term.encode('utf-8')) & mask for term in retrievalTerms(word)]
+            for t in buckets:
+                counts[t] = counts.get(t, 0) + num
+        return counts
+
+    def idf(self, t):
+        return math.log((len(self.norms) + 1) / (self.df[t] + 1)) + 1
+
+    #添加一个文档，start/length 为原文的引用，返回文档编号
+    def add(self, text, start, length):
+        doc = len(self.norms)
+        df, delta = self.df, self.delta
+        for t, tf in self.termCounts(text).items():
+            df[t] += 1
+            delta.setdefault(t, []).append((doc, min(tf, 65535)))
+        self.norms.append(1.0)
+        self.stale = True
+        self.refStart.append(start)
+        self.refLen.append(length)
+        self.deltaDocs += 1
+        if self.deltaDocs >= 5000:
+            self.compact()
+        return doc
+
+    #将 delta 中的文档合并到倒排表，没有变化的桶整段复制
+    def compact(self):
+        if not self.delta:
+            return
+        extra = [0] * (self.dim + 1)
+        docs, tfs = array('I'), array('H')
+        pos = 0
+        for t in sorted(self.delta):
+            items = self.delta[t]
+            extra[t + 1] = len(items)
+            end = self.postStart[t + 1]
+            docs += self.postDocs[pos:end]
+            tfs += self.postTf[pos:end]
+            docs.extend(doc for doc, _ in items)
+            tfs.extend(tf for _, tf in items)
+            pos = end
+        docs += self.postDocs[pos:]
+        tfs += self.postTf[pos:]
+        self.postStart = array('I', (a + b for a, b in zip(self.postStart, accumulate(extra))))
+        self.postDocs, self.postTf = docs, tfs
+        self.delta = {}
+        self.deltaDocs = 0
+
+    #使用当前的df重新计算所有文档的向量长度，保证先后添加的相同文档得分相同
+    def updateNorms(self):
+        self.compact()
+        if not self.stale:
+            return
+        log = math.log
+        total = len(self.norms) + 1
+        squares = [0.0] * len(self.norms)
+        df, postStart, postDocs, postTf = self.df, self.postStart, self.postDocs, self.postTf
+        weights = [(1 + log(tf)) ** 2 if tf else 0.0 for tf in range(256)] #常见词频的缓存
+        for t in range(self.dim):
+            start, end = postStart[t], postStart[t + 1]
+            if start == end:
+                continue
+            idf = log(total / (df[t] + 1)) + 1 #和 idf() 相同
+            idf2 = idf * idf
+            for idx in range(start, end):
+                tf = postTf[idx]
+                squares[postDocs[idx]] += (weights[tf] if tf < 256 else (1 + log(tf)) ** 2) * idf2
+        self.norms = array('f', (math.sqrt(value) or 1.0 for value in squares))
+        self.stale = False
+
+    #返回和 text 最相关的k个文档 [(余弦相似度, 文档编号)]，按相似度从高到低排序
+    def search(self, text, k=5):
+        if not self.norms:
+            return []
+        self.updateNorms()
+        log = math.log
+        scores = {}
+        qNorm = 0.0
+        for t, qtf in self.termCounts(text).items():
+            if not self.df[t]:
+                continue
+            idf = self.idf(t)
+            qWeight = (1 + log(qtf)) * idf
+            qNorm += qWeight * qWeight
+            postDocs, postTf = self.postDocs, self.postTf
+            for idx in range(self.postStart[t], self.postStart[t + 1]):
+                doc = postDocs[idx]
+                scores[doc] = scores.get(doc, 0.0) + qWeight * (1 + log(postTf[idx])) * idf
+        if not scores:
+            return []
+        qNorm = math.sqrt(qNorm)
+        norms = self.norms
+        return heapq.nlargest(k, ((score / (norms[doc] * qNorm), doc) for doc, score in scores.items()))
+
+    #文档的引用 (起始位置, 长度)
+    def ref(self, doc):
+        return self.refStart[doc], self.refLen[doc]
+
+    #保存为二进制文件：第一行为json格式的文件头，之后依次为各个数组的原始数据
+    def save(self, fileName):
+        self.updateNorms()
+        header = {'version': 2, 'dim': self.dim, 'byteorder': sys.byteorder, 'meta': self.meta,
+            'itemsizes': [array(code).itemsize for _, code in TermIndex.ARRAYS],
+            'sizes': [len(getattr(self, name)) for name, _ in TermIndex.ARRAYS]}
+        tmpFile = fileName + '.tmp'
+        with open(tmpFile, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for name, _ in TermIndex.ARRAYS:
+                getattr(self, name).tofile(f)
+        os.replace(tmpFile, fileName)
+
+    #从文件加载索引，文件不存在或者格式不兼容返回None
+    @classmethod
+    def load(cls, fileName):
+        try:
+            with open(fileName, 'rb') as f:
+                header = json.loads(f.readline())
+                if (header.get('version') != 2 or header.get('byteorder') != sys.byteorder or
+                    header.get('itemsizes') != [array(code).itemsize for _, code in cls.ARRAYS]):
+                    return None
+                index = cls(0)
+                index.dim = header['dim']
+                for (name, code), size in zip(cls.ARRAYS, header['sizes']):
+                    arr = array(code)
+                    arr.fromfile(f, size)
+                    setattr(index, name, arr)
+                index.meta = header.get('meta') or {}
+                return index
+        except Exception:
+            return None
+
+#推迟处理 Ctrl-C，with 块中收到的中断在退出时才抛出 KeyboardInterrupt，保证块中的修改完整
+#只能在主线程使用，其他线程中不做任何处理
+class DeferInterrupt:
+    def __enter__(self):
+        self.received = False
+        self.oldHandler = None
+        if threading.current_thread() is threading.main_thread():
+            self.oldHandler = signal.signal(signal.SIGINT, self.handler)
+        return self
+
+    def handler(self, signum, frame):
+        self.received = True
+
+    def __exit__(self, excType, excValue, tb):
+        if self.oldHandler is not None:
+            signal.signal(signal.SIGINT, self.oldHandler)
+        if self.received and excType is None:
+            raise KeyboardInterrupt
+
+#Kindle文档(txt/html)的分块检索索引，按固定大小的块流式读取文件，不需要一次读入整个文件
+#索引保存到文件，记录已经处理到的位置，建立索引的过程被中断后可以继续，之后的会话直接使用
+#文件大小或修改时间变化后重新建立索引
+class DocumentIndex:
+    CHUNK = 2048 #每块的字节数
+    EXTS = ('.txt', '.md', '.html', '.htm', '.xhtml')
+    def __init__(self, fileName, indexDir):
+        self.fileName = fileName
+        self.name = os.path.basename(fileName)
+        self.isHtml = fileName.lower().endswith(('.html', '.htm', '.xhtml'))
+        self.indexFile = os.path.join(indexDir, '{:08x}.bin'.format(zlib.crc32(fileName.encode('utf-8'))))
+        stat = os.stat(fileName)
+        self.size = stat.st_size
+        sign = [stat.st_size, int(stat.st_mtime)]
+        self.index = TermIndex.load(self.indexFile)
+        if not self.index or self.index.meta.get('file') != fileName or self.index.meta.get('sign') != sign:
+            self.index = TermIndex()
+            self.index.meta = {'file': fileName, 'sign': sign, 'offset': 0}
+
+    @property
+    def progress(self):
+        return min(1.0, self.index.meta['offset'] / self.size) if self.size else 1.0
+
+    @property
+    def done(self):
+        return self.index.meta['offset'] >= self.size
+
+    #从 offset 开始逐块读取，返回 (起始位置, 数据) 的生成器
+    #块的结尾尽量落在换行或空白处(html为标签结束处)，找不到时也不会截断UTF-8字符
+    def iterChunks(self, offset):
+        with open(self.fileName, 'rb') as f:
+            f.seek(offset)
+            while data := f.read(self.CHUNK):
+                if len(data) == self.CHUNK:
+                    half = self.CHUNK // 2
+                    cut = data.rfind(b'>', half) if self.isHtml else -1
+                    if cut < 0:
+                        cut = max(data.rfind(b'\n', half), data.rfind(b' ', half))
+                    if cut >= 0:
+                        data = data[:cut + 1]
+                    else:
+                        while data and (data[-1] & 0xC0) == 0x80: #去掉不完整的多字节字符
+                            data = data[:-1]
+                        if data and data[-1] >= 0xC0:
+                            data = data[:-1]
+                        if not data: #不是UTF-8文本，按原样切分
+                            f.seek(offset)
+                            data = f.read(self.CHUNK)
+                yield offset, data
+                offset += len(data)
+                f.seek(offset)
+
+    #块的文本内容，html去掉标签
+    def chunkText(self, data):
+        text = data.decode('utf-8', errors='ignore')
+        if self.isHtml:
+            text = html.unescape(re.sub(r'<[^>]*>', ' ', text))
+        return ' '.join(text.split())
+
+    #建立或继续建立索引，每256块保存一次，progress(比例)用于显示进度
+    #被 Ctrl-C 中断时保存已经完成的部分，然后重新抛出异常，正在添加的块完成后才响应中断
+    def build(self, progress=None):
+        index = self.index
+        count = 0
+        try:
+            for start, data in self.iterChunks(index.meta['offset']):
+                with DeferInterrupt():
+                    index.add(self.chunkText(data), start, len(data))
+                    index.meta['offset'] = start + len(data)
+                count += 1
+                if count % 256 == 0:
+                    self.save()
+                    if progress:
+                        progress(self.progress)
+        finally:
+            if count:
+                self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.indexFile), exist_ok=True)
+        self.index.save(self.indexFile)
+
+    #检索和问题相关的块，返回文本列表，按在文档中的顺序排列，数量不超过k，总长度不超过budget
+    def search(self, question, k=4, budget=4000):
+        found = []
+        used = 0
+        with open(self.fileName, 'rb') as f:
+            for _, doc in self.index.search(question, k):
+                start, length = self.index.ref(doc)
+                f.seek(start)
+                text = self.chunkText(f.read(length))
+                if found and used + len(text) > budget:
+                    break
+                found.append((start, text))
+                used += len(text)
+        return [text for _, text in sorted(found)]
+
+#常驻的热点函数计时，统计调用次数、总耗时和最大耗时，每次调用的开销只有两次 perf_counter
+class HotTimers:
+    def __init__(self):
+        self.items = {} #{name: [count, total, max]}，时间单位为秒
+        self.lock = threading.Lock()
+
+    def add(self, name, elapsed):
+        with self.lock:
+            item = self.items.setdefault(name, [0, 0.0, 0.0])
+            item[0] += 1
+            item[1] += elapsed
+            item[2] = max(item[2], elapsed)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: tuple(item) for name, item in self.items.items()}
+
+hotTimers = HotTimers()
+
+#装饰器，将函数的耗时记录到 hotTimers
+def hotPath(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hotTimers.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+#按阶段统计内存分配(--trace-alloc)，没有启用时只是直接调用被装饰的函数
+#进入阶段时清空tracemalloc的记录，退出时得到这个阶段的分配峰值和仍然保留的内存
+#阶段嵌套时只统计最外层
+class AllocTracer:
+    def __init__(self):
+        self.enabled = False
+        self.active = False
+        self.records = [] #[(phase, retained, peak, seconds)]
+
+    def start(self):
+        import tracemalloc
+        tracemalloc.start()
+        self.enabled = True
+
+    #装饰器，被装饰函数的每次调用记录为一个阶段
+    def phase(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or self.active:
+                    return func(*args, **kwargs)
+                import tracemalloc
+                self.active = True
+                tracemalloc.clear_traces()
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    current, peak = tracemalloc.get_traced_memory()
+                    self.records.append((name, current, peak, time.perf_counter() - start))
+                    self.active = False
+            return wrapper
+        return decorator
+
+    def report(self):
+        print('')
+        sprint(' Memory by phase ', fg='white', bg='yellow', bold=True)
+        if not self.records:
+            sprint('No phase recorded yet', fg='bright_black')
+            return
+        fmt = '{:<16} {:>12} {:>12} {:>9}'
+        print(fmt.format('phase', 'retained KB', 'peak KB', 'seconds'))
+        for name, current, peak, seconds in self.records:
+            print(fmt.format(name, f'{current / 1024:.1f}', f'{peak / 1024:.1f}', f'{seconds:.2f}'))
+
+allocTracer = AllocTracer()
+
+#在cProfile下运行func，结束时保存 .prof 文件和按累计耗时排序的文本报告
+#cProfile只统计主线程，网络请求在工作线程中执行，主线程的等待时间显示在 waitForRequest
+def runProfiled(func, profFile):
+    import cProfile, pstats
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(func)
+    finally:
+        reportFile = os.path.splitext(profFile)[0] + '.txt'
+        try:
+            prof.dump_stats(profFile)
+            with open(reportFile, 'w', encoding='utf-8') as f:
+                pstats.Stats(prof, stream=f).sort_stats('cumulative').print_stats(60)
+            print('Profile saved to {}, report saved to {}'.format(style(profFile, bold=True),
+                style(reportFile, bold=True)))
+        except Exception as e:
+            print(f'Failed to save the profile: {e}')
+
 #主类
 class InkWell:
+    @allocTracer.phase('startup')
     def __init__(self, cfgFile):
         self.cfgFile = cfgFile or CONFIG_JSON
         self.currTopic = ''
         self.prompts = {}
         self.currPrompt = ''
         self.history = []
-        self.messages = [{"role": "system", "content": ''}] #role: system, user, assistant
+        self.messages = [Message('system', '')] #role: system, user, assistant
+        self.client = None
+        self.utilityClient = None #处理辅助任务(生成标题等)的客户端，为None则使用主客户端
+        self.tierStats = {tier: {'requests': 0, 'errors': 0, 'ms': 0.0} for tier in ('main', 'utility')}
+        self.compareSpecs = [] #不为空则每个问题同时发给这些model比较
+        self.typeAhead = [] #等待AI回答期间用户已经输入的行
+        self.housekeeping = [] #排队等待集中发送的辅助任务
+        self.netProbe = None #后台检测网络是否可用
+        self.replayPage = 0 #回放历史对话时当前显示的页，0为最后一页
+        self.clipSaving = 0 #读书摘要去重后少发送的字符数
+        self.clipIndex = None #全部读书摘要的检索索引，第一次检索时加载
+        self.document = None #/doc 打开的文档索引 DocumentIndex
+        self.daemonSession = False #是否正在运行常驻进程的终端会话，标准输入为 inkwell_attach.py 的socket
+        self.modelCatalog = ModelCatalog(os.path.join(os.path.dirname(self.cfgFile), MODELS_JSON))
+        self.modelCatalog.merge() #使用缓存的上下文长度和速率限制，需要在加载配置前合并，缓存中的model才能通过校验
         self.config = self.loadConfig()
+        self.modelCatalog.ttl = (self.config or {}).get('model_cache_hours', 24) * 3600
+        renderFile = os.path.join(os.path.dirname(self.cfgFile), RENDER_CACHE_JSON)
+        self.renderCache = RenderCache(renderFile if (self.config or {}).get('render_cache') else None)
+        self.archive = ConversationArchive(os.path.dirname(self.cfgFile))
+        self.usageLedger = UsageLedger(os.path.join(os.path.dirname(self.cfgFile), USAGE_JSON))
+        self.memory = ConversationMemory(self.archive, os.path.join(os.path.dirname(self.cfgFile), MEMORY_INDEX_FILE))
+        self.catalogRefreshing = False
         
     #获取配置数据，这个函数返回的配置字典是经过校验的，里面的数据都是合法的
     def loadConfig(self):
@@ -173,10 +1414,20 @@ class InkWell:
         if provider not in AI_LIST:
             provider = 'google'
             cfg['provider'] = provider
-        models = [item['name'] for item in AI_LIST[provider]['models']]
+        models = [item['name'] for item in providerModels(provider)] #包括model目录缓存中的model
         model = cfg.get('model')
         if model not in models:
             cfg['model'] = models[0]
+        #多个服务商配置组成的故障切换链，每项可以包含 provider/model/api_key/api_host/chat_type/compress_hosts
+        profiles = []
+        for item in (cfg.get('profiles') or []):
+            if not isinstance(item, dict) or str(item.get('provider', '')).lower() not in AI_LIST:
+                print(f'Ignored invalid profile: {item}')
+                continue
+            item['provider'] = item['provider'].lower()
+            item.setdefault('model', AI_LIST[item['provider']]['models'][0]['name'])
+            profiles.append(item)
+        cfg['profiles'] = profiles
         if cfg.get("token_limit", 4000) < 1000:
             cfg['token_limit'] = 1000
         displayStyle = cfg.get('display_style')
@@ -214,6 +1465,7 @@ class InkWell:
         return self.prompts
 
     #加载历史对话信息，返回历史列表
+    @hotPath('loadHistory')
     def loadHistory(self):
         if self.config.get('max_history', 10) <= 0: #禁用了历史对话功能
             return []
@@ -223,29 +1475,42 @@ class InkWell:
         history = []
         if os.path.isfile(hisFile):
             try:
-                with open(hisFile, 'r', encoding='utf-8') as f:
-                    history = json.load(f)
-                if not isinstance(history, list):
-                    history = []
+                history = loadConversations(hisFile, self.config.get('pack_history', True))
             except:
                 pass
         return history
 
+    #压缩不活动的历史会话，当前会话(如果已经在历史列表中)除外
+    def packInactiveHistory(self):
+        if not self.config.get('pack_history', True):
+            return
+        for conv in self.history:
+            if not conv.packed and not (conv.topic == self.currTopic and conv.messages
+                and self.messages[1:2] == conv.messages[:1]):
+                conv.pack()
+
     #将当前会话添加到历史对话列表
     def addCurrentConvToHistory(self):
         maxHisotry = self.config.get('max_history', 10)
         if maxHisotry <= 0 or not self.currTopic or self.currTopic == DEFAULT_TOPIC:
             return
 
-        if self.history and self.history[-1]['topic'] == self.currTopic:
-            self.history[-1]['messages'] = self.messages[1:] #第一条消息固定为背景prompt
+        if self.history and self.history[-1].topic == self.currTopic:
+            self.history[-1].messages = self.messages[1:] #第一条消息固定为背景prompt
         else:
-            self.history.append({'topic': self.currTopic, 'prompt': self.currPrompt, 'messages': self.messages[1:]})
+            self.history.append(Conversation(self.currTopic, self.currPrompt, self.messages[1:]))
         if len(self.history) > maxHisotry:
+            if self.config.get('archive_history', True): #超出的会话移动到归档文件
+                try:
+                    self.archive.append(self.history[:-maxHisotry])
+                except Exception as e:
+                    print(f'Failed to archive conversations: {e}')
             self.history = self.history[-maxHisotry:]
         self.saveHistory()
+        self.packInactiveHistory()
 
     #保存历史对话信息到文件
+    @hotPath('saveHistory')
     def saveHistory(self):
         if self.config.get('max_history', 10) <= 0:
             return
@@ -254,10 +1519,13 @@ class InkWell:
         hisFile = os.path.join(hisPath, HISTORY_JSON)
         try:
             os.makedirs(hisPath, exist_ok=True)
-            with open(hisFile, 'w', encoding='utf-8') as f:
-                json.dump(self.history, f, ensure_ascii=False, indent=2)
+            with open(hisFile, 'w', encoding='utf-8') as f: #和 json.dump(indent=2) 的格式相同
+                f.write('[\n' + ',\n'.join(re.sub(r'^', '  ', conv.toJson(), flags=re.MULTILINE)
+                    for conv in self.history) + '\n]' if self.history else '[]')
         except Exception as e:
             print('Failed to save history file {}: {}'.format(style(hisFile, bold=True), str(e)))
+        self.renderCache.save()
+        self.usageLedger.save()
 
     #根据下标列表，删除某些历史信息
     def deleteHistory(self, indexList):
@@ -270,9 +1538,10 @@ class InkWell:
     #导出某些历史信息到电子书
     #如果expName为电子邮件地址，则发送邮件，否则保存到文件
     #indexList: 需要导出的历史索引号列表
+    @allocTracer.phase('export')
     def exportHistory(self, expName, indexList):
         # 0 为导出当前会话
-        history = [self.history[index - 1] if index else {'topic': self.currTopic, 'messages': self.messages[1:]}
+        history = [self.history[index - 1] if index else Conversation(self.currTopic, self.currPrompt, self.messages[1:])
             for index in indexList if index <= len(self.history)]
 
         if not history:
@@ -462,6 +1731,7 @@ class InkWell:
         return ret
 
     #显示菜单项
+    @outputFrame
     def showMenu(self):
         print('')
         sprint(' Current prompt ', fg='white', bg='yellow', bold=True)
@@ -476,17 +1746,73 @@ class InkWell:
         else:
             for idx, item in enumerate(self.history, 1):
                 sprint('{:2d}. {}'.format(idx, item.get('topic', 'Unknown topic'), fg='bright_black'))
+        if archived := len(self.archive.entries()):
+            sprint(f'{archived} archived conversations, enter a to browse', fg='bright_black')
         print('')
 
+    #分页显示归档的会话，输入关键词过滤标题，列表只使用归档索引
+    #返回 'switched' 表示已经切换到选择的会话
+    def browseArchive(self):
+        perPage = 10
+        page = 0
+        keyword = ''
+        while True:
+            items = [e for e in reversed(self.archive.entries()) if keyword in e['topic'].lower()] #最近归档的在前面
+            pageNum = max(1, (len(items) + perPage - 1) // perPage)
+            page = min(page, pageNum - 1)
+            print('')
+            title = f' Archived conversations {page + 1}/{pageNum} '
+            sprint(title + (f'[{keyword}] ' if keyword else ''), fg='white', bg='yellow', bold=True)
+            if not items:
+                sprint('No archived conversations found!', fg='bright_black')
+            for idx, item in enumerate(items[page * perPage:(page + 1) * perPage], page * perPage + 1):
+                print('{:3d}. {} {}'.format(idx, item['topic'], style('({}, {} messages)'.format(
+                    time.strftime('%Y-%m-%d', time.localtime(item['time'])), item['count']), fg='bright_black')))
+            print('')
+            input_ = input('[num, n, p, /keyword, q] » ').strip()
+            if input_ in ('q', 'Q'):
+                return ''
+            elif input_ in ('', 'n'): #下一页
+                page = page + 1 if page + 1 < pageNum else 0
+            elif input_ == 'p':
+                page = max(0, page - 1)
+            elif input_.startswith('/'): #过滤标题，只输入 / 清除过滤
+                keyword = input_[1:].strip().lower()
+                page = 0
+            elif 1 <= (index := str_to_int(input_)) <= len(items):
+                entry = items[index - 1]
+                try:
+                    conv = self.archive.read(entry)
+                except Exception as e:
+                    print(f'Failed to read the archive: {e}')
+                    continue
+                self.switchConversation(conv)
+                #作为新的一项加入历史列表，不能和标题相同的最后一项合并，先保存到历史文件，再从归档中删除
+                self.history.append(Conversation(self.currTopic, self.currPrompt, self.messages[1:]))
+                self.addCurrentConvToHistory()
+                self.archive.remove(entry)
+                return 'switched'
+
     #显示菜单，根据用户选择进行相应的处理
     def processMenu(self):
         self.showMenu()
         while True:
-            input_ = input('[num, c, d, e, m, n, p, q, ?] » ').lower()
+            input_ = input('[num, a, c, d, e, m, n, p, s, t, u, q, ?] » ').lower()
             if input_ == 'q': #退出
                 return 'quit'
             elif input_ == '?': #显示命令帮助
                 self.showCmdList()
+            elif input_ in ('s', '/stats'): #显示网络请求的延时统计
+                self.showStats()
+            elif input_ in ('u', '/usage'): #显示token用量
+                self.showUsage()
+            elif input_ in ('t', '/timers'): #显示热点函数耗时
+                self.showTimers()
+            elif input_ == 'a': #浏览归档的会话
+                if self.browseArchive() == 'switched':
+                    self.replayConversation()
+                    break
+                self.showMenu()
             elif input_ == 'm': #切换model
                 self.switchModel()
                 self.showMenu()
@@ -529,20 +1855,22 @@ class InkWell:
         elif promptText == self.config.get('custom_prompt'):
             self.currPrompt = 'custom'
         self.messages[0]['content'] = promptText
+        self.packInactiveHistory()
     
     #切换到其他会话
-    #msg: 目的消息字典
-    def switchConversation(self, msg):
+    #conv: 目的会话 Conversation 实例
+    def switchConversation(self, conv):
         self.addCurrentConvToHistory()
-        self.messages = self.messages[:1] + msg.get('messages', [])
-        self.currTopic = msg.get('topic', DEFAULT_TOPIC)
-        self.currPrompt = msg.get('prompt', 'default')
+        self.messages = self.messages[:1] + conv.messages
+        self.currTopic = conv.topic
+        self.currPrompt = conv.prompt
         promptText = self.getPromptText(self.currPrompt)
         if promptText == DEFAULT_PROMPT:
             self.currPrompt = 'default'
         elif promptText == self.config.get('custom_prompt'):
             self.currPrompt = 'custom'
         self.messages[0]['content'] = promptText
+        self.packInactiveHistory()
     
     #根据prompt名字，返回prompt具体文本
     def getPromptText(self, promptName):
@@ -554,34 +1882,165 @@ class InkWell:
 
         return prompt if prompt else DEFAULT_PROMPT
 
+    #返回服务商配置列表，没有配置 profiles 时，使用配置文件顶层的服务商配置
+    def getProfiles(self):
+        return self.config.get('profiles') or [self.config]
+
+    #根据 model 或 provider/model 查找可用的服务商配置，返回一个新的配置字典，找不到返回None
+    #只写model则使用当前的服务商
+    def profileForModel(self, spec):
+        provider, _, model = spec.rpartition('/')
+        provider = provider.lower()
+        if provider not in AI_LIST: #有一些model名字本身包含斜杠
+            provider, model = self.client.name, spec
+        utility = self.config.get('utility_profile')
+        candidates = [self.client.profile, *self.getProfiles(), *([utility] if isinstance(utility, dict) else [])]
+        profile = next((item for item in candidates if str(item.get('provider', '')).lower() == provider
+            and item.get('api_key')), None)
+        return dict(profile, provider=provider, model=model) if profile else None
+
+    #将同一个对话同时发给多个model，每个回答到达后马上显示，然后让用户选择一个作为对话的回答
+    #specs: model列表，每项为 model 或 provider/model
+    #messages: 最后一项为用户问题的消息列表
+    #返回选中的回答文本，放弃则返回None
+    def compareModels(self, specs, messages):
+        clients = []
+        for spec in specs:
+            if profile := self.profileForModel(spec):
+                clients.append(SimpleAiProvider(profile['provider'], apiKey=profile['api_key'], model=profile['model'],
+                    apiHost=profile.get('api_host'), singleTurn=bool(profile.get('chat_type') == 'single_turn'),
+                    compressHosts=profile.get('compress_hosts')))
+                clients[-1].metrics = self.client.metrics
+            else:
+                print('No usable profile for {}'.format(style(spec, bold=True)))
+        if not clients:
+            return None
+
+        trimmed = self.getTrimmedChat(messages)
+        token = CancelToken(self.config.get('request_deadline', 0) or 0)
+        results = queue.Queue()
+        arrived = threading.Event()
+        #每个线程使用独立的客户端、连接和子令牌，结果 (编号, AiResponse, 耗时) 放入队列
+        def ask(idx, client, childToken):
+            CancelToken.setCurrent(childToken)
+            start = time.perf_counter()
+            try:
+                resp = AiResponse(success=True, content=client.chat(trimmed).strip())
+            except RequestCancelled:
+                resp = AiResponse(success=False, error='Request cancelled')
+            except DeadlineExceeded as e:
+                resp = AiResponse(success=False, error=str(e))
+            except Exception:
+                resp = AiResponse(success=False, error=loc_exc_pos('Error'))
+            results.put((idx, resp, time.perf_counter() - start))
+            arrived.set()
+
+        for idx, client in enumerate(clients, 1):
+            threading.Thread(target=ask, args=(idx, client, token.child()), daemon=True).start()
+        answers = {}
+        pending = len(clients)
+        while pending and not token.cancelled: #每个回答到达后马上显示，期间按 Ctrl-C 或输入 q 回车取消剩下的请求
+            try:
+                idx, resp, elapsed = results.get_nowait()
+            except queue.Empty:
+                self.waitForRequest(arrived, token)
+                arrived.clear()
+                continue
+            pending -= 1
+            client = clients[idx - 1]
+            usage = client.lastUsage
+            tokens = '{}+{}t'.format(usage.get('prompt', 0), usage.get('completion', 0)) if usage else ''
+            if resp.success:
+                self.usageLedger.record(client.name, client.keyTag, client.model, usage)
+            resp.timing = ' '.join(e for e in (f'{idx}.{client.model}', f'{elapsed:.1f}s',
+                f'{len(resp.content)}c' if resp.success else '', tokens) if e)
+            if resp.success:
+                answers[idx] = resp
+                self.printAiResponse(resp)
+            else:
+                self.printChatBubble('assistant', resp.timing)
+                print(resp.error)
+        if token.cancelled and pending:
+            print(f'Request timed out after {token.timeout}s' if token.timedOut else 'Request cancelled')
+        for client in clients: #被取消的线程会因为连接关闭而马上结束
+            client.close()
+
+        if not answers:
+            return None
+        print('')
+        while True:
+            input_ = input('[num to adopt, q to discard] » ')
+            if input_ in ('q', 'Q'):
+                return None
+            elif (index := str_to_int(input_)) in answers:
+                return answers[index].content
+
     #显示菜单，切换当前服务提供商的其他model
+    #可用model列表优先使用model目录缓存，马上显示，缓存过期则在后台更新，输入空行重新显示
     def switchModel(self):
-        provider = self.config.get('provider')
-        model = self.config.get('model')
+        provider = self.client.name
         if provider not in AI_LIST:
             print('Current provider is invalid')
             return
 
-        models = [item['name'] for item in AI_LIST[provider]['models']]
-        print('')
-        sprint(' Current model ', fg='white', bg='yellow', bold=True)
-        print(f'{provider}/{model}')
-        print('')
-        sprint(' Available models [add ! to persist] ', fg='white', bg='yellow', bold=True)
-        print('\n'.join(f'{idx:2d}. {item}' for idx, item in enumerate(models, 1)))
-        print('')
+        def _show():
+            cached = [item['name'] for item in self.modelCatalog.get(provider)]
+            models = cached if self.modelCatalog.age(provider) is not None and cached else self.client.models()
+            if self.client.model not in models:
+                models = [self.client.model] + models
+            age = self.modelCatalog.age(provider)
+            info = 'built-in' if age is None else f'updated {age / 3600:.0f}h ago'
+            if self.catalogRefreshing:
+                info += ', refreshing, enter to reload'
+            print('')
+            sprint(' Current model ', fg='white', bg='yellow', bold=True)
+            print(f'{provider}/{self.client.model}')
+            print('')
+            sprint(f' Available models ({info}) [add ! to persist] ', fg='white', bg='yellow', bold=True)
+            print('\n'.join(f'{idx:2d}. {item}' for idx, item in enumerate(models, 1)))
+            print('')
+            return models
+
+        if self.modelCatalog.isStale(provider):
+            self.refreshModelCatalog()
+        models = _show()
         while True:
             if (input_ := input('» ')) == 'q':
                 return
+            elif not input_:
+                models = _show()
+                continue
             needSave = input_.endswith('!')
             input_ = input_.rstrip('!')
             if 1 <= (index := str_to_int(input_)) <= len(models):
                 self.client.model = models[index - 1]
-                self.config['model'] = self.client.model
+                self.client.profile['model'] = self.client.model
                 if needSave:
                     self.saveConfig(self.config)
                 break
 
+    #在后台从服务商获取当前服务商的model列表，保存到model目录缓存
+    #使用单独的客户端，不影响正在使用的长连接
+    def refreshModelCatalog(self):
+        if self.catalogRefreshing:
+            return
+        profile = self.client.profile
+        def _refresh():
+            client = None
+            try:
+                client = SimpleAiProvider(profile.get('provider', ''), apiKey=profile.get('api_key', ''),
+                    model=profile.get('model'), apiHost=profile.get('api_host'))
+                self.modelCatalog.update(client.name, client.modelInfos())
+                self.client.current.updateModelInfo()
+            except Exception:
+                pass
+            finally:
+                self.catalogRefreshing = False
+                if client:
+                    client.close()
+        self.catalogRefreshing = True
+        threading.Thread(target=_refresh, daemon=True).start()
+
     #显示菜单，选择一个会话使用的prompt
     def switchPrompt(self):
         self.loadPrompts()
@@ -634,26 +2093,130 @@ class InkWell:
                     sprint(f'Prompt set to: {self.currPrompt}', bold=True)
                 break
 
-    #读取高亮或读书笔记，返回最新的前10条记录
+    #读取高亮或读书笔记，返回最新的前10条记录 [(书名, 笔记内容)]
+    #启用 clip_dedup 时合并近似重复的摘要，结果按文件大小和修改时间缓存，文件没有变化时不需要重新读取
+    @allocTracer.phase('clippings')
     def readClippings(self):
         if not os.path.isfile(CLIPPINGS_FILE):
             print('The file {} does not exist.'.format(style(CLIPPINGS_FILE, bold=True)))
             return []
 
+        dedup = self.config.get('clip_dedup', True)
+        cacheFile = os.path.join(os.path.dirname(self.cfgFile), CLIPS_CACHE_JSON)
         try:
-            with open(CLIPPINGS_FILE, 'r', encoding='utf-8') as f:
-                clips = f.read().split('==========')
+            stat = os.stat(CLIPPINGS_FILE)
+            #开头为合并规则的版本，规则修改后旧的缓存失效
+            key = f'2|{CLIPPINGS_FILE}|{stat.st_size}|{stat.st_mtime_ns}|{int(dedup)}'
         except Exception as e:
             print(f'Read clippings failed: {str(e)}')
             return []
+        try:
+            with open(cacheFile, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache.get('key') == key:
+                self.clipSaving = cache.get('saved_chars', 0)
+                return [tuple(item) for item in cache['clips']]
+        except Exception:
+            pass
+
+        try: #新的摘要追加在文件末尾，只需要读取最后一部分
+            with open(CLIPPINGS_FILE, 'rb') as f:
+                f.seek(max(0, stat.st_size - 512 * 1024))
+                clips = f.read().decode('utf-8', errors='ignore').replace('\r\n', '\n').split('==========')
+            if stat.st_size > 512 * 1024: #第一个摘要可能不完整
+                clips = clips[1:]
+        except Exception as e:
+            print(f'Read clippings failed: {str(e)}')
+            return []
+
+        #去重时使用最近200个摘要作为比较窗口
+        entries = [e for e in map(parseClipping, clips[-200:] if dedup else clips[-10:]) if e]
+
+        self.clipSaving = 0
+        if dedup:
+            keptIdx = collapseClippings(entries)[-10:]
+            keptSet = set(keptIdx)
+            #不去重时列表中显示的最新10条里面被合并掉的部分
+            self.clipSaving = sum(len(entries[idx][2]) for idx in range(max(0, len(entries) - 10), len(entries))
+                if idx not in keptSet)
+            entries = [entries[idx] for idx in keptIdx]
+        ret = [(book, text) for book, _, text in entries]
+        try:
+            with open(cacheFile, 'w', encoding='utf-8') as f:
+                json.dump({'key': key, 'clips': ret, 'saved_chars': self.clipSaving}, f, ensure_ascii=False)
+        except Exception:
+            pass
+        return ret
+
+    #加载全部读书摘要的检索索引，My Clippings.txt 有新增的摘要时增量更新
+    #文件开头的内容变化(被改写而不是追加)则重新建立索引
+    def updateClipIndex(self):
+        idxFile = os.path.join(os.path.dirname(self.cfgFile), CLIPS_INDEX_FILE)
+        index = self.clipIndex or TermIndex.load(idxFile)
+        try:
+            size = os.path.getsize(CLIPPINGS_FILE)
+            with open(CLIPPINGS_FILE, 'rb') as f:
+                head = f.read(4096)
+        except Exception as e:
+            print(f'Read clippings failed: {str(e)}')
+            return None
+
+        meta = index.meta if index else {}
+        headLen = meta.get('headLen', 0)
+        if (not index or meta.get('file') != CLIPPINGS_FILE or meta.get('offset', 0) > size or
+            meta.get('head') != zlib.crc32(head[:headLen])):
+            index = TermIndex()
+            index.meta = {'file': CLIPPINGS_FILE, 'offset': 0, 'headLen': 0, 'head': zlib.crc32(b'')}
+        if index.meta['offset'] < size:
+            if not len(index):
+                sprint('Indexing all clippings, it may take a while for the first time', fg='bright_black')
+            added = 0
+            try:
+                for start, end, book, _, text in iterClippings(CLIPPINGS_FILE, index.meta['offset']):
+                    with DeferInterrupt(): #中断时不能只添加了一半
+                        index.add(f'{book}\n{text}', start, end - start)
+                        index.meta['offset'] = end
+                    added += 1
+                    if added % 5000 == 0: #定期保存，建立索引的过程被中断后下次可以继续
+                        self.saveClipIndex(index, idxFile, head)
+            finally:
+                if added:
+                    self.saveClipIndex(index, idxFile, head)
+        self.clipIndex = index
+        return index
+
+    #保存读书摘要索引，同时记录文件开头的校验值，用于判断文件是否被改写
+    def saveClipIndex(self, index, idxFile, head):
+        headLen = min(4096, index.meta['offset'])
+        index.meta.update({'headLen': headLen, 'head': zlib.crc32(head[:headLen])})
+        try:
+            index.save(idxFile)
+        except Exception as e:
+            print(f'Failed to save the clippings index: {e}')
 
+    #在全部读书摘要中检索和问题最相关的摘要，返回 [(书名, 摘要内容)]
+    #数量不超过 clip_top_k，总长度不超过token限制的一半，重复的摘要只保留一条
+    def searchClippings(self, question):
+        if not (index := self.updateClipIndex()):
+            return []
+        topK = max(1, self.config.get('clip_top_k', 8))
+        budget = self.charLimit() // 2
         ret = []
-        for item in clips[-10:]: #只显示最新的9个摘要，因为最后一个为空
-            #每个笔记第一行是书名；第二行使用横杠开头，竖杠分割：笔记类型/页数/位置/时间；之后为具体摘要内容
-            lines = item.strip().split('\n', 2)
-            if len(lines) < 3:
-                continue
-            ret.append((lines[0], lines[-1].strip())) #书名，笔记内容
+        used = 0
+        with open(CLIPPINGS_FILE, 'rb') as f:
+            for _, doc in index.search(question, topK * 2):
+                start, length = index.ref(doc)
+                f.seek(start)
+                item = f.read(length).decode('utf-8', errors='ignore').replace('\r\n', '\n')
+                item = parseClipping(item.split('==========')[0])
+                if not item or any(item[2] in text or text in item[2] for _, text in ret):
+                    continue
+                if ret and used + len(item[2]) > budget:
+                    break
+                ret.append((item[0], item[2]))
+                used += len(item[2])
+                if len(ret) >= topK:
+                    break
         return ret
 
     #分享一个高亮读书片段给AI，让AI总结和答疑
@@ -663,42 +2226,54 @@ class InkWell:
             sprint('There is no clippings now', bold=True)
             return
 
-        print('')
-        sprint(' The latest clippings ', fg='white', bg='yellow', bold=True)
-        toDisplay = []
-        for idx, item in enumerate(myClips, 1):
-            frag = (item[1][:35] + '...') if len(item[1]) > 35 else item[1]
-            toDisplay.append(f'{idx:2d}. {item[0][:30]}\n    {{}}'.format(style(frag, fg='bright_black')))
-        print('\n'.join(toDisplay))
-        print('')
+        with termWriter:
+            print('')
+            sprint(' The latest clippings ', fg='white', bg='yellow', bold=True)
+            if self.clipSaving:
+                ratio = self.usageLedger.charsPerToken(self.client.name if self.client else '')
+                sprint('Near-duplicates collapsed, about {} tokens saved'.format(int(self.clipSaving / ratio)),
+                    fg='bright_black')
+            toDisplay = []
+            for idx, item in enumerate(myClips, 1):
+                frag = (item[1][:35] + '...') if len(item[1]) > 35 else item[1]
+                toDisplay.append(f'{idx:2d}. {item[0][:30]}\n    {{}}'.format(style(frag, fg='bright_black')))
+            print('\n'.join(toDisplay))
+            print('')
         while True:
-            if (input_ := input('[q, num or range] » ')) == 'q':
+            if (input_ := input('[q, num or range, or a question] » ')) == 'q':
                 return 'quit'
-            if not (nums := self.parseRange(input_)):
-                continue
-            #提取需要的笔记
-            clips = [myClips[idx] for idx in range(len(myClips)) if (idx + 1) in nums]
-            if not clips:
+            if nums := self.parseRange(input_):
+                #提取需要的笔记
+                clips = [myClips[idx] for idx in range(len(myClips)) if (idx + 1) in nums]
+                if not clips:
+                    continue
+                questMsg = []
+                while (quest := input('Question » ')) not in ('', 'q', 'Q'):
+                    questMsg.append(quest)
+                if quest in ('q', 'Q'):
+                    return 'quit'
+                question = '\nQuestion:\n{}'.format('\n'.join(questMsg)) if questMsg else ''
+            elif re.search(r'[^\W\d_]', input_): #输入的是问题，在全部读书摘要中检索相关的摘要
+                if not (clips := self.searchClippings(input_)):
+                    sprint('No related clippings found', bold=True)
+                    continue
+                question = f'\nQuestion:\n{input_}'
+            else:
                 continue
-            questMsg = []
-            while (quest := input('Question » ')) not in ('', 'q', 'Q'):
-                questMsg.append(quest)
-            if quest in ('q', 'Q'):
-                return 'quit'
-            question = '\nQuestion:\n{}'.format('\n'.join(questMsg)) if questMsg else ''
 
             self.startNewConversation()
             msg = CLIPS_PROMPT.format(clips='\n'.join([f'- {e[0]}\n{e[1]}' for e in clips]), question=question)
-            self.messages.append({"role": 'user', "content": msg})
+            self.messages.append(Message('user', msg))
             self.printUserMessage(msg)
-            resp = self.fetchAiResponse(self.messages)
+            resp = self.fetchWhenOnline(self.messages)
             respText = resp.content.strip() if resp.success else ('Error: ' + resp.error)
-            self.messages.append({"role": 'assistant', "content": respText})
+            self.messages.append(Message('assistant', respText))
             self.printAiResponse(resp)
             self.printChatBubble('user', self.currTopic) #准备下一轮对话
             break
 
     #显示命令列表和帮助
+    @outputFrame
     def showCmdList(self):
         print('')
         sprint(' Commands ', fg='white', bg='yellow', bold=True)
@@ -709,26 +2284,158 @@ class InkWell:
         print('{}: Switch to another model'.format(style('   m', bold=True)))
         print('{}: Start a new conversation'.format(style('   n', bold=True)))
         print('{}: Choose another prompt'.format(style('   p', bold=True)))
+        print('{}: Show request latency statistics'.format(style('   s', bold=True)))
+        print('{}: Show hot path timers'.format(style('   t', bold=True)))
+        print('{}: Show token usage'.format(style('   u', bold=True)))
+        print('{}: Browse archived conversations'.format(style('   a', bold=True)))
         print('{}: Quit the program'.format(style('   q', bold=True)))
         print('{}: Show the command list'.format(style('   ?', bold=True)))
 
+    #显示网络请求的延时统计，按host和model分组
+    @outputFrame
+    def showStats(self):
+        metrics = self.client.metrics
+        print('')
+        if not metrics.records:
+            sprint('No requests have been sent yet', fg='bright_black')
+            return
+        for title, key in ((' Latency by host ', 'host'), (' Latency by model ', 'model')):
+            sprint(title, fg='white', bg='yellow', bold=True)
+            print('{:<24} {:>4} {:>4} {:>7} {:>7} {:>7}'.format('', 'req', 'err', 'ttfb50', 'p50', 'p95'))
+            for name, item in metrics.summary(key).items():
+                print('{:<24} {:>4} {:>4} {:>7} {:>7} {:>7}'.format(name[:24], item['count'], item['errors'],
+                    *(f'{item[k] / 1000:.2f}s' for k in ('ttfb_p50', 'p50', 'p95'))))
+            print('')
+        sprint(' Requests by tier ', fg='white', bg='yellow', bold=True)
+        for tier, stat in self.tierStats.items():
+            client = self.utilityClient if (tier == 'utility' and self.utilityClient) else self.client
+            avg = stat['ms'] / stat['requests'] / 1000 if stat['requests'] else 0
+            print('{:<8} {:<24} {:>4} req {:>3} err, avg {:.2f}s'.format(tier, repr(client)[:24], stat['requests'],
+                stat['errors'], avg))
+        print('')
+        rec = metrics.last
+        sprint(' Last request ', fg='white', bg='yellow', bold=True)
+        print('{} {} key:{} status:{}'.format(rec['host'], rec['model'], rec['key'], rec['status'] or rec['error']))
+        print('connect {connect_ms:.0f}ms, tls {tls_ms:.0f}ms, ttfb {ttfb_ms:.0f}ms, total {total_ms:.0f}ms, '
+            'sent {req_bytes}B, received {resp_bytes}B'.format(**rec))
+        print('Timeouts: connect {:.1f}s, read {:.1f}s'.format(*self.client.current.timeouts(rec['host'])))
+        ratios = metrics.compressionRatios()
+        print('Compression ratio: request {:.1f}:1, response {:.1f}:1'.format(*ratios))
+
+    #显示最近几天的token用量，按天、ApiKey、model分组
+    @outputFrame
+    def showUsage(self, days=7):
+        print('')
+        records = self.usageLedger.recent(days)
+        sprint(f' Token usage of the last {days} days ', fg='white', bg='yellow', bold=True)
+        if not records:
+            sprint('No usage recorded yet', fg='bright_black')
+            return
+        fmt = '{:<10} {:<8} {:<20} {:>5} {:>9} {:>9} {:>8}'
+        print(fmt.format('day', 'key', 'model', 'req', 'prompt', 'complete', 'cached'))
+        total = [0, 0, 0, 0]
+        for day, key, model, item in records:
+            values = [item[k] for k in ('requests', 'prompt', 'completion', 'cached')]
+            total = [a + b for a, b in zip(total, values)]
+            print(fmt.format(day, key, model[:20], *values))
+        print(fmt.format('total', '', '', *total))
+        print('')
+        if self.client:
+            print('Estimated characters per token for {}: {:.2f}'.format(self.client.name,
+                self.usageLedger.charsPerToken(self.client.name)))
+
+    #显示热点函数的耗时统计，启用了 --trace-alloc 时同时显示各阶段的内存占用
+    @outputFrame
+    def showTimers(self):
+        print('')
+        sprint(' Hot path timers ', fg='white', bg='yellow', bold=True)
+        items = hotTimers.snapshot()
+        if not items:
+            sprint('No calls recorded yet', fg='bright_black')
+        else:
+            fmt = '{:<16} {:>7} {:>10} {:>9} {:>9}'
+            print(fmt.format('name', 'calls', 'total ms', 'avg ms', 'max ms'))
+            for name, (count, total, longest) in sorted(items.items()):
+                print(fmt.format(name, count, f'{total * 1000:.1f}', f'{total * 1000 / count:.2f}',
+                    f'{longest * 1000:.2f}'))
+        if allocTracer.enabled:
+            allocTracer.report()
+
+    #使用tracemalloc统计历史文件加载到内存后的占用，比较原始字典结构和紧凑结构(展开/压缩)
+    def memReport(self):
+        import tracemalloc
+        hisFile = os.path.join(os.path.dirname(self.cfgFile), HISTORY_JSON)
+        if not os.path.isfile(hisFile):
+            print('The history file {} does not exist'.format(style(hisFile, bold=True)))
+            return
+
+        def _load():
+            with open(hisFile, 'r', encoding='utf-8') as f:
+                return [item for item in json.load(f) if isinstance(item, dict)]
+        builders = (('dict (json.load)', _load), ('compact', lambda: loadConversations(hisFile, pack=False)),
+            ('compact + packed', lambda: loadConversations(hisFile, pack=True)))
+
+        raw = _load()
+        convNum, msgNum = len(raw), sum(len(item.get('messages') or []) for item in raw)
+        del raw
+        print('')
+        sprint(' Memory report ', fg='white', bg='yellow', bold=True)
+        print('{}: {} bytes, {} conversations, {} messages'.format(hisFile, os.path.getsize(hisFile),
+            convNum, msgNum))
+        print('{:<20} {:>12} {:>12} {:>7}'.format('', 'retained KB', 'peak KB', 'vs dict'))
+        base = 0
+        for name, builder in builders:
+            tracemalloc.start()
+            obj = builder()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del obj
+            base = base or current
+            print('{:<20} {:>12.1f} {:>12.1f} {:>6.0f}%'.format(name, current / 1024, peak / 1024,
+                current * 100 / base if base else 0))
+        print('')
+
     #重新输出对话信息，用于切换对话历史
-    def replayConversation(self):
-        for item in self.messages[1:]:
+    #长对话分页显示，默认只显示最后 replay_turns 轮，page为往前翻的页数
+    @outputFrame
+    def replayConversation(self, page=0):
+        msgs = self.messages[1:]
+        perPage = max(1, self.config.get('replay_turns', 10)) * 2 #一轮包括问和答两条消息
+        end = max(0, len(msgs) - page * perPage)
+        start = max(0, end - perPage)
+        self.replayPage = page
+        if start > 0:
+            sprint(f'{(start + 1) // 2} earlier turns, enter /more to show', fg='bright_black')
+        for item in msgs[start:end]:
             if item.get('role') == 'user':
                 self.printUserMessage(item.get('content'))
             else:
                 self.printAiResponse(AiResponse(success=True, content=item.get('content')))
-        
+        if page > 0:
+            sprint(f'Turns {start // 2 + 1}-{(end + 1) // 2} of {(len(msgs) + 1) // 2}', fg='bright_black')
+
         self.printChatBubble('user', self.currTopic)
 
+    #渲染需要在终端显示的AI回答，结果缓存起来，回放历史对话时不需要重新渲染
+    def renderContent(self, content):
+        disStyle = self.config.get('display_style', 'markdown')
+        if disStyle == 'plaintext':
+            return content
+        key = RenderCache.key(content, disStyle, termWidth())
+        if (ret := self.renderCache.get(key)) is None:
+            ret = self.markdownToTerm(content)
+            self.renderCache.put(key, ret)
+        return ret
+
     #打印用户输入内容
+    @outputFrame
     def printUserMessage(self, content):
         self.printChatBubble('user', self.currTopic)
         for line in (e for e in content.splitlines() if e):
             print(f'» {line}')
 
     #打印AI返回的内容
+    @outputFrame
     def printAiResponse(self, resp):
         host = resp.host
         if host.startswith('http://'):
@@ -741,11 +2448,9 @@ class InkWell:
                 break
             host = host[:pos]
 
-        self.printChatBubble('assistant', host)
+        self.printChatBubble('assistant', ' '.join(e for e in (host, resp.timing) if e))
         if resp.success:
-            disStyle = self.config.get('display_style', 'markdown')
-            content = resp.content if disStyle == 'plaintext' else self.markdownToTerm(resp.content)
-            print(content.strip())
+            print(self.renderContent(resp.content).strip())
         else:
             print(resp.error)
             sprint('Press r to resend the last chat', bold=True)
@@ -754,6 +2459,7 @@ class InkWell:
                 sprint('Press k to renew the api key', bold=True)
 
     #简单的处理markdown格式，用于在终端显示粗体斜体等效果
+    @hotPath('markdownToTerm')
     def markdownToTerm(self, content):
         #标题 (# 或 ## 等)，使用粗体
         content = re.sub(r'^(#{1,6})\s+?(.*)$', r'\033[1m\2\033[0m', content, flags=re.MULTILINE)
@@ -785,53 +2491,25 @@ class InkWell:
         return content
 
     #处理markdown文本里面的表格，排版对齐以便显示在终端上
-    #在电脑上效果还可以
-    #但在kindle实测效果不好，因为kindle屏幕太小，排版容易乱
+    #每个连续的表格行块单独排版，按显示宽度对齐，超过终端宽度的单元格自动折行
     #返回排版后的字符串
     def mdTableToTerm(self, content):
-        #假定里面只有一个表格，如果有多个表格，直接返回
-        table = [] #表格的文本内容 [[col0, col1,...],]，如果不是表格行，则是原行的字符串
-        colWidths = [] #每列文本字数 [[cnt0, cnt1,...],]，用于使用每列最大值进行对齐
-        colNums = [] #每行的列数 [num0, num1,...]，用于判断表格是否有效
-        prevTableRowIdx = -1
         lines = content.splitlines()
-        for idx, row in enumerate(lines):
-            if row.startswith('|') and row.endswith('|'):
-                #必须要连续
-                if prevTableRowIdx >= 0 and (prevTableRowIdx + 1) != idx:
-                    colNums = []
-                    break
-                prevTableRowIdx = idx
-                rowArr = [cell.strip() for cell in row.strip('|').split('|')]
-                table.append(rowArr)
-                colWidths.append([len(cell) for cell in rowArr]) #当前行每列的宽度
-                colNums.append(len(rowArr))
-            else:
-                table.append(row)
-        
-        #如果有一些列数不同，可能为多个表格，为了避免排版混乱，直接返回原结果
-        if not colNums or any(x != colNums[0] for x in colNums):
-            return content
-
-        colMaxWidths = [max(row[i] for row in colWidths) for i in range(colNums[0])] #每列的最大长度
-
-        #内嵌函数，统一左对齐
-        def format_row(row, bold):
-            return "| {} |".format(" | ".join(style(cell.ljust(width), bold=bold) 
-                            for cell, width in zip(row, colMaxWidths)))
-        
-        rowIdx = 0
-        for idx in range(len(table)):
-            row = table[idx]
-            if isinstance(row, list):
-                if all(not cell.strip('-:') for cell in row): #分割线
-                    table[idx] = '| ' + "-+-".join(('-' * width) for width in colMaxWidths) + ' |'
-                else: #内容行
-                    table[idx] = format_row(row, bold=bool(rowIdx == 0))
-                rowIdx += 1
-        return '\n'.join(table)
+        width = termWidth()
+        ret = []
+        block = []
+        for row in lines + ['']: #最后添加一个空行，用于结束最后一个表格
+            if row.startswith('|') and row.rstrip().endswith('|') and len(row.strip()) > 1:
+                block.append(row)
+                continue
+            if block:
+                ret.append(layoutMdTable('\n'.join(block), width))
+                block = []
+            ret.append(row)
+        return '\n'.join(ret[:-1])
 
     #在终端打印对话泡泡，显示角色和对话主题
+    @outputFrame
     def printChatBubble(self, role, topic=''):
         topic = f' ({topic})' if topic else ''
         if role == 'user':
@@ -840,7 +2518,7 @@ class InkWell:
             role, fg, bg, bubFg = ' AI ', 'white', 'cyan', 'bright_black'
         #不打印中间行左右的 ╞ ╡，避免不同的终端字体不同而不对齐
         txt = " {}{} ".format(style(role, fg=fg, bg=bg, bold=True), style(topic, fg=bubFg))
-        charCnt = len(role) + len(topic) + 2
+        charCnt = displayWidth(role) + displayWidth(topic) + 2
         sprint('\n╭{}╮'.format('─' * charCnt), fg=bubFg)
         print(txt)
         sprint('╰{}╯'.format('─' * charCnt), fg=bubFg)
@@ -851,26 +2529,227 @@ class InkWell:
             words = msg.replace('\n', ' ').replace('"', ' ').replace("'", ' ').split(' ')[:5]
             self.currTopic = ' '.join(words)[:30].strip() #限制总长度不超过30字节
         else: #让AI总结
-            messages = self.messages + [{"role": "user", "content": PROMPT_GET_TOPIC}]
-            resp = self.fetchAiResponse(messages)
+            messages = self.messages + [Message('user', PROMPT_GET_TOPIC)]
+            resp = self.fetchAiResponse(messages, tier='utility')
             if resp.success:
                 self.currTopic = resp.content.replace('`', '').replace('"', '').replace('\n', '')[:30]
 
     #给AI发请求，返回 AiResponse
-    def fetchAiResponse(self, messages):
+    #tier: 'main' 为给用户看的回答，使用主model；'utility' 为生成标题等辅助任务，使用 utility_profile 配置的快速model
+    #请求在工作线程中执行，等待期间按 Ctrl-C 或输入 q 回车可以取消，参见 waitForRequest()
+    def fetchAiResponse(self, messages, tier='main'):
+        client = self.utilityClient if (tier == 'utility' and self.utilityClient) else self.client
+        stat = self.tierStats[tier]
+        stat['requests'] += 1
+        start = time.perf_counter()
+        token = CancelToken(self.config.get('request_deadline', 0) or 0)
+        result = {}
+        def _worker():
+            CancelToken.setCurrent(token)
+            try:
+                if tier == 'main' and messages is self.messages and (self.config.get('memory_mode') or self.document):
+                    trimmed = self.getContextChat(messages)
+                else:
+                    trimmed = self.getTrimmedChat(messages)
+                result['content'] = client.chat(trimmed)
+                current = client.current
+                chars = sum(len(item['content']) + 20 for item in trimmed) #和 getTrimmedChat 的计算方法相同
+                self.usageLedger.record(current.name, current.keyTag, current.model, current.lastUsage, chars)
+            except RequestCancelled:
+                result['error'] = 'Request cancelled'
+            except DeadlineExceeded as e:
+                result['error'] = str(e)
+            except Exception as e:
+                result['error'] = loc_exc_pos('Error')
+                result['offline'] = isNetworkDownError(e)
+
+        worker = threading.Thread(target=_worker, daemon=True)
+        worker.start()
+        self.waitForRequest(worker, token)
+        stat['ms'] += (time.perf_counter() - start) * 1000
+        if token.cancelled and 'content' not in result:
+            stat['errors'] += 1
+            error = f'Request timed out after {token.timeout}s' if token.timedOut else 'Request cancelled'
+            return AiResponse(success=False, error=error, host=client.tag)
+        elif 'error' in result:
+            stat['errors'] += 1
+            return AiResponse(success=False, error=result['error'], host=client.tag, timing=self.getTimingTag(),
+                offline=result.get('offline', False))
+        else:
+            return AiResponse(success=True, content=result['content'], host=client.tag, timing=self.getTimingTag())
+
+    #等待工作线程完成请求，期间按 Ctrl-C 或输入 q 回车则取消请求
+    #输入的其他行保存到 self.typeAhead，作为下一条消息的开头
+    #超过令牌的截止时间1秒后工作线程仍然没有返回(比如阻塞在DNS解析)，也取消请求
+    #只在交互式输入(终端或常驻进程的会话)时检测输入，管道输入的后续行是给之后的提示符的，不能在这里读取
+    #worker: 工作线程，也可以传入一个 threading.Event，等待其被设置
+    def waitForRequest(self, worker, token):
+        import select
+        isEvent = isinstance(worker, threading.Event)
+        _running = (lambda: not worker.is_set()) if isEvent else worker.is_alive
         try:
-            respTxt = self.client.chat(self.getTrimmedChat(messages))
-        except:
-            return AiResponse(success=False, error=loc_exc_pos('Error'), host=self.client.tag)
+            watchInput = self.daemonSession or sys.stdin.isatty()
+        except (AttributeError, ValueError): #标准输入已经关闭
+            watchInput = False
+        while _running() and not token.cancelled:
+            if token.deadline and time.monotonic() > token.deadline + 1:
+                token.timedOut = True
+                token.cancel()
+                break
+            try:
+                if not watchInput:
+                    worker.wait(0.1) if isEvent else worker.join(0.1)
+                    continue
+                try:
+                    readable = select.select([sys.stdin], [], [], 0.1)[0]
+                except (OSError, ValueError): #windows 不支持对终端使用select
+                    watchInput = False
+                    continue
+                if readable:
+                    line = sys.stdin.readline()
+                    if not line: #输入已经结束
+                        watchInput = False
+                    elif line.strip() in ('q', 'Q'):
+                        token.cancel()
+                    else:
+                        self.typeAhead.append(line.rstrip('\n'))
+            except KeyboardInterrupt:
+                token.cancel()
+
+        if token.cancelled and not isEvent:
+            worker.join(1)
+            if worker.is_alive(): #仍然阻塞在连接或DNS解析中，放弃此线程，替换掉它使用的连接
+                token.recycle()
+
+    #网络不可用时先将消息保存到待发送文件，等后台检测到网络可用后马上发送，返回 AiResponse
+    #刚启动时先等待后台检测的第一个结果(最多为连接超时时间)，检测失败才保存为等待发送的消息
+    #如果请求因为网络问题失败，则等待网络恢复后自动重发一次
+    def fetchWhenOnline(self, messages):
+        pending = None
+        for attempt in range(2):
+            if not self.netProbe.online.is_set():
+                if not pending and not self.netProbe.settle(self.getTimeouts()[0]):
+                    pending = self.savePending(messages[-1]['content'])
+                    sprint('Network is not ready, the message will be sent once it is up (Ctrl-C or q to cancel)',
+                        fg='bright_black')
+                token = CancelToken() #网络可用时等待的是后台线程完成预连接
+                self.waitForRequest(self.netProbe.online, token)
+                if token.cancelled:
+                    self.dropPending(pending)
+                    return AiResponse(success=False, error='Request cancelled')
+            resp = self.fetchAiResponse(messages)
+            if not resp.offline or attempt:
+                break
+            self.netProbe.markOffline()
+        self.dropPending(pending)
+        return resp
+
+    #添加一条等待网络恢复后发送的消息，返回保存的条目
+    #和当前会话的标题一起保存，重启后切换到原先的会话继续发送
+    def savePending(self, content):
+        item = {'topic': self.currTopic, 'prompt': self.currPrompt, 'content': content, 'time': int(time.time())}
+        self.writePending(self.loadPending() + [item])
+        return item
+
+    #删除已经发送或者取消的消息，item为None则忽略
+    def dropPending(self, item):
+        if item:
+            self.writePending([e for e in self.loadPending() if e != item])
+
+    #保存所有等待发送的消息，列表为空则删除文件
+    def writePending(self, items):
+        fileName = os.path.join(os.path.dirname(self.cfgFile), PENDING_JSON)
+        try:
+            if not items:
+                if os.path.isfile(fileName):
+                    os.remove(fileName)
+            else:
+                with open(fileName, 'w', encoding='utf-8') as f:
+                    json.dump(items, f, ensure_ascii=False)
+        except Exception as e:
+            print(f'Failed to save the pending message: {e}')
+
+    #读取上次运行没有发送出去的消息，返回列表，兼容只保存一条消息的旧格式
+    def loadPending(self):
+        fileName = os.path.join(os.path.dirname(self.cfgFile), PENDING_JSON)
+        try:
+            with open(fileName, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+        except Exception:
+            return []
+        items = [items] if isinstance(items, dict) else items
+        return [e for e in items if isinstance(e, dict) and e.get('content')] if isinstance(items, list) else []
+
+    #辅助任务(比如生成会话标题)不马上发送，排队到下一次主请求之后集中发送，减少无线网络的开启时间
+    def queueHousekeeping(self, func):
+        self.housekeeping.append(func)
+
+    def flushHousekeeping(self):
+        while self.housekeeping and self.netProbe.online.is_set():
+            self.housekeeping.pop(0)()
+
+    #发送一条用户消息并显示AI的回答
+    @allocTracer.phase('chat turn')
+    def sendMessage(self, msg):
+        self.messages.append(Message('user', msg))
+        if len(self.messages) == 2: #第一次交谈，使用用户输出的开头四个单词做为topic
+            self.updateTopic(msg)
+        elif len(self.messages) == 4: #第三次交谈，使用ai总结谈话内容做为topic
+            self.queueHousekeeping(self.updateTopic)
+        if self.compareSpecs:
+            respText = (self.compareModels(self.compareSpecs, self.messages)
+                or 'Error: no answer adopted')
         else:
-            return AiResponse(success=True, content=respTxt, host=self.client.tag)
+            resp = self.fetchWhenOnline(self.messages)
+            respText = resp.content.strip() if resp.success else ('Error: ' + resp.error)
+            self.printAiResponse(resp)
+        self.messages.append(Message('assistant', respText))
+        self.flushHousekeeping()
+        self.usageLedger.save()
+        self.printChatBubble('user', self.currTopic)
+
+    #按顺序发送上次运行因为网络不可用而没有发送出去的消息
+    #每条消息发送前先从文件中删除，仍然发送不出去的话 fetchWhenOnline() 会重新保存
+    def sendPending(self):
+        for item in self.loadPending():
+            self.dropPending(item)
+            topic = item.get('topic')
+            index = next((idx for idx, conv in enumerate(self.history) if conv.topic == topic), -1)
+            if index >= 0:
+                self.switchConversation(self.history.pop(index))
+                if self.messages[-1]['role'] == 'user' and self.messages[-1]['content'] == item['content']:
+                    self.messages.pop() #已经保存到历史会话但是没有回答
+                self.replayConversation()
+            sprint('Sending the message pending from the last session', fg='bright_black')
+            for line in item['content'].splitlines():
+                print(f'» {line}')
+            print('')
+            self.sendMessage(item['content'])
+
+    #返回最近一次请求的耗时字符串(首字节/总耗时)，用于显示在AI对话泡泡上
+    def getTimingTag(self):
+        rec = self.client.metrics.last
+        if not self.config.get('show_timing') or not rec:
+            return ''
+        return '{:.1f}/{:.1f}s'.format(rec['ttfb_ms'] / 1000, rec['total_ms'] / 1000)
+
+    #一次请求可以发送的字符数，根据 token_limit 计算
+    #不能超过model的上下文长度，每个token的字符数使用实际用量校准过的值
+    def charLimit(self):
+        limit = self.config.get("token_limit", 4000)
+        ratio = UsageLedger.DEFAULT_RATIO
+        if self.client:
+            limit = min(limit, self.client.contextSize)
+            ratio = self.usageLedger.charsPerToken(self.client.name)
+        return int(limit * ratio)
 
     #从消息历史中截取符合token长度要求的最近一部分会话，用于发送给AI服务器
     #返回一个新的列表
+    @hotPath('getTrimmedChat')
     def getTrimmedChat(self, messages: list):
         if not messages:
             return messages
-        limit = int(self.config.get("token_limit", 4000) * 3) #简化token计算公式：字节数/3
+        limit = self.charLimit()
         currLen = len(messages[0]['content']) + 20 # 20='role'/'system'/symbols:[]{},""
         newMsgs = []
         for idx in range(len(messages) - 1, 0, -1):
@@ -881,9 +2760,85 @@ class InkWell:
             currLen += len(content) + 20
             if currLen > limit:
                 break
-            newMsgs.append({'role': role, 'content': content})
+            newMsgs.append(messages[idx] if content else Message(role, content)) #共享原消息对象，不复制内容
         return messages[:1] + newMsgs[::-1]
 
+    #将检索到的背景附加在系统prompt后面，背景的总长度不超过token限制的一半
+    #文档模式：/doc 打开的文档中和问题相关的块
+    #记忆模式：只发送最近 memory_turns 轮对话，当前会话更早的对话和其他会话中与问题相关的片段
+    #作为背景，每次请求的长度不会随着会话变长而增加
+    def getContextChat(self, messages):
+        question = messages[-1]['content']
+        budget = self.charLimit() // 2
+        contexts = []
+        recentStart = 1
+        if self.document:
+            try:
+                chunks = self.document.search(question, max(1, self.config.get('doc_chunks', 4)), budget)
+            except Exception:
+                chunks = []
+            if chunks:
+                contexts.append(DOC_PROMPT.format(name=self.document.name, chunks='\n\n'.join(chunks)))
+                budget -= len(contexts[-1])
+        if self.config.get('memory_mode'):
+            keep = max(0, self.config.get('memory_turns', 2)) * 2 + 1 #最近的几轮问答和当前问题
+            recentStart = max(1, len(messages) - keep)
+            try:
+                chunks = self.memory.search(question, messages, recentStart, self.history, self.currTopic,
+                    k=max(1, self.config.get('memory_chunks', 4)), budget=budget) if budget > 0 else []
+            except Exception:
+                chunks = []
+            if chunks:
+                contexts.append(MEMORY_PROMPT.format(chunks='\n\n'.join(f'[{topic}]\n{text}' for topic, text in chunks)))
+        system = messages[0]
+        if contexts:
+            system = Message('system', '\n\n'.join([system['content']] + contexts))
+        return self.getTrimmedChat([system] + messages[recentStart:])
+
+    #打开一个Kindle文档(txt/html)，之后的问题从文档中检索相关的块作为背景，name为空则退出文档模式
+    def openDocument(self, name):
+        if not name:
+            if self.document:
+                print('Stopped answering from {}'.format(style(self.document.name, bold=True)))
+                self.document = None
+            else:
+                print('Usage: /doc <file> to ask questions about a txt/html document, /doc again to stop')
+            return
+        if not (fileName := self.findDocument(name)):
+            print('No txt/html document matches {}'.format(style(name, bold=True)))
+            return
+        doc = None
+        try:
+            doc = DocumentIndex(fileName, os.path.join(os.path.dirname(self.cfgFile), DOC_INDEX_DIR))
+            if not doc.done:
+                sprint('Indexing {}, Ctrl-C to pause'.format(doc.name), fg='bright_black')
+                doc.build(lambda pct: print(f'\r{pct * 100:.0f}%', end='', flush=True))
+                print('\r100%')
+        except KeyboardInterrupt:
+            print('')
+            if not doc:
+                return
+            sprint('Indexing paused at {:.0f}%, enter the same /doc command to continue'.format(doc.progress * 100),
+                bold=True)
+        except Exception as e:
+            print(f'Failed to index the document: {e}')
+            return
+        self.document = doc
+        sprint('Questions are answered from {} ({} chunks), enter /doc to stop'.format(doc.name, len(doc.index)),
+            bold=True)
+
+    #查找文档，可以是完整路径、Kindle文档目录下的相对路径，或者文档目录下文件名的一部分
+    def findDocument(self, name):
+        for path in (name, os.path.join(KINDLE_DOC_DIR, name), os.path.join(BASE_PATH, name)):
+            if os.path.isfile(path):
+                return os.path.abspath(path)
+        name = name.lower()
+        for root, _, files in os.walk(KINDLE_DOC_DIR):
+            for fileName in sorted(files):
+                if name in fileName.lower() and fileName.lower().endswith(DocumentIndex.EXTS):
+                    return os.path.join(root, fileName)
+        return None
+
     #更新ApiKey
     def renewApiKey(self):
         url = self.config.get('renew_api_key', '')
@@ -893,7 +2848,7 @@ class InkWell:
 
         parts = urlsplit(url)
         kC = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
-        conn = kC(parts.netloc, timeout=60)
+        conn = kC(parts.netloc, timeout=self.getTimeouts()[1])
 
         url = f"{parts.path}?{parts.query}" if parts.query else parts.path
         conn.request('GET', url)
@@ -906,11 +2861,11 @@ class InkWell:
             body = newKey = modified = None
         if not (200 <= resp.status < 300) or not body:
             print(f'Failed to renew api key: {resp.status}: {resp.reason}: {body}')
-        elif newKey == self.config.get('api_key'):
+        elif newKey == self.client.profile.get('api_key'):
             print(f'Your api key is up to date: {modified}')
         elif newKey:
             self.client.apiKey = newKey
-            self.config['api_key'] = newKey
+            self.client.profile['api_key'] = newKey
             self.saveConfig(self.config)
             print(f'Api key has been renewed successfully: {modified}')
         else:
@@ -918,15 +2873,64 @@ class InkWell:
 
         conn.close()
 
+    #根据配置创建AI客户端和加载历史对话
+    def createClient(self):
+        cfg = self.config
+        self.client = ProviderRouter(self.getProfiles(), cooldown=cfg.get('failover_cooldown', 300),
+            catalog=self.modelCatalog, timeouts=self.getTimeouts())
+        if traceFile := cfg.get('trace_file'): #相对路径为相对配置文件所在目录
+            self.client.metrics.traceFile = os.path.join(os.path.dirname(self.cfgFile), traceFile)
+        self.utilityClient = self.createUtilityClient()
+        self.history = self.loadHistory()
+        if self.netProbe:
+            self.netProbe.stop()
+        self.netProbe = NetworkProbe(self.client.probeAddress, onOnline=self.client.warmUp)
+        if cfg.get('net_probe', True):
+            self.netProbe.start()
+        else:
+            self.netProbe.online.set()
+
+    #根据 utility_profile 创建处理辅助任务的客户端，没有配置则返回None
+    #utility_profile 和主配置的服务商相同时，没有填写的 api_key/api_host 等使用主配置的
+    def createUtilityClient(self):
+        utility = self.config.get('utility_profile')
+        if not utility or not isinstance(utility, dict):
+            return None
+        main = self.getProfiles()[0]
+        provider = str(utility.get('provider') or main.get('provider')).lower()
+        if provider not in AI_LIST:
+            print(f'Ignored invalid utility_profile: {utility}')
+            return None
+        profile = {}
+        if provider == main.get('provider'):
+            profile = {key: main.get(key) for key in ('api_key', 'api_host', 'chat_type', 'compress_hosts')}
+        profile.update(utility)
+        profile['provider'] = provider
+        if not profile.get('api_key'):
+            print('Ignored utility_profile: the api key is missing')
+            return None
+        return ProviderRouter([profile], metrics=self.client.metrics, catalog=self.modelCatalog,
+            timeouts=self.getTimeouts())
+
+    #配置的网络超时 (连接超时, 读取超时)，单位为秒
+    def getTimeouts(self):
+        return (max(1, self.config.get('connect_timeout', 10) or 10), max(1, self.config.get('read_timeout', 60) or 60))
+
+    #关闭所有客户端的连接
+    def closeClients(self):
+        self.client.close()
+        if self.utilityClient:
+            self.utilityClient.close()
+
     #主循环入口
     #clippings: 为True则直接进入选择摘要模式，否则默认新建一个对话
-    def start(self, clippings=False):
+    #resident: 常驻进程模式，复用已经创建的客户端，退出时不关闭连接
+    def start(self, clippings=False, resident=False):
         cfg = self.config
         if cfg is None:
             return
 
-        apiKey = cfg.get('api_key')
-        if not apiKey:
+        if not all(item.get('api_key') for item in self.getProfiles()):
             print('')
             sprint('Api key is missing', bold=True)
             sprint('Set it in the config file or run with the -s option', bold=True)
@@ -934,34 +2938,48 @@ class InkWell:
             input_ = input('Press return key to quit ')
             return
 
-        provider = cfg.get('provider')
-        model = cfg.get('model')
-        singleTurn = bool(cfg.get('chat_type') == 'single_turn')
-
-        self.client = SimpleAiProvider(provider, apiKey=apiKey, model=model, apiHost=cfg.get('api_host'),
-            singleTurn=singleTurn)
-        self.history = self.loadHistory()
+        if not (resident and self.client):
+            self.createClient()
         self.startNewConversation()
 
-        print('Model: {}'.format(style(f'{provider}/{model}', bold=True)))
+        print('Model: {}'.format(style(repr(self.client), bold=True)))
         print('Prompt: {}'.format(style(self.currPrompt, bold=True)))
         print('{} send, {} menu, {} clips, {} quit'.format(style(' Enter ', fg='white', bg='cyan'),
             style(' ? ', fg='white', bg='cyan'), style(' c ', fg='white', bg='cyan'),
             style(' q ', fg='white', bg='cyan')))
         #print('Empty line to send, ? to menu, q to quit')
 
+        try:
+            self.chatLoop(clippings)
+        except (KeyboardInterrupt, EOFError): #Ctrl-C 或输入结束，保存当前会话后退出
+            print('')
+
+        if not resident:
+            self.closeClients()
+        self.addCurrentConvToHistory()
+
+    #聊天主循环，直到用户退出
+    def chatLoop(self, clippings=False):
+        cfg = self.config
         quitRequested = False
         #直接进入选择读书摘要界面
         if not clippings:
-            self.printChatBubble('user', self.currTopic)
+            if self.loadPending():
+                self.sendPending()
+            else:
+                self.printChatBubble('user', self.currTopic)
         elif self.summarizeClippings() == 'quit':
             quitRequested = True
         
         while not quitRequested:
             msgArr = []
             while not quitRequested:
-                sys.stdin.flush()
-                input_ = input("» ")
+                if self.typeAhead: #等待回答期间已经输入的行
+                    input_ = self.typeAhead.pop(0)
+                    print(f'» {input_}')
+                else:
+                    sys.stdin.flush()
+                    input_ = input("» ")
                 if input_ in ('q', 'Q'):
                     quitRequested = True
                     break
@@ -970,6 +2988,32 @@ class InkWell:
                 elif input_ == 'c': #进入选择读书摘要界面
                     if self.summarizeClippings() == 'quit':
                         self.replayConversation() #中断了分享读书摘要，回到原先的对话
+                elif input_ == '/more' and not msgArr: #回放历史对话时往前翻一页
+                    perPage = max(1, cfg.get('replay_turns', 10)) * 2
+                    if (self.replayPage + 1) * perPage < len(self.messages) - 1:
+                        self.replayConversation(self.replayPage + 1)
+                    else:
+                        print('No earlier turns')
+                elif input_ == '/stats' and not msgArr: #显示网络请求的延时统计
+                    self.showStats()
+                    self.printChatBubble('user', self.currTopic)
+                elif input_ == '/usage' and not msgArr: #显示token用量
+                    self.showUsage()
+                    self.printChatBubble('user', self.currTopic)
+                elif input_ == '/timers' and not msgArr: #显示热点函数耗时
+                    self.showTimers()
+                    self.printChatBubble('user', self.currTopic)
+                elif (input_ == '/doc' or input_.startswith('/doc ')) and not msgArr: #针对一个文档提问
+                    self.openDocument(input_[4:].strip())
+                    self.printChatBubble('user', self.currTopic)
+                elif input_.startswith('/compare') and not msgArr: #将上一个问题同时发给多个model比较
+                    specs = [e for e in input_[8:].replace(' ', '').split(',') if e]
+                    if specs and len(self.messages) > 2 and self.messages[-1]['role'] == 'assistant':
+                        if respText := self.compareModels(specs, self.messages[:-1]):
+                            self.messages[-1]['content'] = respText
+                    else:
+                        print('Usage: /compare model1,provider/model2,... to ask the last question again')
+                    self.printChatBubble('user', self.currTopic)
                 elif input_ == '?':
                     msgArr = []
                     ret = 'reshow'
@@ -993,20 +3037,370 @@ class InkWell:
                         msgArr.append(input_)
                     elif msg: #输入一个空行并且之前已经有过输入，发送请求
                         msgArr = []
-                        self.messages.append({"role": 'user', "content": msg})
-                        if len(self.messages) == 2: #第一次交谈，使用用户输出的开头四个单词做为topic
-                            self.updateTopic(msg)
-                        elif len(self.messages) == 4: #第三次交谈，使用ai总结谈话内容做为topic
-                            self.updateTopic()
-                        resp = self.fetchAiResponse(self.messages)
-                        respText = resp.content.strip() if resp.success else ('Error: ' + resp.error)
-                        self.messages.append({"role": 'assistant', "content": respText})
-                        self.printAiResponse(resp)
-                        self.printChatBubble('user', self.currTopic)
+                        self.sendMessage(msg)
 
-        self.client.close()
+    #常驻进程模式，保持配置、历史对话、prompt和长连接，通过Unix socket为 inkwell_attach.py 提供终端会话
+    #一次只服务一个会话，空闲超过 daemon_idle 分钟后自动退出，避免耗电
+    def runDaemon(self, sockPath):
+        if self.config is None or not all(item.get('api_key') for item in self.getProfiles()):
+            return
+        try:
+            if os.path.exists(sockPath):
+                os.remove(sockPath)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            oldMask = os.umask(0o177) #socket文件权限为0600，其他用户不能连接
+            try:
+                server.bind(sockPath)
+            finally:
+                os.umask(oldMask)
+            server.listen(1)
+        except Exception as e:
+            print(f'Failed to listen on {sockPath}: {e}')
+            return
+
+        #脱离启动它的终端，终端关闭后继续运行
+        try:
+            os.setsid()
+        except OSError: #已经是进程组组长，比如直接从shell启动
+            pass
+        devNull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devNull, fd)
+
+        self.createClient()
+        self.loadPrompts() #createClient() 启动的网络检测会在网络可用时提前完成DNS解析和TLS握手
+        cfgMtime = os.path.getmtime(self.cfgFile)
+        server.settimeout(max(1, self.config.get('daemon_idle', 10)) * 60)
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            #配置文件被修改过则重新加载
+            if os.path.isfile(self.cfgFile) and os.path.getmtime(self.cfgFile) != cfgMtime:
+                cfgMtime = os.path.getmtime(self.cfgFile)
+                self.addCurrentConvToHistory()
+                self.config = self.loadConfig()
+                self.closeClients()
+                self.createClient()
+            self.runDaemonSession(conn)
+        server.close()
+        os.remove(sockPath)
+        self.closeClients()
         self.addCurrentConvToHistory()
 
+    #将标准输入输出重定向到socket，运行一个终端会话
+    def runDaemonSession(self, conn):
+        #逐字节读取输入，缓存中不会留下还没有处理的行，waitForRequest 使用select检测输入时不会遗漏
+        rFile = io.TextIOWrapper(io.BufferedReader(socket.SocketIO(conn, 'rb'), buffer_size=1), encoding='utf-8',
+            newline='')
+        rFile._CHUNK_SIZE = 1
+        wFile = conn.makefile('w', encoding='utf-8', newline='')
+        wFile.reconfigure(line_buffering=True)
+        oldIn, oldOut = sys.stdin, sys.stdout
+        sys.stdin, sys.stdout = rFile, wFile
+        self.daemonSession = True
+        try:
+            handshake = rFile.readline() #第一行为客户端参数：INKWELL clippings=0/1 cols=N
+            cols = re.search(r'cols=(\d+)', handshake)
+            if cols: #常驻进程没有终端，使用客户端的终端宽度
+                os.environ['COLUMNS'] = cols.group(1)
+            self.start(clippings=bool('clippings=1' in handshake), resident=True)
+        except (EOFError, OSError, KeyboardInterrupt): #客户端断开连接，保存当前会话
+            self.saveDaemonSession()
+        except Exception: #其他异常只结束这个会话，记录下来后常驻进程继续服务
+            self.logDaemonError()
+            self.saveDaemonSession()
+        finally:
+            sys.stdin, sys.stdout = oldIn, oldOut
+            self.daemonSession = False
+            for f in (rFile, wFile, conn):
+                try:
+                    f.close()
+                except Exception:
+                    pass
+
+    #会话结束时保存当前会话，失败只记录，不影响常驻进程
+    def saveDaemonSession(self):
+        try:
+            self.addCurrentConvToHistory()
+        except Exception:
+            self.logDaemonError()
+
+    #将当前异常的调用栈追加到日志文件，同时尽量显示给客户端
+    def logDaemonError(self):
+        import traceback
+        detail = traceback.format_exc()
+        try:
+            with open(os.path.join(os.path.dirname(self.cfgFile), DAEMON_LOG), 'a', encoding='utf-8') as f:
+                f.write('{}\n{}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), detail))
+        except Exception:
+            pass
+        try:
+            print(loc_exc_pos('Error'))
+        except Exception: #客户端已经断开
+            pass
+
+    #批处理模式，并发执行一个jsonl文件里面的所有请求，结果按完成顺序追加到输出文件
+    #每行为一个json对象：{"prompt": "...", "system": "...", "model": "...", "id": "..."}
+    #或者 {"messages": [{"role": "user", "content": "..."}], "model": "..."}
+    #输出文件同时作为检查点，重新运行时会跳过已经成功的行
+    #jobs: 并发数，默认为 key数量*host数量
+    def runBatch(self, inFile, outFile, jobs=0):
+        cfg = self.config
+        if cfg is None:
+            return
+        profile = self.getProfiles()[0] #批处理和转发服务只使用第一个服务商配置
+        if not profile.get('api_key'):
+            print('Api key is missing, set it in the config file or run with the -s option')
+            return
+
+        try:
+            with open(inFile, 'r', encoding='utf-8') as f:
+                lines = [line.strip() for line in f]
+        except Exception as e:
+            print('Failed to read {}: {}'.format(style(inFile, bold=True), str(e)))
+            return
+
+        done = set() #已经成功的行号
+        if os.path.isfile(outFile):
+            with open(outFile, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(rec, dict) and rec.get('success'):
+                        done.add(rec.get('index'))
+
+        tasks = queue.Queue()
+        for idx, line in enumerate(lines):
+            if line and idx not in done:
+                tasks.put((idx, line))
+        total = tasks.qsize()
+        print(f'Batch: {total} to run, {len(done)} done before')
+        if not total:
+            return
+
+        pool = ProviderPool(profile.get('provider'), apiKey=profile.get('api_key'), model=profile.get('model'),
+            apiHost=profile.get('api_host'), singleTurn=bool(profile.get('chat_type') == 'single_turn'),
+            compressHosts=profile.get('compress_hosts'), size=jobs)
+        pool.ledger = self.usageLedger
+        stopEvent = threading.Event()
+        outLock = threading.Lock()
+        counter = [0, 0] #完成数，失败数
+
+        def worker(outF):
+            while not stopEvent.is_set():
+                try:
+                    idx, line = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                rec = self.runBatchLine(pool, idx, line)
+                with outLock:
+                    outF.write(json.dumps(rec, ensure_ascii=False) + '\n')
+                    outF.flush()
+                    counter[0] += 1
+                    counter[1] += int(not rec['success'])
+                    state = 'ok' if rec['success'] else rec['error'][:60]
+                    print(f'[{counter[0]}/{total}] #{idx} {state}')
+
+        with open(outFile, 'a', encoding='utf-8') as outF:
+            threads = [threading.Thread(target=worker, args=(outF,), daemon=True)
+                for _ in range(min(pool.size, total))]
+            for t in threads:
+                t.start()
+            try:
+                while any(t.is_alive() for t in threads):
+                    for t in threads:
+                        t.join(0.2)
+            except KeyboardInterrupt: #等待正在进行的请求结束，未执行的行下次继续
+                stopEvent.set()
+                print('Interrupted, waiting for the running requests...')
+                for t in threads:
+                    t.join()
+        pool.close()
+        self.usageLedger.save()
+        print('Batch finished: {} succeeded, {} failed, results in {}'.format(counter[0] - counter[1], counter[1],
+            style(outFile, bold=True)))
+
+    #执行批处理的一行，返回需要写入输出文件的结果字典
+    def runBatchLine(self, pool, idx, line):
+        item = {}
+        start = time.perf_counter()
+        try:
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {'prompt': item}
+            elif not isinstance(item, dict): #合法的json但不是对象，比如数组或数字
+                item = {}
+                raise ValueError('Each line must be a json object or string')
+            messages = item.get('messages') or [{'role': 'user', 'content': item['prompt']}]
+            if messages[0].get('role') != 'system':
+                system = item.get('system') or self.getPromptText(self.config.get('prompt', 'default'))
+                messages = [{'role': 'system', 'content': system}] + messages
+            model = item.get('model') or pool.model
+            respTxt, host = pool.chat(self.getTrimmedChat(messages), model=model)
+        except Exception:
+            return {'index': idx, 'id': item.get('id'), 'success': False, 'error': loc_exc_pos('Error'),
+                'elapsed_ms': round((time.perf_counter() - start) * 1000)}
+        return {'index': idx, 'id': item.get('id'), 'success': True, 'content': respTxt, 'model': model,
+            'host': host, 'elapsed_ms': round((time.perf_counter() - start) * 1000)}
+
+    #启动本地OpenAI兼容的转发服务，多个设备共享同一组key和长连接，统一执行速率限制
+    #转发服务接受openai格式的请求，需要的话由 SimpleAiProvider 转换为gemini/anthropic格式
+    #addr: 监听地址，格式为 host:port 或 :port(只监听本机)，监听其他地址需要设置 relay_key
+    def serve(self, addr):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+        cfg = self.config
+        if cfg is None:
+            return
+        profile = self.getProfiles()[0] #批处理和转发服务只使用第一个服务商配置
+        if not profile.get('api_key'):
+            print('Api key is missing, set it in the config file or run with the -s option')
+            return
+        host, _, port = addr.rpartition(':')
+        if not port.isdigit():
+            print(f'Invalid listening address: {addr}')
+            return
+        host = host.strip('[]') or '127.0.0.1' #没有写地址时只监听本机
+        #监听其他网络接口时必须设置 relay_key，否则局域网内任何人都可以使用这里的api key
+        if not (host == 'localhost' or host == '::1' or host.startswith('127.')) and not cfg.get('relay_key'):
+            print(f'Refused to listen on {host} without authentication, set "relay_key" in the config file first')
+            return
+
+        pool = ProviderPool(profile.get('provider'), apiKey=profile.get('api_key'), model=profile.get('model'),
+            apiHost=profile.get('api_host'), singleTurn=bool(profile.get('chat_type') == 'single_turn'),
+            compressHosts=profile.get('compress_hosts'))
+        pool.ledger = ledger = self.usageLedger
+        lastSave = [time.monotonic()] #用量账本最多每分钟保存一次
+        relayKey = cfg.get('relay_key', '')
+
+        class RelayHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' #支持客户端的长连接
+            disable_nagle_algorithm = True #响应头和响应体分开发送，避免延时确认带来的40ms延时
+            MAX_BODY = 8 * 1024 * 1024 #请求体的最大字节数
+
+            def log_message(self, format, *args): #每个请求结束时由 do_POST 打印一行简单日志
+                pass
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0].rstrip('/').endswith('/models'):
+                    models = [{'id': m['name'], 'object': 'model', 'owned_by': pool.name}
+                        for m in AI_LIST[pool.name]['models']]
+                    self.sendJson(200, {'object': 'list', 'data': models})
+                else:
+                    self.sendError(404, 'Not found')
+
+            #读取请求体之前先检查路径、relay_key和长度，出错时请求体没有读取，响应后关闭连接，
+            #否则长连接上没有读取的数据会被当作下一个请求
+            def do_POST(self):
+                start = time.perf_counter()
+                if not self.path.split('?', 1)[0].rstrip('/').endswith('/chat/completions'):
+                    self.close_connection = True
+                    self.sendError(404, 'Not found')
+                    return
+                if relayKey and not hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'),
+                    f'Bearer {relayKey}'.encode('utf-8')):
+                    self.close_connection = True
+                    self.sendError(401, 'Invalid relay key')
+                    return
+                length = str_to_int(self.headers.get('Content-Length') or '0', -1)
+                if not (0 <= length <= self.MAX_BODY):
+                    self.close_connection = True
+                    self.sendError(413 if length > 0 else 411, 'Invalid request length')
+                    return
+                body = self.rfile.read(length)
+                try:
+                    req = json.loads(decodeBody(body, self.headers.get('Content-Encoding')).decode('utf-8'))
+                    messages = [{'role': e.get('role', 'user'), 'content': self.textOf(e.get('content'))}
+                        for e in req['messages']]
+                    model = req.get('model') or pool.model
+                    if any(model == m['name'] for name, item in AI_LIST.items() if name != pool.name
+                        for m in item['models']): #客户端按其他服务商配置时，使用转发服务的model
+                        model = pool.model
+                except Exception as e:
+                    self.sendError(400, f'Invalid request: {e}')
+                    return
+
+                try:
+                    respTxt, upHost = pool.chat(messages, model=model)
+                except HttpResponseError as e:
+                    self.sendError(e.status, str(e))
+                    upHost = 'upstream error'
+                except Exception as e:
+                    self.sendError(502, str(e) or type(e).__name__)
+                    upHost = 'upstream error'
+                else:
+                    result = {'id': f'chatcmpl-inkwell{int(time.time() * 1000)}', 'object': 'chat.completion',
+                        'created': int(time.time()), 'model': model, 'choices': [{'index': 0, 'message':
+                        {'role': 'assistant', 'content': respTxt}, 'finish_reason': 'stop'}]}
+                    if req.get('stream'):
+                        self.sendStream(result)
+                    else:
+                        self.sendJson(200, result)
+                print('{} {} {} -> {} {:.1f}s'.format(self.client_address[0], self.command, model, upHost,
+                    time.perf_counter() - start))
+                if time.monotonic() - lastSave[0] > 60:
+                    lastSave[0] = time.monotonic()
+                    ledger.save()
+
+            #openai的content可以为多部分的列表，转发时只保留文本
+            def textOf(self, content):
+                if isinstance(content, list):
+                    return '\n'.join(e.get('text', '') for e in content if isinstance(e, dict))
+                return content or ''
+
+            def sendError(self, status, message):
+                self.sendJson(status, {'error': {'message': message, 'type': 'relay_error', 'code': status}})
+
+            def sendJson(self, status, data):
+                body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.sendBody(status, 'application/json', body)
+
+            #客户端请求流式输出时，将完整的回答作为一个数据块发送
+            def sendStream(self, result):
+                chunk = {'id': result['id'], 'object': 'chat.completion.chunk', 'created': result['created'],
+                    'model': result['model'], 'choices': [{'index': 0, 'delta': result['choices'][0]['message'],
+                    'finish_reason': 'stop'}]}
+                body = 'data: {}\n\ndata: [DONE]\n\n'.format(json.dumps(chunk, ensure_ascii=False))
+                self.sendBody(200, 'text/event-stream', body.encode('utf-8'))
+
+            def sendBody(self, status, contentType, body):
+                gzipped = len(body) > 512 and 'gzip' in self.headers.get('Accept-Encoding', '')
+                if gzipped:
+                    body = gzipBody(body)
+                self.send_response(status)
+                self.send_header('Content-Type', f'{contentType}; charset=utf-8')
+                if gzipped:
+                    self.send_header('Content-Encoding', 'gzip')
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class RelayServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        try:
+            server = RelayServer((host, int(port)), RelayHandler)
+        except Exception as e:
+            print(f'Failed to listen on {addr}: {e}')
+            pool.close()
+            return
+        print('Relay for {} listening on {}, {} upstream clients'.format(style(f'{pool.name}/{pool.model}', bold=True),
+            style(f'{host}:{port}', bold=True), pool.size))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        pool.close()
+        ledger.save()
+
     #交互式配置过程
     def setup(self):
         cfg = {}
@@ -1182,6 +3576,113 @@ AI_LIST = {
         {'name': 'qwen-max', 'rpm': 60, 'context': 32000},],},
 }
 
+#从model目录缓存合并的model信息，由 ModelCatalog.merge() 填充，内置的 AI_LIST 保持不变
+#格式为 {provider: {model: {'name':, 'rpm':, 'context':}}}，内置model只保存有变化的字段
+LIVE_MODELS = {}
+
+#返回某个服务商可用的model列表：内置列表使用缓存的信息更新，再加上缓存中新的model
+def providerModels(name):
+    models = AI_LIST[name]['models']
+    if not (live := LIVE_MODELS.get(name)):
+        return models
+    known = {item['name'] for item in models}
+    return ([dict(item, **live[item['name']]) if item['name'] in live else item for item in models] +
+        [item for key, item in sorted(live.items()) if key not in known])
+
+#响应头里面的每分钟请求数限制，其他服务商的同名响应头可能是每天的限制，不使用
+RATE_LIMIT_HEADERS = {'openai': 'x-ratelimit-limit-requests', 'anthropic': 'anthropic-ratelimit-requests-limit'}
+
+#openai兼容接口的models列表里面不能用于聊天的model
+NON_CHAT_MODEL_PATTERN = re.compile(r'embed|tts|whisper|dall-e|moderation|davinci|babbage|audio|realtime|transcribe|image|search|guard')
+
+#model目录缓存，保存从服务商获取的model列表和上下文长度、速率限制等信息，过期后重新获取
+#fileName: json文件，格式为 {provider: {"time": 时间戳, "models": [{"name":, "context":, "rpm":}]}}
+#ttl: 有效期(秒)
+class ModelCatalog:
+    def __init__(self, fileName=None, ttl=86400):
+        self.fileName = fileName
+        self.ttl = ttl
+        self.data = None
+        self.lock = threading.RLock()
+
+    def load(self):
+        with self.lock:
+            if self.data is None:
+                self.data = {}
+                try:
+                    with open(self.fileName, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    if isinstance(data, dict):
+                        self.data = data
+                except Exception:
+                    pass
+            return self.data
+
+    def save(self):
+        if not self.fileName:
+            return
+        with self.lock:
+            try:
+                with open(self.fileName, 'w', encoding='utf-8') as f:
+                    json.dump(self.data, f, ensure_ascii=False, indent=1)
+            except Exception:
+                pass
+
+    #返回缓存的model信息列表，没有缓存返回空列表
+    def get(self, provider):
+        return (self.load().get(provider) or {}).get('models', [])
+
+    #返回缓存已经保存了多少秒，没有缓存返回None
+    def age(self, provider):
+        entry = self.load().get(provider)
+        return (time.time() - entry['time']) if entry and entry.get('time') else None
+
+    def isStale(self, provider):
+        age = self.age(provider)
+        return age is None or age > self.ttl
+
+    #保存从服务商获取的model列表，保留之前记录的速率限制
+    def update(self, provider, models):
+        with self.lock:
+            hints = {item['name']: item['rpm'] for item in self.get(provider) if item.get('rpm')}
+            for item in models:
+                if not item.get('rpm') and item['name'] in hints:
+                    item['rpm'] = hints[item['name']]
+            self.load()[provider] = {'time': int(time.time()), 'models': models}
+            self.save()
+        self.merge(provider)
+
+    #记录某个model的一项元数据，比如从响应头得到的速率限制，值没有变化则不保存
+    def setHint(self, provider, model, key, value):
+        with self.lock:
+            entry = self.load().setdefault(provider, {'time': 0, 'models': []})
+            item = next((m for m in entry['models'] if m['name'] == model), None)
+            if item is None:
+                item = {'name': model}
+                entry['models'].append(item)
+            if item.get(key) == value:
+                return
+            item[key] = value
+            self.save()
+        self.merge(provider)
+
+    #将缓存的信息合并到 LIVE_MODELS，新的model使用内置列表第一项的参数作为默认值
+    def merge(self, provider=None):
+        for name in ([provider] if provider else list(self.load())):
+            if name not in AI_LIST:
+                continue
+            models = AI_LIST[name]['models']
+            known = {item['name'] for item in models}
+            live = {}
+            for info in self.get(name):
+                if info['name'] in known:
+                    if fields := {k: info[k] for k in ('context', 'rpm') if info.get(k)}:
+                        live[info['name']] = fields
+                else:
+                    live[info['name']] = {'name': info['name'], 'rpm': info.get('rpm') or models[0]['rpm'],
+                        'context': info.get('context') or models[0]['context']}
+            LIVE_MODELS[name] = live
+
 #自定义HTTP响应错误异常
 class HttpResponseError(Exception):
     def __init__(self, status, reason, body=None):
@@ -1190,39 +3691,511 @@ class HttpResponseError(Exception):
         self.reason = reason
         self.body = body
 
+#判断异常是否因为网络不可用(域名解析失败、网络不可达)
+def isNetworkDownError(e):
+    import errno
+    if isinstance(e, socket.gaierror):
+        return True
+    return isinstance(e, OSError) and e.errno in (errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN)
+
+#后台检测网络是否可用：解析域名并建立到当前主机的TCP连接
+#kindle启动程序时才打开wifi，如果马上发送请求，经常因为网络还没有就绪而失败
+#addrFunc: 返回 (host, port) 的函数
+#onOnline: 检测到网络可用时调用，比如预先完成TLS握手，调用返回后才设置 online 事件
+class NetworkProbe:
+    def __init__(self, addrFunc, onOnline=None, interval=2.0):
+        self.addrFunc = addrFunc
+        self.onOnline = onOnline
+        self.interval = interval
+        self.online = threading.Event() #网络可用并且已经完成预连接
+        self.checked = threading.Event() #最近一次检测已经有了结果
+        self.reachable = False #最近一次检测的结果
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            if not self.online.is_set() and self.probe():
+                if self.onOnline: #先完成预连接再通知等待中的请求，避免两个线程同时使用同一个连接
+                    try:
+                        self.onOnline()
+                    except Exception:
+                        pass
+                self.online.set()
+            self.wakeup.wait(self.interval if not self.online.is_set() else None)
+            self.wakeup.clear()
+
+    #检测一次并记录结果，通知 settle() 中等待的线程
+    def probe(self):
+        self.reachable = self.check()
+        self.checked.set()
+        return self.reachable
+
+    #等待最近一次检测的结果，最多等待 timeout 秒，返回网络是否可用
+    #刚启动时检测和预连接还没有完成，网络可用的话不需要把消息当作等待发送的消息
+    def settle(self, timeout):
+        if not self.online.is_set():
+            self.checked.wait(timeout)
+        return self.online.is_set() or (self.checked.is_set() and self.reachable)
+
+    def check(self):
+        try:
+            host, port = self.addrFunc()
+            socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            with socket.create_connection((host, port), timeout=3):
+                return True
+        except Exception:
+            return False
+
+    #请求因为网络问题失败，重新开始检测
+    def markOffline(self):
+        self.online.clear()
+        self.checked.clear()
+        self.reachable = False
+        self.wakeup.set()
+
+#用户取消正在进行的请求时抛出
+class RequestCancelled(Exception):
+    pass
+
+#整个请求(包括重试和切换主机)超过了配置的截止时间
+class DeadlineExceeded(Exception):
+    pass
+
+#取消令牌，用于中断工作线程中正在进行的网络请求
+#工作线程发送请求前调用 attach() 登记使用的连接，其他线程调用 cancel() 时关闭此连接的socket，阻塞中的读操作马上返回
+#令牌同时携带整个请求的截止时间，重试和切换主机时都使用同一个截止时间
+#timeout: 从现在开始的秒数，0 为没有截止时间
+class CancelToken:
+    _local = threading.local()
+    def __init__(self, timeout=0):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.client = None
+        self.index = -1
+        self.timeout = timeout
+        self.deadline = (time.monotonic() + timeout) if timeout > 0 else 0.0
+        self.timedOut = False #是否因为超过截止时间而被取消
+        self.children = [] #同时进行的多个请求各自使用一个子令牌，取消时一起取消
+
+    #创建一个截止时间相同的子令牌，用于并发请求的其中一个工作线程
+    def child(self):
+        token = CancelToken()
+        token.timeout, token.deadline = self.timeout, self.deadline
+        if self.cancelled:
+            token.event.set()
+        self.children.append(token)
+        return token
+
+    #当前线程使用的令牌，没有则返回None
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'token', None)
+    @classmethod
+    def setCurrent(cls, token):
+        cls._local.token = token
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    #距离截止时间的剩余秒数，没有截止时间返回None
+    def remaining(self):
+        return (self.deadline - time.monotonic()) if self.deadline else None
+
+    #如果已经超过截止时间则抛出 DeadlineExceeded
+    def checkDeadline(self):
+        if self.deadline and time.monotonic() >= self.deadline:
+            raise DeadlineExceeded(f'Request timed out after {self.timeout}s')
+
+    #登记正在使用的连接，如果已经取消则抛出 RequestCancelled
+    def attach(self, client, index):
+        with self.lock:
+            self.client, self.index = client, index
+            if self.event.is_set():
+                raise RequestCancelled('Request cancelled')
+
+    def detach(self):
+        with self.lock:
+            self.client, self.index = None, -1
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            conn = self.client.connPools[self.index][1] if self.client else None
+        sock = getattr(conn, 'sock', None)
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for token in self.children:
+            token.cancel()
+
+    #工作线程没有及时退出时，使用新的连接替换被占用的连接，保证连接池可用
+    def recycle(self):
+        with self.lock:
+            client, index = self.client, self.index
+        if client:
+            client.createOneConnection(index)
+        for token in self.children:
+            token.recycle()
+
+#根据 Content-Encoding 解压响应体，支持 gzip/deflate
+def decodeBody(body, encoding):
+    encoding = (encoding or '').lower().strip()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate': #规范是zlib格式，但是有一些服务器发送的是裸deflate数据
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+#将请求体压缩为gzip格式
+def gzipBody(body):
+    comp = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return comp.compress(body) + comp.flush()
+
+#带耗时统计的HTTP连接，connectTime包括DNS解析和TCP连接
+class TimedHTTPConnection(http.client.HTTPConnection):
+    connectTime = 0.0
+    tlsTime = 0.0
+    readTimeout = None #连接建立后socket使用的超时，None 则继续使用连接超时 self.timeout
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        self.connectTime = time.perf_counter() - start
+        if self.readTimeout:
+            self.sock.settimeout(self.readTimeout)
+
+#带耗时统计的HTTPS连接，TCP连接和TLS握手分开计时
+class TimedHTTPSConnection(http.client.HTTPSConnection):
+    connectTime = 0.0
+    tlsTime = 0.0
+    readTimeout = None
+    def connect(self):
+        start = time.perf_counter()
+        http.client.HTTPConnection.connect(self)
+        self.connectTime = time.perf_counter() - start
+        start = time.perf_counter()
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host)
+        self.tlsTime = time.perf_counter() - start
+        if self.readTimeout:
+            self.sock.settimeout(self.readTimeout)
+
+#网络请求的耗时统计，保存在内存的环形缓冲区，可选同时追加到一个jsonl跟踪文件
+#每条记录为一个字典，时间单位为毫秒，字节数为请求体和响应体的长度
+class RequestMetrics:
+    def __init__(self, size=200, traceFile=None):
+        self.records = deque(maxlen=size)
+        self.traceFile = traceFile
+        self.lock = threading.Lock()
+
+    #最近一次请求的记录
+    @property
+    def last(self):
+        return self.records[-1] if self.records else None
+
+    def add(self, record):
+        self.records.append(record)
+        if not self.traceFile:
+            return
+        try:
+            with self.lock, open(self.traceFile, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except Exception as e: #跟踪文件写入失败不影响正常使用
+            self.traceFile = None
+            print(f'Failed to write trace file: {e}')
+
+    #按某个字段分组统计，返回字典 {name: {'count':, 'errors':, 'ttfb_p50':, 'p50':, 'p95':}}
+    #延时百分位数只统计成功的请求
+    def summary(self, key):
+        groups = {}
+        for rec in list(self.records):
+            groups.setdefault(rec.get(key, ''), []).append(rec)
+        ret = {}
+        for name, recs in groups.items():
+            succ = [rec for rec in recs if not rec['error']]
+            totals = sorted(rec['total_ms'] for rec in succ)
+            ttfbs = sorted(rec['ttfb_ms'] for rec in succ)
+            ret[name] = {'count': len(recs), 'errors': len(recs) - len(succ), 'ttfb_p50': percentile(ttfbs, 50),
+                'p50': percentile(totals, 50), 'p95': percentile(totals, 95)}
+        return ret
+
+    #根据某个主机最近成功请求的延时计算自适应超时，返回 (连接超时, 读取超时)，单位为秒
+    #配置值是下限，只会根据统计数据延长，不会缩短：连接超时取 TCP连接+TLS握手 p95 的4倍，不超过配置值的3倍；
+    #读取超时取 p95 首字节时间的3倍和按这个model的 p95 回复长度、p50 生成速度估计的耗时的2倍中较大的，不超过配置值的5倍
+    #样本少于5个时直接使用配置值
+    def timeouts(self, host, model, connectBase, readBase):
+        records = [rec for rec in list(self.records) if rec['host'] == host and not rec['error']]
+        connect = connectBase
+        shakes = sorted(rec['connect_ms'] + rec['tls_ms'] for rec in records if rec['connect_ms'] > 0)
+        if len(shakes) >= 5:
+            connect = min(connectBase * 3, max(connectBase, percentile(shakes, 95) * 4 / 1000))
+        records = [rec for rec in records if rec['model'] == model and rec['resp_plain'] > 0]
+        if len(records) < 5:
+            return connect, readBase
+        ttfb = percentile(sorted(rec['ttfb_ms'] for rec in records), 95)
+        respKb = percentile(sorted(rec['resp_plain'] / 1024 for rec in records), 95)
+        msPerKb = percentile(sorted(rec['ttfb_ms'] * 1024 / rec['resp_plain'] for rec in records), 50)
+        read = max(ttfb * 3, respKb * msPerKb * 2) / 1000
+        return connect, min(max(read, readBase), readBase * 5)
+
+    #返回缓冲区内所有请求的压缩率 (请求压缩率, 响应压缩率)，未压缩为 1.0
+    def compressionRatios(self):
+        records = list(self.records)
+        reqWire = sum(rec['req_bytes'] for rec in records)
+        respWire = sum(rec['resp_bytes'] for rec in records)
+        reqPlain = sum(rec['req_plain'] for rec in records)
+        respPlain = sum(rec['resp_plain'] for rec in records)
+        return (reqPlain / reqWire if reqWire else 1.0), (respPlain / respWire if respWire else 1.0)
+
+#判断一个异常是否值得换一个key/host重试：限流、服务器错误、网络错误
+def isRetryableError(e):
+    if isinstance(e, HttpResponseError):
+        return e.status == 429 or e.status >= 500
+    return isinstance(e, (http.client.HTTPException, OSError))
+
+#返回某个model的rpm，如果model不在列表中，使用第一个model的参数
+def modelRpm(name, model):
+    models = providerModels(name)
+    return next((m['rpm'] for m in models if m['name'] == model), models[0]['rpm'])
+
+#简单的速率限制器，保证相邻两次请求的间隔不小于 60/rpm 秒，多线程安全
+class RateLimiter:
+    def __init__(self, rpm):
+        self.interval = 60.0 / max(1, rpm)
+        self.nextTime = 0.0
+        self.lock = threading.Lock()
+
+    #阻塞直到可以发起下一个请求
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.nextTime - now
+            self.nextTime = max(now, self.nextTime) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+#多线程共享的AI客户端池，每个客户端固定使用一个key和一个host，拥有独立的长连接
+#速率限制按照 key+model 计算，同一个key的客户端共享一个限制器
+#size: 客户端数量，默认为 key数量*host数量，最多8个
+class ProviderPool:
+    def __init__(self, name, apiKey, model=None, apiHost=None, singleTurn=False, compressHosts='', size=0):
+        self.name = name.lower()
+        if self.name not in AI_LIST:
+            raise ValueError(f"Unsupported provider: {name}")
+        keys = [e for e in apiKey.split(';') if e]
+        hosts = [e for e in (apiHost or AI_LIST[self.name]['host']).replace(' ', '').split(';') if e]
+        slots = [(keys[idx % len(keys)], hosts[(idx // len(keys)) % len(hosts)])
+            for idx in range(len(keys) * len(hosts))]
+        self.size = size if size > 0 else min(len(slots), 8)
+        self.metrics = RequestMetrics()
+        self.idle = queue.Queue()
+        self.clients = []
+        for idx in range(self.size):
+            key, host = slots[idx % len(slots)]
+            client = SimpleAiProvider(self.name, apiKey=key, model=model, apiHost=host, singleTurn=singleTurn,
+                compressHosts=compressHosts)
+            client.metrics = self.metrics
+            self.clients.append(client)
+            self.idle.put(client)
+        self.model = self.clients[0].model
+        self.limiters = {}
+        self.lock = threading.Lock()
+        self.ledger = None #UsageLedger 实例，设置后记录每个请求的token用量
+
+    #返回某个key+model对应的速率限制器
+    def limiter(self, key, model):
+        with self.lock:
+            if (key, model) not in self.limiters:
+                self.limiters[(key, model)] = RateLimiter(modelRpm(self.name, model))
+            return self.limiters[(key, model)]
+
+    #借用一个空闲的客户端发送请求，可重试的错误会换一个客户端重试
+    #返回 (respTxt, host)
+    def chat(self, message, model=None, retries=2):
+        for attempt in range(retries + 1):
+            client = self.idle.get()
+            try:
+                client.model = model or self.model
+                self.limiter(client.apiKeys[0], client.model).acquire()
+                respTxt = client.chat(message)
+                if self.ledger:
+                    #和 getTrimmedChat 的计算方法相同，只有纯文本消息时才用于校准
+                    chars = (sum(len(item['content']) + 20 for item in message) if isinstance(message, list)
+                        and all(isinstance(item.get('content'), str) for item in message) else 0)
+                    self.ledger.record(client.name, client.keyTag, client.model, client.lastUsage, chars)
+                return respTxt, client.host
+            except Exception as e:
+                if attempt >= retries or not isRetryableError(e):
+                    raise
+            finally:
+                self.idle.put(client)
+            time.sleep(min(8, 2 ** attempt)) #指数退避
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+#多个服务商配置组成的路由器，按配置顺序使用，遇到可重试的错误(限流、服务器错误、网络错误)自动切换到下一个
+#出错的配置在冷却时间内不再使用，后续对话直接使用当前健康的配置，冷却结束后再尝试排在前面的配置
+#消息历史使用openai格式保存，每个 SimpleAiProvider 会转换为各自服务商的格式
+#对外的接口和 SimpleAiProvider 一致，model/apiKey 等属性对应当前使用的配置
+class ProviderRouter:
+    #profiles: 配置字典列表，每项包含 provider/model/api_key/api_host/chat_type/compress_hosts
+    #cooldown: 出错的配置暂停使用的秒数
+    #metrics: 可以传入一个 RequestMetrics 实例和其他路由器共享统计数据
+    #catalog: ModelCatalog 实例，用于记录响应头里面的速率限制
+    #timeouts: (连接超时, 读取超时) 秒数，为各个主机计算自适应超时的基准
+    def __init__(self, profiles, cooldown=300, metrics=None, catalog=None, timeouts=None):
+        self.profiles = profiles
+        self.cooldown = cooldown
+        self.metrics = metrics or RequestMetrics()
+        self.clients = []
+        for item in profiles:
+            client = SimpleAiProvider(item.get('provider', ''), apiKey=item.get('api_key', ''), model=item.get('model'),
+                apiHost=item.get('api_host'), singleTurn=bool(item.get('chat_type') == 'single_turn'),
+                compressHosts=item.get('compress_hosts'))
+            client.metrics = self.metrics
+            client.catalog = catalog
+            if timeouts:
+                client.connectTimeout, client.readTimeout = timeouts
+            self.clients.append(client)
+        self.currIdx = 0
+        self.downUntil = [0.0] * len(self.clients) #每个配置暂停使用到什么时候
+
+    #当前使用的客户端和配置字典
+    @property
+    def current(self):
+        return self.clients[self.currIdx]
+    @property
+    def profile(self):
+        return self.profiles[self.currIdx]
+
+    @property
+    def name(self):
+        return self.current.name
+    @property
+    def host(self):
+        return self.current.host
+    @property
+    def model(self):
+        return self.current.model
+    @model.setter
+    def model(self, value):
+        self.current.model = value
+        self.current.updateModelInfo()
+    @property
+    def contextSize(self):
+        return self.current.context_size
+    @property
+    def apiKey(self):
+        return self.current.apiKey
+    @apiKey.setter
+    def apiKey(self, value):
+        self.current.apiKey = value
+
+    #用于界面显示，有多个配置时附加服务商名字，便于知道是哪个配置回答的
+    @property
+    def tag(self):
+        tag = self.current.tag
+        if len(self.clients) > 1:
+            tag = f'{self.current.name} {tag}'.strip()
+        return tag
+
+    #按顺序尝试未在冷却中的配置，如果全部在冷却中，则全部尝试一遍
+    def chat(self, message):
+        now = time.monotonic()
+        candidates = [idx for idx in range(len(self.clients)) if self.downUntil[idx] <= now]
+        error = None
+        for idx in (candidates or range(len(self.clients))):
+            try:
+                respTxt = self.clients[idx].chat(message)
+            except Exception as e:
+                if not isRetryableError(e) or len(self.clients) == 1:
+                    raise
+                self.downUntil[idx] = time.monotonic() + self.cooldown
+                error = e
+                continue
+            self.currIdx = idx
+            self.downUntil[idx] = 0.0
+            return respTxt
+        raise error
+
+    def models(self, prebuild=True):
+        return self.current.models(prebuild)
+
+    def warmUp(self):
+        self.current.warmUp()
+
+    def probeAddress(self):
+        return self.current.probeAddress()
+
+    def close(self, index=None):
+        for client in self.clients:
+            client.close()
+
+    def __repr__(self):
+        return repr(self.current)
+
 class SimpleAiProvider:
     #name: AI提供商的名字
     #apiKey: 如需要多个Key，以分号分割，逐个使用
     #apiHost: 支持自搭建的API转发服务器，如传入以分号分割的地址列表字符串，则逐个使用
     #singleTurn: 一些API转发服务不支持多轮对话模式，设置此标识，当前仅支持 openai
-    def __init__(self, name, apiKey, model=None, apiHost=None, singleTurn=False):
+    #compressHosts: 接受gzip压缩请求体的主机列表，以分号分割，'*' 表示全部主机
+    def __init__(self, name, apiKey, model=None, apiHost=None, singleTurn=False, compressHosts=''):
         name = name.lower()
         if name not in AI_LIST:
             raise ValueError(f"Unsupported provider: {name}")
         self.name = name
         self.apiKeys = apiKey.split(';')
         self.apiKeyIdx = 0
+        self.currKey = '' #最近一次取出的ApiKey，用于统计
+        self.lastUsage = {} #最近一次对话的token用量 {'prompt':, 'completion':, 'cached':}
         self.singleTurn = singleTurn
-        self._models = AI_LIST[name]['models']
-        
-        #如果传入的model不在列表中，默认使用第一个的参数
-        item = next((m for m in self._models if m['name'] == model), self._models[0])
-        #self.model = item['name']
-        self.model = model or item['name']
-        self._rpm = item['rpm']
-        self.context_size = item['context']
-        if self._rpm <= 0:
-            self._rpm = 2
-        if self.context_size < 1000:
-            self.context_size = 1000
+        self.metrics = RequestMetrics()
+        self.catalog = None #ModelCatalog 实例，用于记录从响应头得到的速率限制
+        self.connectTimeout = 10 #连接超时和读取超时的基准秒数，实际使用的值根据每个主机的延时统计调整
+        self.readTimeout = 60
+        self.model = model or self._models[0]['name']
+        self.updateModelInfo()
         #分析主机和url，保存为 SplitResult(scheme,netloc,path,query,frament)元祖
         #connPools每个元素为 [host_tuple, conn_obj]
         self.connPools = [[urlsplit(e if e.startswith('http') else ('https://' + e)), None]
             for e in (apiHost or AI_LIST[name]['host']).replace(' ', '').split(';')]
         self.host = '' #当前正在使用的 netloc
         self.connIdx = 0
+        self.compressHosts = [e.split('://', 1)[-1].strip('/') for e in (compressHosts or '').replace(' ', '').split(';') if e]
         self.createConnections()
 
+    #内置列表和model目录缓存合并后的model列表
+    @property
+    def _models(self):
+        return providerModels(self.name)
+
+    #从model列表更新当前model的速率和上下文长度，切换model或者合并了model目录缓存后调用
+    #如果model不在列表中，默认使用第一个的参数
+    def updateModelInfo(self):
+        item = next((m for m in self._models if m['name'] == self.model), self._models[0])
+        self._rpm = item['rpm']
+        self.context_size = item['context']
+        if self._rpm <= 0:
+            self._rpm = 2
+        if self.context_size < 1000:
+            self.context_size = 1000
+
     #返回速率限制，如果有多个host或key，则速率可以倍数放大
     @property
     def rpm(self):
@@ -1232,10 +4205,16 @@ class SimpleAiProvider:
     def tag(self):
         return self.host if len(self.connPools) > 1 else ""
 
+    #最近一次使用的ApiKey的后四位，用于统计
+    @property
+    def keyTag(self):
+        key = self.currKey
+        return f'...{key[-4:]}' if len(key) > 8 else '...'
+
     #自动获取下一个ApiKey
     @property
     def apiKey(self):
-        ret = self.apiKeys[self.apiKeyIdx]
+        ret = self.currKey = self.apiKeys[self.apiKeyIdx]
         self.apiKeyIdx = (self.apiKeyIdx + 1) % len(self.apiKeys)
         return ret
     @apiKey.setter
@@ -1271,35 +4250,123 @@ class SimpleAiProvider:
         #使用HTTPSConnection有一个好处是短时间多次对话只需要一次握手
         if host.scheme == 'https':
             sslCtx = ssl._create_unverified_context()
-            conn = http.client.HTTPSConnection(host.netloc, timeout=60, context=sslCtx)
+            conn = TimedHTTPSConnection(host.netloc, timeout=self.connectTimeout, context=sslCtx)
         else:
-            conn = http.client.HTTPConnection(host.netloc, timeout=60)
+            conn = TimedHTTPConnection(host.netloc, timeout=self.connectTimeout)
+        conn.readTimeout = self.readTimeout
         self.connPools[index][1] = conn
 
+    #返回某个主机当前使用的 (连接超时, 读取超时)
+    def timeouts(self, netloc):
+        return self.metrics.timeouts(netloc, self.model, self.connectTimeout, self.readTimeout)
+
+    #判断是否可以向某个主机发送gzip压缩的请求体
+    def acceptsGzip(self, netloc):
+        return any(e in ('*', netloc) for e in self.compressHosts)
+
     #发起一个网络请求，返回json数据
+    #每次尝试都会记录一条耗时统计到 self.metrics
+    #字节数统计中 req_bytes/resp_bytes 为实际传输的字节数，req_plain/resp_plain 为未压缩时的字节数
+    @hotPath('_send')
     def _send(self, path, headers=None, payload=None, toJson=True, method='POST'):
         if payload:
-            payload = json.dumps(payload)
+            payload = dumpsPayload(payload).encode('utf-8')
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        token = CancelToken.current()
         retried = 0
         while retried < 2:
+            if token:
+                token.checkDeadline()
+            index, host, conn = self.nextConnection() #(index, host_tuple, conn_obj)
+            self.host = host.netloc
+            #连接超时和读取超时分开设置，都不超过截止时间的剩余秒数
+            connectTimeout, readTimeout = self.timeouts(host.netloc)
+            if token and token.deadline:
+                remaining = max(0.1, token.remaining())
+                connectTimeout, readTimeout = min(connectTimeout, remaining), min(readTimeout, remaining)
+            conn.timeout, conn.readTimeout = connectTimeout, readTimeout
+            if conn.sock:
+                conn.sock.settimeout(readTimeout)
+            key = self.currKey
+            body = payload
+            reqHeaders = headers
+            if payload and len(payload) > 512 and self.acceptsGzip(host.netloc): #太短的数据压缩没有意义
+                body = gzipBody(payload)
+                reqHeaders = dict(headers, **{'Content-Encoding': 'gzip'})
+            rec = {'time': int(time.time()), 'host': host.netloc, 'model': self.model, 'path': path.split('?', 1)[0],
+                'key': f'...{key[-4:]}' if len(key) > 8 else '...', 'status': 0, 'error': '', 'connect_ms': 0,
+                'tls_ms': 0, 'ttfb_ms': 0, 'total_ms': 0, 'req_bytes': len(body or b''),
+                'req_plain': len(payload or b''), 'resp_bytes': 0, 'resp_plain': 0}
+            conn.connectTime = conn.tlsTime = 0.0
+            start = time.perf_counter()
             try:
-                index, host, conn = self.nextConnection() #(index, host_tuple, conn_obj)
-                self.host = host.netloc
+                if token:
+                    token.attach(self, index)
                 #拼接路径，避免一些边界条件出错
                 url = '/' + host.path.strip('/') + (('?' + host.query) if host.query else '') + path.lstrip('/')
-                conn.request(method, url, payload, headers)
+                conn.request(method, url, body, reqHeaders)
                 resp = conn.getresponse()
-                body = resp.read().decode("utf-8")
+                rec['ttfb_ms'] = round((time.perf_counter() - start) * 1000, 1)
+                rec['status'] = resp.status
+                body = resp.read()
+                rec['resp_bytes'] = len(body)
+                body = decodeBody(body, resp.getheader('Content-Encoding'))
+                rec['resp_plain'] = len(body)
+                body = body.decode("utf-8")
                 #print(resp.reason, ', ', body) #TODO
                 if not (200 <= resp.status < 300):
                     raise HttpResponseError(resp.status, resp.reason, body)
+                self.noteRateLimit(resp)
                 return json.loads(body) if toJson else body
-            except (http.client.CannotSendRequest, http.client.RemoteDisconnected) as e:
-                if retried:
+            except Exception as e:
+                if token and token.cancelled: #用户取消，关闭连接，下次请求时自动重连
+                    rec['error'] = 'cancelled'
+                    conn.close()
+                    raise RequestCancelled('Request cancelled') from None
+                elif token and token.deadline and token.remaining() <= 0: #超时是截止时间导致的，不算主机的错误
+                    rec['error'] = 'deadline'
+                    conn.close()
+                    raise DeadlineExceeded(f'Request timed out after {token.timeout}s') from None
+                elif isinstance(e, (http.client.CannotSendRequest, http.client.RemoteDisconnected)):
+                    rec['error'] = type(e).__name__
+                    if retried:
+                        raise
+                    #print("Connection issue, retrying:", e)
+                    self.createOneConnection(index)
+                    retried += 1
+                else:
+                    rec['error'] = str(e)[:100] or type(e).__name__
                     raise
-                #print("Connection issue, retrying:", e)
-                self.createOneConnection(index)
-                retried += 1
+            finally:
+                if token:
+                    token.detach()
+                rec['connect_ms'] = round(conn.connectTime * 1000, 1)
+                rec['tls_ms'] = round(conn.tlsTime * 1000, 1)
+                rec['total_ms'] = round((time.perf_counter() - start) * 1000, 1)
+                self.metrics.add(rec)
+
+    #记录响应头里面的每分钟请求数限制到model目录缓存
+    def noteRateLimit(self, resp):
+        header = RATE_LIMIT_HEADERS.get(self.name)
+        if not (header and self.catalog) or (rpm := str_to_int(resp.getheader(header) or '')) <= 0:
+            return
+        self.catalog.setHint(self.name, self.model, 'rpm', rpm)
+        self.updateModelInfo()
+
+    #预先建立所有连接，完成DNS解析、TCP连接和TLS握手，失败则忽略，发送请求时会自动重连
+    def warmUp(self):
+        for host, conn in self.connPools:
+            try:
+                if conn and not conn.sock:
+                    conn.connect()
+            except Exception:
+                pass
+
+    #返回下一个请求将要使用的主机地址 (host, port)，用于检测网络是否可用
+    def probeAddress(self):
+        host = self.connPools[self.connIdx][0]
+        return host.hostname, host.port or (443 if host.scheme == 'https' else 80)
 
     #关闭连接
     #index: 如果传入一个整型，则只关闭对应索引的连接
@@ -1325,7 +4392,7 @@ class SimpleAiProvider:
     #传入 list/dict 可以定制 role 等参数
     #返回 respTxt
     def chat(self, message):
-        if not self.apiKey:
+        if not any(self.apiKeys): #不能使用 self.apiKey 判断，否则会多消耗一个key，导致轮换失效
             raise ValueError(f'The api key is empty')
         name = self.name
         if name == "openai":
@@ -1348,39 +4415,50 @@ class SimpleAiProvider:
             raise ValueError(f"Unsupported provider: {name}")
 
     #返回当前服务提供商支持的models列表
+    #prebuild: True 返回内置列表(已经合并了model目录缓存)，False 从服务商获取
     def models(self, prebuild=True):
-        if self.name in ('openai', 'xai'):
-            return self._openai_models()
-        elif self.name == 'google':
+        return [item['name'] for item in (self._models if prebuild else self.modelInfos())]
+
+    #从服务商获取models列表和元数据，返回 [{'name':, 'context':}]，不支持获取的服务商返回内置列表
+    def modelInfos(self):
+        if self.name == 'google':
             return self._google_models()
+        elif self.name in ('openai', 'xai', 'mistral'):
+            return self._openai_models()
+        elif self.name == 'groq':
+            return self._openai_models(path='openai/v1/models')
         else:
-            return [item['name'] for item in self._models]
+            return [{'name': item['name'], 'context': item['context']} for item in self._models]
 
     #openai的chat接口
     def _openai_chat(self, message, path='v1/chat/completions'):
         headers = {'Authorization': f'Bearer {self.apiKey}', 'Content-Type': 'application/json'}
         if isinstance(message, str):
             msg = [{"role": "user", "content": message}]
-        elif self.singleTurn and (len(message) > 1): #将多轮对话手动拼接为单一轮对话
-            msgArr = ['Previous conversions:\n']
-            roleMap = {'system': 'background', 'assistant': 'Your responsed'}
-            msgArr.extend([f'{roleMap.get(e["role"], "I asked")}:\n{e["content"]}\n' for e in message[:-1]])
-            msgArr.append(f'\nPlease continue this conversation based on the previous information:\n')
-            msgArr.append("I ask:")
-            msgArr.append(message[-1]['content'])
-            msgArr.append("You Response:\n")
-            msg = [{"role": "user", "content": '\n'.join(msgArr)}]
+        elif self.singleTurn and (len(message) > 1): #将多轮对话手动拼接为单一轮对话，直接拼接转义后的片段
+            msgArr = [jsonEscape('Previous conversions:\n')]
+            msgArr.extend([encodeMessage(e, 'single_turn') for e in message[:-1]])
+            msgArr.append(jsonEscape('\nPlease continue this conversation based on the previous information:\n'))
+            msgArr.append(jsonEscape("I ask:"))
+            msgArr.append(jsonEscape(message[-1]['content']))
+            msgArr.append(jsonEscape("You Response:\n"))
+            msg = RawJson('[{"role": "user", "content": "' + '\\n'.join(msgArr) + '"}]')
         else:
-            msg = message
+            msg = RawJson('[' + ', '.join([encodeMessage(e, 'openai') for e in message]) + ']')
         payload = {"model": self.model, "messages": msg}
         data = self._send(path, headers=headers, payload=payload, method='POST')
+        usage = data.get('usage') or {}
+        self.lastUsage = {'prompt': usage.get('prompt_tokens', 0), 'completion': usage.get('completion_tokens', 0),
+            'cached': (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)}
         return data["choices"][0]["message"]["content"]
 
-    #openai的models接口
-    def _openai_models(self):
+    #openai的models接口，兼容接口可能会返回上下文长度
+    def _openai_models(self, path='v1/models'):
         headers = {'Authorization': f'Bearer {self.apiKey}', 'Content-Type': 'application/json'}
-        data = self._send('v1/models', headers=headers, method='GET')
-        return [item['id'] for item in data['data']]
+        data = self._send(path, headers=headers, method='GET')
+        _context = lambda x: x.get('context_window') or x.get('context_length') or x.get('max_context_length') or 0
+        return [{'name': item['id'], 'context': _context(item)} for item in data['data']
+            if not NON_CHAT_MODEL_PATTERN.search(item['id'])]
 
     #anthropic的chat接口
     def _anthropic_chat(self, message):
@@ -1388,12 +4466,8 @@ class SimpleAiProvider:
             'Content-Type': 'application/json', 'x-api-key': self.apiKey}
 
         if isinstance(message, list): #将openai的payload格式转换为anthropic的格式
-            msg = []
-            for item in message:
-                role = 'Human' if (item.get('role') != 'assistant') else 'Assistant'
-                content = item.get('content', '')
-                msg.append(f"\n\n{role}: {content}")
-            prompt = ''.join(msg) + "\n\nAssistant:"
+            msg = [encodeMessage(item, 'anthropic') for item in message]
+            prompt = RawJson('"' + ''.join(msg) + jsonEscape("\n\nAssistant:") + '"')
             payload = {"prompt": prompt, "model": self.model, "max_tokens_to_sample": 256}
         elif isinstance(message, dict):
             payload = message
@@ -1402,6 +4476,9 @@ class SimpleAiProvider:
             payload = {"prompt": prompt, "model": self.model, "max_tokens_to_sample": 256}
         
         data = self._send('v1/complete', headers=headers, payload=payload, method='POST')
+        usage = data.get('usage') or {} #旧的complete接口不返回用量
+        self.lastUsage = {'prompt': usage.get('input_tokens', 0), 'completion': usage.get('output_tokens', 0),
+            'cached': usage.get('cache_read_input_tokens', 0)}
         return data["completion"]
 
     #gemini的chat接口
@@ -1409,27 +4486,27 @@ class SimpleAiProvider:
         url = f'v1beta/models/{self.model}:generateContent?key={self.apiKey}'
         headers = {'Content-Type': 'application/json'}
         if isinstance(message, list): #将openai的payload格式转换为gemini的格式
-            msg = []
-            for item in message:
-                role = 'user' if (item.get('role') != 'assistant') else 'model'
-                content = item.get('content', '')
-                msg.append({'role': role, 'parts': [{'text': content}]})
-            payload = {'contents': msg}
+            msg = [encodeMessage(item, 'google') for item in message]
+            payload = {'contents': RawJson('[' + ', '.join(msg) + ']')}
         elif isinstance(message, dict):
             payload = message
         else:
             payload = {'contents': [{'role': 'user', 'parts': [{'text': message}]}]}
         data = self._send(url, headers=headers, payload=payload, method='POST')
+        usage = data.get('usageMetadata') or {}
+        self.lastUsage = {'prompt': usage.get('promptTokenCount', 0), 'completion': usage.get('candidatesTokenCount', 0),
+            'cached': usage.get('cachedContentTokenCount', 0)}
         contents = data["candidates"][0]["content"]
         return contents['parts'][0]['text']
 
-    #google的models接口
+    #google的models接口，只返回支持 generateContent 的model
     def _google_models(self):
-        url = f'v1beta/models?key={self.apiKey}&pageSize=100'
+        url = f'v1beta/models?key={self.apiKey}&pageSize=1000'
         headers = {'Content-Type': 'application/json'}
         data = self._send(url, headers=headers, method='GET')
         _trim = lambda x: x[7:] if x.startswith('models/') else x
-        return [_trim(item['name']) for item in data['models']]
+        return [{'name': _trim(item['name']), 'context': item.get('inputTokenLimit', 0)} for item in data['models']
+            if 'generateContent' in item.get('supportedGenerationMethods', ['generateContent'])]
 
     #xai的chat接口
     def _xai_chat(self, message):
@@ -1475,15 +4552,38 @@ def loc_exc_pos(msg: str):
     else:
         return msg
 
+#常驻进程的Unix socket路径，每个配置文件对应一个常驻进程
+#Kindle的 /mnt/us 为vfat格式，不支持创建socket文件，所以放在 /tmp
+#注意：inkwell_attach.py 里面有相同的算法
+def daemonSocketPath(cfgFile):
+    return '/tmp/inkwell-{:08x}.sock'.format(zlib.crc32(cfgFile.encode('utf-8')))
+
 #分析命令行参数
 def getArg():
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--setup", action="store_true", help="Start interactive configuration")
     parser.add_argument("-c", "--config", metavar="FILE", help="Specify a configuration file")
     parser.add_argument("-k", "--clippings", action="store_true", help="Start in clippings")
+    parser.add_argument("-b", "--batch", metavar="FILE", help="Run the prompts of a jsonl file non-interactively")
+    parser.add_argument("-o", "--out", metavar="FILE", help="Output jsonl file of the batch mode")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="Concurrent requests of the batch mode")
+    parser.add_argument("--serve", metavar="ADDR", help="Run an OpenAI compatible relay server, e.g. :8080 or 0.0.0.0:8080")
+    parser.add_argument("--compare", metavar="MODELS", help="Send every question to these models, e.g. m1,m2")
+    parser.add_argument("--daemon", action="store_true", help="Run as a resident process for inkwell_attach.py")
+    parser.add_argument("--mem-report", action="store_true", help="Report the memory used by the history")
+    parser.add_argument("--profile", metavar="FILE", nargs='?', const='', help="Run under cProfile and save the stats")
+    parser.add_argument("--trace-alloc", action="store_true", help="Report the memory allocated by each phase")
     return parser.parse_args()
 
 if __name__ == "__main__":
+    args = getArg()
+    cfgFile = os.path.abspath(args.config or CONFIG_JSON)
+    if args.trace_alloc:
+        allocTracer.start()
+    if args.daemon: #常驻进程不需要显示标题
+        InkWell(cfgFile).runDaemon(daemonSocketPath(cfgFile))
+        sys.exit(0)
+
     print(style(r'''  _____         _                    _  _ ''', fg='green'))
     print(style(r''' |_   _|       | |                  | || |''', fg='green'))
     print(style(r'''   | |   _ __  | | ____      __ ___ | || |''', fg='green'))
@@ -1493,19 +4593,31 @@ if __name__ == "__main__":
     print(style(r'''                                          ''', fg='green'))
     print(__Version__)
 
-    args = getArg()
-    cfgFile = args.config
-    if cfgFile:
-        cfgFile = os.path.abspath(cfgFile)
-
     #如果不是初始化并且指定了配置文件，则配置文件必须存在
-    if not args.setup and cfgFile and not os.path.isfile(cfgFile):
+    if not args.setup and args.config and not os.path.isfile(cfgFile):
         print('The file {} does not exist'.format(style(cfgFile, bold=True)))
         print('')
         input_ = input('Press return key to quit ')
     else:
-        inkwell = InkWell(cfgFile)
-        if args.setup:
-            inkwell.setup()
+        def run():
+            inkwell = InkWell(cfgFile)
+            if args.setup:
+                inkwell.setup()
+
+            if args.mem_report:
+                inkwell.memReport()
+            elif args.serve:
+                inkwell.serve(args.serve)
+            elif args.batch:
+                inkwell.runBatch(args.batch, args.out or (os.path.splitext(args.batch)[0] + '_out.jsonl'), args.jobs)
+            else:
+                if args.compare:
+                    inkwell.compareSpecs = [e for e in args.compare.replace(' ', '').split(',') if e]
+                inkwell.start(args.clippings)
 
-        inkwell.start(args.clippings)
+        if args.profile is not None:
+            runProfiled(run, os.path.abspath(args.profile or os.path.join(os.path.dirname(cfgFile), 'inkwell.prof')))
+        else:
+            run()
+        if args.trace_alloc:
+            allocTracer.report()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#Author: cdhigh <https://github.com/cdhigh>
+"""inkwell.py 常驻进程的瘦客户端，用于KUAL菜单快速启动
+1. 只使用几个内置模块，不需要解析 inkwell.py、导入ssl/http.client、加载配置和历史文件
+2. 通过Unix socket连接常驻进程，转发终端的输入输出
+3. 常驻进程不存在时自动启动，启动失败则直接运行 inkwell.py
+用法(参数和 inkwell.py 相同)：
+python3 inkwell_attach.py --config /mnt/us/extensions/kterm/ai/google.json [--clippings]
+"""
+import os, sys, time, zlib, select, signal, socket
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+INKWELL_PY = os.path.join(BASE_PATH, 'inkwell.py')
+
+#和 inkwell.py 里面的 daemonSocketPath() 算法相同
+def daemonSocketPath(cfgFile):
+    return '/tmp/inkwell-{:08x}.sock'.format(zlib.crc32(cfgFile.encode('utf-8')))
+
+#连接常驻进程，返回socket对象，失败返回None
+def connect(sockPath):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockPath)
+        return sock
+    except OSError:
+        sock.close()
+        return None
+
+#启动常驻进程并等待其就绪，返回socket对象，失败返回None
+def spawnDaemon(sockPath, cfgFile):
+    os.spawnv(os.P_NOWAIT, sys.executable, [sys.executable, INKWELL_PY, '--daemon', '--config', cfgFile])
+    for _ in range(150):
+        time.sleep(0.1)
+        if sock := connect(sockPath):
+            return sock
+    return None
+
+#Ctrl-C 不结束客户端，而是向常驻进程发送一行 q，用于取消正在进行的请求
+#2秒内连续按两次 Ctrl-C 则退出客户端
+def forwardInterrupt(sock):
+    last = [0.0]
+    def handler(signum, frame):
+        now = time.monotonic()
+        if now - last[0] < 2:
+            raise KeyboardInterrupt
+        last[0] = now
+        sock.sendall(b'q\n')
+    signal.signal(signal.SIGINT, handler)
+
+#在终端和常驻进程之间转发数据，直到任何一方关闭
+def proxy(sock):
+    inFd, outFd = sys.stdin.fileno(), sys.stdout.fileno()
+    watch = [inFd, sock]
+    while True:
+        readable, _, _ = select.select(watch, [], [])
+        if sock in readable:
+            data = sock.recv(4096)
+            if not data:
+                return
+            os.write(outFd, data)
+        if inFd in readable:
+            data = os.read(inFd, 4096)
+            if data:
+                sock.sendall(data)
+            else: #终端输入结束，通知常驻进程
+                sock.shutdown(socket.SHUT_WR)
+                watch = [sock]
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    cfgFile = os.path.join(BASE_PATH, 'config.json')
+    for opt in ('-c', '--config'):
+        if opt in argv and argv.index(opt) + 1 < len(argv):
+            cfgFile = argv[argv.index(opt) + 1]
+    cfgFile = os.path.abspath(cfgFile)
+    clippings = any(opt in argv for opt in ('-k', '--clippings'))
+
+    sockPath = daemonSocketPath(cfgFile)
+    sock = None
+    if os.path.isfile(cfgFile) and not any(opt in argv for opt in ('-s', '--setup')):
+        sock = connect(sockPath) or spawnDaemon(sockPath, cfgFile)
+    if not sock: #无法使用常驻进程，直接运行
+        os.execv(sys.executable, [sys.executable, INKWELL_PY] + argv)
+
+    try:
+        try:
+            cols = os.get_terminal_size(sys.stdout.fileno()).columns
+        except OSError:
+            cols = 80
+        sock.sendall('INKWELL clippings={} cols={}\n'.format(int(clippings), cols).encode('utf-8'))
+        forwardInterrupt(sock)
+        proxy(sock)
+    except (KeyboardInterrupt, OSError):
+        pass
+    finally:
+        sock.close()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#Author: cdhigh <https://github.com/cdhigh>
+"""ConversationMemory 检索较早对话的测试
+用法：
+python -m unittest discover tests
+"""
+import os, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import inkwell
+
+class ConversationMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        archive = inkwell.ConversationArchive(self.tmpDir.name)
+        self.memory = inkwell.ConversationMemory(archive, os.path.join(self.tmpDir.name, 'memory.bin'))
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    #会话开头的问答不会因为先加入索引而得分偏高，更相关的后期问答排在前面
+    def testEarlyTurnsNotFavoured(self):
+        messages = [{'role': 'system', 'content': 'prompt'},
+            {'role': 'user', 'content': 'What did Seneca write?'},
+            {'role': 'assistant', 'content': 'Seneca wrote letters about life.'}]
+        for idx in range(200):
+            messages.append({'role': 'user', 'content': f'Tell me about chapter {idx} of the novel'})
+            messages.append({'role': 'assistant', 'content': f'Chapter {idx} describes a journey by ship.'})
+        messages.append({'role': 'user', 'content': 'Seneca on the shortness of life'})
+        messages.append({'role': 'assistant', 'content': 'Seneca argues life is long if you know how to use it.'})
+        found = self.memory.search('seneca shortness of life', messages, len(messages), [], 'topic', k=2)
+        self.assertEqual(len(found), 2)
+        self.assertIn('shortness', found[0][1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#Author: cdhigh <https://github.com/cdhigh>
+"""TermIndex 检索索引的测试
+用法：
+python -m unittest discover tests
+"""
+import os, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import inkwell
+
+FILLER = ['kindle reading note chapter idea book summary question context number {}'.format(idx)
+    for idx in range(3000)]
+
+class TermIndexTest(unittest.TestCase):
+    TEXT = 'Seneca on the shortness of life and how much of it we waste'
+
+    #相同的文档无论先后添加，得分都相同，而且是余弦相似度
+    def testScoreIndependentOfOrder(self):
+        index = inkwell.TermIndex()
+        first = index.add(self.TEXT, 0, 1)
+        for idx, text in enumerate(FILLER):
+            index.add(text, idx + 1, 1)
+        last = index.add(self.TEXT, len(FILLER) + 1, 1)
+        scores = dict((doc, score) for score, doc in index.search('seneca shortness life', 5))
+        self.assertAlmostEqual(scores[first], scores[last], places=5)
+        self.assertLessEqual(scores[first], 1.0 + 1e-6)
+
+    #保存后重新加载，得分不变
+    def testSaveAndLoad(self):
+        index = inkwell.TermIndex(1 << 12)
+        for idx, text in enumerate([self.TEXT] + FILLER[:500]):
+            index.add(text, idx, 1)
+        expected = index.search('seneca shortness life', 3)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, 'index.bin')
+            index.save(fileName)
+            loaded = inkwell.TermIndex.load(fileName)
+        self.assertEqual(len(loaded), len(index))
+        for (score1, doc1), (score2, doc2) in zip(expected, loaded.search('seneca shortness life', 3)):
+            self.assertEqual(doc1, doc2)
+            self.assertAlmostEqual(score1, score2, places=5)
+
+if __name__ == '__main__':
+    unittest.main()